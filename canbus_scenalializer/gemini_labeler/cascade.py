@@ -0,0 +1,118 @@
+import random
+
+import numpy as np
+
+from classifier import SCENARIO_LABELS
+from prompts import CLASS_NAMES
+
+STAGE_RULE = 'rule'
+STAGE_LLM = 'llm'
+
+# Rule labels the LLM can answer with; others (e.g. "U-Turn") are always left to the LLM
+LLM_LABELS = frozenset(CLASS_NAMES.values())
+
+def rule_stage(classifier, vehicle_state_arrays):
+    """
+    Label a scene with the rule-based classifier and flag the samples it is unsure about.
+
+    Args:
+        classifier (RuleBasedClassifier): Rule classifier.
+        vehicle_state_arrays (dict): CanBusIndex.vehicle_state_arrays of the scene's sample timestamps.
+
+    Returns:
+        tuple: (scenario names, margins, transition mask). A sample is at a transition
+               when its label differs from the previous or the next sample's.
+    """
+    states = vehicle_state_arrays
+    ids = classifier.classify_arrays(states['speed'], states['steering_angle'], states['yaw_rate'], states['turn_signal'])
+    margins = classifier.decision_margins(ids, states['speed'], states['steering_angle'], states['turn_signal'])
+    change = ids[1:] != ids[:-1]
+    transition = np.zeros(len(ids), dtype=bool)
+    transition[1:] |= change
+    transition[:-1] |= change
+    return [SCENARIO_LABELS[i] for i in ids], margins, transition
+
+def select_for_llm(requests, margin_threshold=0.2, budget=None, audit_rate=0.0, seed=0):
+    """
+    Split cascade requests into the ones sent to the LLM and the ones kept by the rule stage.
+
+    Ambiguous samples (margin below `margin_threshold`, or at a label transition)
+    are candidates; with a budget the lowest margins win, transitions first.
+    Samples whose rule label is not one of the LLM classes (LLM_LABELS) can't be
+    kept by the rule stage: they come first, and the ones beyond the budget are
+    left out of both lists so that --resume picks them up.
+    A random `audit_rate` fraction of the confident samples is also sent, so
+    agreement can be measured on samples the rules are sure about.
+
+    Args:
+        requests (list of dict): Requests with 'rule_margin' and 'rule_transition'.
+        margin_threshold (float): Margins below this are ambiguous.
+        budget (int, optional): Maximum number of LLM requests (audits included).
+        audit_rate (float): Fraction of confident samples to audit.
+        seed (int): Seed of the audit draw.
+
+    Returns:
+        tuple: (LLM requests, rule-only requests), each in the original order.
+               LLM requests get 'stage_reason' ('unmapped', 'transition', 'margin' or 'audit').
+    """
+    rng = random.Random(seed)
+    candidates, audits = [], []
+    unmapped = set()
+    for i, r in enumerate(requests):
+        if r['rule_scenario'] not in LLM_LABELS:
+            unmapped.add(i)
+            candidates.append((-1, 0.0, i, 'unmapped'))
+        elif r['rule_transition']:
+            candidates.append((0, 0.0, i, 'transition'))
+        elif r['rule_margin'] < margin_threshold:
+            candidates.append((1, r['rule_margin'], i, 'margin'))
+        elif audit_rate > 0 and rng.random() < audit_rate:
+            audits.append((2, 1.0, i, 'audit'))
+
+    candidates.sort()
+    selected = candidates + audits
+    if budget is not None:
+        selected = selected[:budget]
+
+    reasons = {i: reason for _, _, i, reason in selected}
+    llm_requests, rule_requests = [], []
+    for i, r in enumerate(requests):
+        if i in reasons:
+            llm_requests.append(dict(r, stage_reason=reasons[i]))
+        elif i not in unmapped:
+            rule_requests.append(r)
+    return llm_requests, rule_requests
+
+def rule_result(request):
+    """
+    Result of a sample labeled by the rule stage, shaped like a LabelingEngine result.
+    """
+    result = dict(request)
+    result.update({
+        "label": {
+            "class_name": request['rule_scenario'],
+            "reasoning": f"Rule-based classifier (margin {request['rule_margin']:.2f}).",
+        },
+        "error": None,
+        "stage": STAGE_RULE,
+    })
+    return result
+
+def report_agreement(results):
+    """
+    Print how often the LLM agreed with the rule stage, per selection reason.
+
+    Samples whose rule label is not an LLM class can't agree and are left out.
+
+    Args:
+        results (list of dict): LLM results of the cascade (with 'rule_scenario' and 'stage_reason').
+    """
+    counts = {}
+    for r in results:
+        if r['label'] is None or r['rule_scenario'] not in LLM_LABELS:
+            continue
+        stats = counts.setdefault(r['stage_reason'], [0, 0])
+        stats[0] += r['label'].get('class_name') == r['rule_scenario']
+        stats[1] += 1
+    for reason, (agree, total) in sorted(counts.items()):
+        print(f"  Rule/LLM agreement ({reason}): {agree}/{total} ({agree / total:.1%})")
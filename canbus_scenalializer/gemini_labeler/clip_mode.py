@@ -0,0 +1,115 @@
+import math
+
+from prompts import CLIP_PROMPT, SCENARIO_DEFINITIONS
+
+# Camera of the clip frames (CLIP_PROMPT describes front camera keyframes)
+CLIP_CAMERA = 'CAM_FRONT'
+
+# Largest timestamp step within a clip (keyframes are ~0.5 s apart, the prompt says so)
+MAX_FRAME_GAP_US = 750000
+
+def make_clip_requests(requests, clip_size, max_gap_us=MAX_FRAME_GAP_US):
+    """
+    Group per-sample requests into clip requests of up to `clip_size` consecutive
+    samples of the same scene (in request order).
+
+    Requests filtered out before (--resume, cascade selection) leave holes in a
+    scene, so a clip is also cut where the keyframe index is not the previous
+    one + 1 or the timestamps are more than `max_gap_us` apart. A sample without
+    a CAM_FRONT image can't be part of a clip and is kept as a per-sample request.
+
+    A clip request sends the CAM_FRONT image of every frame plus a CAN summary
+    in one prompt; its member requests are kept under 'samples'.
+
+    Args:
+        requests (list of dict): Per-sample requests from build_requests.
+        clip_size (int): Frames per clip.
+        max_gap_us (int): Largest timestamp step between the frames of a clip (microseconds).
+
+    Returns:
+        list of dict: Clip requests ('sample_token' is the first frame's token),
+                      and the per-sample requests left out of clips.
+    """
+    clips = []
+    current = []
+    for r in requests:
+        if CLIP_CAMERA not in dict(r['images']):
+            if current:
+                clips.append(make_clip_request(current))
+                current = []
+            clips.append(r)
+            continue
+        if current and (len(current) >= clip_size or not is_next_frame(current[-1], r, max_gap_us)):
+            clips.append(make_clip_request(current))
+            current = []
+        current.append(r)
+    if current:
+        clips.append(make_clip_request(current))
+    return clips
+
+def is_next_frame(prev, request, max_gap_us=MAX_FRAME_GAP_US):
+    """
+    Whether `request` is the keyframe right after `prev` in the same scene.
+    """
+    if prev['scene_token'] != request['scene_token']:
+        return False
+    if 'frame_index' in prev and request.get('frame_index') != prev['frame_index'] + 1:
+        return False
+    return 0 <= request['timestamp'] - prev['timestamp'] <= max_gap_us
+
+def make_clip_request(samples):
+    images = []
+    for k, s in enumerate(samples, start=1):
+        path = dict(s['images'])[CLIP_CAMERA]
+        images.append((f"{CLIP_CAMERA}#{k}", path))
+    prompt = CLIP_PROMPT.format(
+        num_frames=len(samples),
+        definitions=SCENARIO_DEFINITIONS,
+        can_summary=can_summary([s['vehicle_state'] for s in samples]),
+    )
+    return {
+        "sample_token": samples[0]['sample_token'],
+        "scene_token": samples[0]['scene_token'],
+        "scene_name": samples[0]['scene_name'],
+        "clip_tokens": [s['sample_token'] for s in samples],
+        "images": images,
+        "prompt": prompt,
+        "samples": samples,
+    }
+
+def can_summary(vehicle_states):
+    """
+    One line per frame, e.g. "frame 1: speed 8.31, steering +0.052, yaw rate -0.012, turn signal none".
+    """
+    signals = {0: "none", 1: "left", 2: "right"}
+    lines = []
+    for k, state in enumerate(vehicle_states, start=1):
+        fields = [
+            f"speed {_fmt(state.get('speed'), '.2f')}",
+            f"steering {_fmt(state.get('steering_angle'), '+.3f')}",
+            f"yaw rate {_fmt(state.get('yaw_rate'), '+.3f')}",
+            f"turn signal {signals.get(state.get('turn_signal', 0), 'unknown')}",
+        ]
+        lines.append(f"frame {k}: " + ", ".join(fields))
+    return "\n".join(lines)
+
+def _fmt(value, spec):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "n/a"
+    return format(value, spec)
+
+def expand_clip_result(result):
+    """
+    Split a clip result into per-sample results (the shape LabelingEngine returns
+    for a single sample), so they can be written like any other sample.
+    """
+    # parse_response normalizes clip replies to {"frames": [...]} with one label per sample
+    frames = result['label']['frames'] if result['label'] is not None else None
+    expanded = []
+    for k, sample in enumerate(result['samples']):
+        r = dict(sample)
+        r.update({key: result[key] for key in ('error', 'attempts', 'cached', 'bytes_original', 'bytes_sent', 'latency')})
+        r['label'] = frames[k] if frames is not None else None
+        r['clip_size'] = len(result['samples'])
+        expanded.append(r)
+    return expanded
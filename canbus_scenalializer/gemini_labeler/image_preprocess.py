@@ -0,0 +1,146 @@
+import asyncio
+import contextlib
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+class ImagePreprocessor:
+    """
+    Prepares the images of a request before they are sent: resize to a maximum
+    long edge, re-encode as JPEG, and optionally tile all images of the request
+    (several cameras and/or consecutive keyframes) into one mosaic.
+
+    With no option set, the original files are sent unchanged.
+
+    `prepare` returns the payload that the transports send: a list of parts
+    {'title', 'data' (bytes), 'mime_type', 'path'}, where 'path' is the original
+    file when it is sent as is (the CLI can then pass it directly), else None.
+    """
+
+    def __init__(self, long_edge=None, quality=None, tile=False, workers=4):
+        """
+        Args:
+            long_edge (int, optional): Maximum length of the longer image side (of the mosaic when tiling).
+            quality (int, optional): JPEG quality for re-encoding (default 85 when an image is re-encoded).
+            tile (bool): Combine all images of a request into one mosaic.
+            workers (int): Threads used by prepare_async.
+        """
+        self.long_edge = long_edge
+        self.quality = quality
+        self.tile = tile
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='preprocess')
+
+    @property
+    def passthrough(self):
+        return not (self.long_edge or self.quality or self.tile)
+
+    def signature(self):
+        """
+        Settings that change what the model sees (part of the response cache key).
+        """
+        if self.passthrough:
+            return "original"
+        return f"long_edge={self.long_edge},quality={self.quality},tile={self.tile}"
+
+    def prepare(self, images):
+        """
+        Args:
+            images (list of tuple): (camera, path) pairs of a request.
+
+        Returns:
+            tuple: (payload parts, original bytes on disk)
+        """
+        original_bytes = sum(os.path.getsize(path) for _, path in images)
+        if self.passthrough:
+            parts = []
+            for camera, path in images:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                parts.append({"title": camera_title(camera), "data": data, "mime_type": "image/jpeg", "path": path})
+            return parts, original_bytes
+
+        if self.tile and len(images) > 1:
+            # Close every file once the mosaic is built (the async engine prepares many requests)
+            with contextlib.ExitStack() as stack:
+                mosaic = tile_images([stack.enter_context(Image.open(path)) for _, path in images], self.long_edge)
+            titles = ", ".join(camera_title(camera) for camera, _ in images)
+            return [{
+                "title": f"Mosaic, left to right and top to bottom: {titles}",
+                "data": encode_jpeg(mosaic, self.quality),
+                "mime_type": "image/jpeg",
+                "path": None,
+            }], original_bytes
+
+        parts = []
+        for camera, path in images:
+            with Image.open(path) as image:
+                data = encode_jpeg(resize_long_edge(image, self.long_edge), self.quality)
+            parts.append({"title": camera_title(camera), "data": data, "mime_type": "image/jpeg", "path": None})
+        return parts, original_bytes
+
+    async def prepare_async(self, images):
+        """
+        prepare() in the thread pool (PIL releases the GIL while decoding/encoding).
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.prepare, images)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def camera_title(camera):
+    """
+    "CAM_FRONT" -> "Front Camera", "CAM_FRONT@-1" -> "Front Camera (t-1)"
+    (previous keyframe), "CAM_FRONT#2" -> "Front Camera (frame 2)" (clip mode),
+    matching the wording of the original SDK prompt.
+    """
+    camera, _, frame = camera.partition("#")
+    camera, _, offset = camera.partition("@")
+    parts = camera.replace("CAM_", "").split("_")
+    title = " ".join(p.capitalize() for p in parts) + " Camera"
+    if offset:
+        title += f" (t{offset})"
+    if frame:
+        title += f" (frame {frame})"
+    return title
+
+def resize_long_edge(image, long_edge):
+    """
+    Downscale so that the longer side is at most `long_edge` (never upscales).
+    """
+    if not long_edge or max(image.size) <= long_edge:
+        return image
+    scale = long_edge / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    # draft() lets the JPEG decoder skip most of the work when shrinking a lot
+    if hasattr(image, 'draft'):
+        image.draft('RGB', size)
+    return image.convert('RGB').resize(size, Image.BILINEAR)
+
+def tile_images(images, long_edge=None):
+    """
+    Tile images into a near-square grid (row-major). Every cell has the size of
+    the first image, scaled so that the mosaic's long edge is at most `long_edge`.
+    """
+    cols = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / cols)
+    w, h = images[0].size
+    scale = 1.0
+    if long_edge and max(cols * w, rows * h) > long_edge:
+        scale = long_edge / max(cols * w, rows * h)
+    cell_w, cell_h = max(1, round(w * scale)), max(1, round(h * scale))
+
+    mosaic = Image.new('RGB', (cols * cell_w, rows * cell_h))
+    for i, image in enumerate(images):
+        if hasattr(image, 'draft'):
+            image.draft('RGB', (cell_w, cell_h))
+        tile = image.convert('RGB').resize((cell_w, cell_h), Image.BILINEAR)
+        mosaic.paste(tile, ((i % cols) * cell_w, (i // cols) * cell_h))
+    return mosaic
+
+def encode_jpeg(image, quality=None):
+    buf = io.BytesIO()
+    image.convert('RGB').save(buf, format='JPEG', quality=quality or 85)
+    return buf.getvalue()
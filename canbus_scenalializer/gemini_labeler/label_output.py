@@ -0,0 +1,131 @@
+import json
+import os
+
+JSONL_FILENAME = 'gemini_labels.jsonl'
+OUTPUT_FILENAME = 'gemini_labels.json'
+
+class JsonlWriter:
+    """
+    Append-only JSONL writer, one labeled sample per line, flushed after every line.
+
+    A crash loses at most the sample being written; a torn last line is
+    skipped by read_records.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torn = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        self.f = open(path, 'a', encoding='utf-8')
+        if torn:
+            # Terminate a torn last line so the next record starts on its own line
+            self.f.write("\n")
+        self.count = 0
+
+    def write(self, record):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_records(path):
+    """
+    Iterate over the records of a JSONL file, skipping incomplete or corrupt lines.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Torn write from an interrupted run
+                continue
+
+def read_done_tokens(path):
+    """
+    Sample tokens already present in a JSONL output (for --resume).
+    """
+    return {record['sample_token'] for record in read_records(path)}
+
+def to_record(result):
+    """
+    JSONL record of one labeled sample: the data_format.md sample fields plus its scene,
+    the stage that labeled it ('llm' or 'rule', see cascade.py) and, in cascade mode,
+    the rule stage's label and margin.
+    """
+    record = {
+        "scene_token": result['scene_token'],
+        "scene_name": result['scene_name'],
+        "sample_token": result['sample_token'],
+        "timestamp": result['timestamp'],
+        "scenario": result['label'].get('class_name', 'Unknown'),
+        "vehicle_state": result['vehicle_state'],
+        "reasoning": result['label'].get('reasoning', ''), # Added reasoning as extra field, though not in strict spec, it's useful.
+        "stage": result.get('stage', 'llm'),
+    }
+    if 'rule_scenario' in result:
+        record["rule_scenario"] = result['rule_scenario']
+        record["rule_margin"] = round(float(result['rule_margin']), 4)
+    return record
+
+def compact_jsonl(jsonl_path, output_path, scene_order=None):
+    """
+    Convert the JSONL output into the nested per-scene layout of data_format.md.
+
+    Samples are sorted by timestamp within a scene (they are appended in completion
+    order), duplicates from resumed runs keep the last record.
+
+    Args:
+        jsonl_path (str): JSONL file written by JsonlWriter.
+        output_path (str): Output JSON file.
+        scene_order (list of str, optional): Scene tokens in output order; other
+                                             scenes follow in order of appearance.
+
+    Returns:
+        int: Number of samples written.
+    """
+    scenes = {}
+    for record in read_records(jsonl_path):
+        scene = scenes.setdefault(record['scene_token'], {
+            "scene_token": record['scene_token'],
+            "scene_name": record['scene_name'],
+            "samples": {}
+        })
+        sample = {k: v for k, v in record.items() if k not in ('scene_token', 'scene_name')}
+        scene["samples"][record['sample_token']] = sample
+
+    order = [token for token in (scene_order or []) if token in scenes]
+    listed = set(order)
+    order += [token for token in scenes if token not in listed]
+
+    final_results = []
+    num_samples = 0
+    for token in order:
+        scene = scenes[token]
+        samples = sorted(scene["samples"].values(), key=lambda s: s['timestamp'])
+        num_samples += len(samples)
+        final_results.append({
+            "scene_token": scene["scene_token"],
+            "scene_name": scene["scene_name"],
+            "samples": samples
+        })
+
+    with open(output_path, 'w') as f:
+        json.dump(final_results, f, indent=2)
+    return num_samples
@@ -1,51 +1,204 @@
 import argparse
 import os
 import sys
-import json
 import time
-from tqdm import tqdm
+import datetime
+import numpy as np
 from nuscenes.nuscenes import NuScenes
+from nuscenes.can_bus.can_bus_api import NuScenesCanBus
 
 # Add current directory to sys.path to allow importing local modules
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if current_dir not in sys.path:
     sys.path.append(current_dir)
 
-from prompts import SYSTEM_PROMPT
-from utils import setup_gemini, load_image
+# Shared CAN bus index lives next to the rule-based classifier
+rule_based_dir = os.path.join(current_dir, '..', 'rule_based')
+if rule_based_dir not in sys.path:
+    sys.path.append(rule_based_dir)
 
-def parse_args():
+from can_index import CanBusIndex, load_can_index, get_scene_samples
+from can_cache import CanBusCache
+from classifier import RuleBasedClassifier
+from clip_mode import make_clip_requests, expand_clip_result, CLIP_CAMERA
+from cascade import rule_stage, select_for_llm, rule_result, report_agreement, STAGE_LLM
+from labeling_engine import LabelingEngine
+from transports import make_transport
+from response_cache import ResponseCache, CACHE_FILENAME
+from image_preprocess import ImagePreprocessor
+from label_output import JsonlWriter, read_done_tokens, to_record, compact_jsonl, JSONL_FILENAME, OUTPUT_FILENAME
+
+DEFAULT_CAMERAS = ('CAM_FRONT', 'CAM_BACK')
+
+def parse_args(default_backend='sdk'):
     parser = argparse.ArgumentParser(description="Generate Ground Truth Ego Behavior Labels using Gemini.")
     parser.add_argument("--version", type=str, default="v1.0-mini", help="NuScenes version (e.g., v1.0-mini, v1.0-trainval)")
     parser.add_argument("--dataroot", type=str, required=True, help="Path to NuScenes data root")
-    parser.add_argument("--output", type=str, default="gemini_labels.json", help="Output JSON file path")
+    parser.add_argument("--output", type=str, default=None, help="Output JSON file path (default: output/<run_id>/gemini_labels.json); samples are appended to the .jsonl next to it while running")
+    parser.add_argument("--resume", action='store_true', help="Skip samples already in the JSONL output (default: the most recent run in output/)")
     parser.add_argument("--limit", type=int, default=None, help="Limit number of samples to process")
-    parser.add_argument("--model", type=str, default="gemini-1.5-flash", help="Gemini model name")
     parser.add_argument("--scene_name", type=str, default=None, help="Specific scene name to process")
-    return parser.parse_args()
+    parser.add_argument("--backend", type=str, default=default_backend, choices=['sdk', 'cli', 'stub'], help="Transport: google-generativeai SDK, gemini CLI, or a local stub for testing")
+    parser.add_argument("--model", type=str, default=None, help="Gemini model name (default: gemini-1.5-flash for sdk, gemini-2.5-flash for cli)")
+    parser.add_argument("--prompt", type=str, default=None, help="Prompt to send to Gemini CLI (cli backend only)")
+    parser.add_argument("--cameras", type=str, nargs='+', default=list(DEFAULT_CAMERAS), help="Cameras sent per sample, if present")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of requests in flight")
+    parser.add_argument("--rate", type=float, default=1.0, help="Maximum requests per second, retries included (0 = unlimited)")
+    parser.add_argument("--burst", type=int, default=1, help="Token bucket size (requests allowed back to back)")
+    parser.add_argument("--max_retries", type=int, default=5, help="Retries with exponential backoff on 429s/timeouts")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--long_edge", type=int, default=None, help="Downscale images (or the mosaic) to this long edge in pixels")
+    parser.add_argument("--jpeg_quality", type=int, default=None, help="Re-encode images as JPEG with this quality")
+    parser.add_argument("--tile", action='store_true', help="Send all images of a sample as one mosaic")
+    parser.add_argument("--prev_frames", type=int, default=0, help="Also send CAM_FRONT of this many preceding keyframes")
+    parser.add_argument("--preprocess_workers", type=int, default=4, help="Threads preparing images ahead of the requests")
+    parser.add_argument("--max_repairs", type=int, default=2, help="Text-only repair prompts per unparseable reply (0 = drop it)")
+    parser.add_argument("--retry_queue_size", type=int, default=100, help="Maximum number of unparseable replies waiting for a repair")
+    parser.add_argument("--clip_size", type=int, default=0, help="Clip mode: label this many consecutive keyframes (CAM_FRONT + CAN summary) per request")
+    parser.add_argument("--cascade", action='store_true', help="Label with the rule-based classifier first and only send ambiguous samples to Gemini")
+    parser.add_argument("--margin", type=float, default=0.2, help="Cascade: rule margins below this (relative distance to a threshold) are ambiguous")
+    parser.add_argument("--llm_budget", type=int, default=None, help="Cascade: maximum number of samples sent to Gemini")
+    parser.add_argument("--audit_rate", type=float, default=0.0, help="Cascade: fraction of confident samples also sent to Gemini to measure agreement")
+    parser.add_argument("--rule_config", type=str, default=os.path.join(rule_based_dir, 'config.yaml'), help="Cascade: rule classifier config")
+    parser.add_argument("--cache", type=str, default=os.path.join(current_dir, '..', 'output', CACHE_FILENAME), help="Response cache (SQLite) keyed by model, prompt and image digests")
+    parser.add_argument("--no_cache", action='store_true', help="Always call the model and do not store responses")
+    parser.add_argument("--cache_max_mb", type=float, default=None, help="Evict least recently used cache entries above this size")
+    parser.add_argument("--cache_max_age_days", type=float, default=None, help="Evict cache entries older than this")
+    args = parser.parse_args()
+    if args.clip_size > 1 and CLIP_CAMERA not in args.cameras:
+        parser.error(f"--clip_size needs {CLIP_CAMERA} in --cameras (clips are built from its images)")
+    return args
+
+def build_requests(nusc, nusc_can, scenes, dataroot, can_cache=None, limit=None, prev_frames=0, classifier=None,
+                   cameras=DEFAULT_CAMERAS):
+    """
+    Collect one labeling request per sample (the images of `cameras` present in the sample).
+
+    With prev_frames > 0, CAM_FRONT of the preceding keyframes of the scene is
+    added first, oldest first, as "CAM_FRONT@-k". With a classifier (cascade mode),
+    every request also gets 'rule_scenario', 'rule_margin' and 'rule_transition'.
+
+    Scenes without CAN bus data (e.g. blacklisted scenes) are labeled from the
+    images alone: their vehicle_state has no CAN values and, in cascade mode,
+    every sample gets margin 0 so that none of them keeps a rule label.
+
+    Returns:
+        list of dict: 'sample_token', 'timestamp', 'scene_token', 'scene_name',
+                      'frame_index' (keyframe index in the scene), 'images' (list of (camera, path))
+                      and 'vehicle_state'.
+    """
+    requests = []
+    for scene in scenes:
+        scene_name = scene['name']
+
+        # Turn signal is in 'vehicle_monitor' usually, but might not be populated in all datasets.
+        # We only load pose/steering, so turn_signal defaults to 0.
+        try:
+            can_index = load_can_index(nusc_can, scene_name, ('pose', 'steeranglefeedback'), can_cache)
+            has_can = True
+        except Exception as e:
+            print(f"No CAN bus data for {scene_name}, labeling from images only: {e}")
+            can_index = CanBusIndex(scene_name, {})
+            has_can = False
+        samples = get_scene_samples(nusc, scene)
+        timestamps = [s['timestamp'] for s in samples]
+        vehicle_states = can_index.vehicle_states(timestamps)
+        if classifier is not None:
+            rule_scenarios, rule_margins, rule_transitions = rule_stage(classifier, can_index.vehicle_state_arrays(timestamps))
+            if not has_can:
+                rule_margins = np.zeros(len(samples))
+
+        for idx, (sample, vehicle_state) in enumerate(zip(samples, vehicle_states)):
+            if limit and len(requests) >= limit:
+                return requests
+
+            images = []
+            for k in range(min(prev_frames, idx), 0, -1):
+                cam_data = nusc.get('sample_data', samples[idx - k]['data']['CAM_FRONT'])
+                images.append((f'CAM_FRONT@-{k}', os.path.join(dataroot, cam_data['filename'])))
+            for camera in cameras:
+                if camera in sample['data']:
+                    cam_data = nusc.get('sample_data', sample['data'][camera])
+                    images.append((camera, os.path.join(dataroot, cam_data['filename'])))
 
-def main():
-    args = parse_args()
+            request = {
+                "sample_token": sample['token'],
+                "timestamp": sample['timestamp'],
+                "scene_token": scene['token'],
+                "scene_name": scene_name,
+                "frame_index": idx,
+                "images": images,
+                "vehicle_state": vehicle_state,
+            }
+            if classifier is not None:
+                request["rule_scenario"] = rule_scenarios[idx]
+                request["rule_margin"] = float(rule_margins[idx])
+                request["rule_transition"] = bool(rule_transitions[idx])
+            requests.append(request)
+    return requests
 
-    # Initialize Gemini
+def find_latest_jsonl(base_output_dir):
+    """
+    JSONL output of the most recent run under output/ (for --resume without --output).
+    """
+    if not os.path.isdir(base_output_dir):
+        return None
+    for run_id in sorted(os.listdir(base_output_dir), reverse=True):
+        path = os.path.join(base_output_dir, run_id, JSONL_FILENAME)
+        if os.path.exists(path):
+            return path
+    return None
+
+def report_transfer(sent):
+    """
+    Print image bytes per request (on disk vs. sent) and the request latency.
+    """
+    n = len(sent["latencies"])
+    if n == 0:
+        return
+    latencies = sorted(sent["latencies"])
+    ratio = sent["bytes_original"] / sent["bytes_sent"] if sent["bytes_sent"] else 0.0
+    print(f"Images per request: {sent['bytes_original'] / n / 1024:.0f} KB on disk -> "
+          f"{sent['bytes_sent'] / n / 1024:.0f} KB sent ({ratio:.1f}x smaller)")
+    print(f"Request latency: mean {sum(latencies) / n:.2f} s, p50 {latencies[n // 2]:.2f} s, "
+          f"p95 {latencies[min(n - 1, int(n * 0.95))]:.2f} s")
+
+def main(default_backend='sdk'):
+    args = parse_args(default_backend)
+
+    # Initialize the transport
     try:
-        model = setup_gemini(model_name=args.model)
-        print(f"Gemini model '{args.model}' initialized.")
+        transport = make_transport(args.backend, model=args.model, prompt=args.prompt, timeout=args.timeout)
+        print(f"Backend '{transport.name}' initialized.")
     except Exception as e:
-        print(f"Error initializing Gemini: {e}")
+        print(f"Error initializing backend '{args.backend}': {e}")
         return
 
     # Initialize NuScenes
     print(f"Initializing NuScenes {args.version}...")
     try:
         nusc = NuScenes(version=args.version, dataroot=args.dataroot, verbose=True)
+        nusc_can = NuScenesCanBus(dataroot=args.dataroot)
+        can_cache = CanBusCache.open(args.dataroot)
     except Exception as e:
         print(f"Error initializing NuScenes: {e}")
         return
 
-    results = []
-    processed_count = 0
-    
+    base_output_dir = os.path.join(current_dir, '..', 'output')
+    output_path = args.output
+    if output_path is None and args.resume:
+        jsonl_path = find_latest_jsonl(base_output_dir)
+        if jsonl_path is not None:
+            output_path = os.path.join(os.path.dirname(jsonl_path), OUTPUT_FILENAME)
+    if output_path is None:
+        # Output directory setup
+        run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_dir = os.path.join(base_output_dir, run_id)
+        os.makedirs(output_dir, exist_ok=True)
+        print(f"Output directory created: {output_dir}")
+        output_path = os.path.join(output_dir, OUTPUT_FILENAME)
+    jsonl_path = os.path.splitext(output_path)[0] + '.jsonl'
+
     # Filter scenes if needed
     scenes = nusc.scene
     if args.scene_name:
@@ -55,80 +208,98 @@ def main():
             return
 
     print(f"Processing {len(scenes)} scenes...")
+    classifier = RuleBasedClassifier(args.rule_config) if args.cascade else None
+    requests = build_requests(nusc, nusc_can, scenes, args.dataroot, can_cache, args.limit, args.prev_frames, classifier,
+                              tuple(args.cameras))
+    if args.resume:
+        done_tokens = read_done_tokens(jsonl_path)
+        requests = [r for r in requests if r['sample_token'] not in done_tokens]
+        print(f"Resuming {jsonl_path}: {len(done_tokens)} samples already labeled, {len(requests)} to go.")
 
-    for scene in scenes:
-        scene_name = scene['name']
-        first_sample_token = scene['first_sample_token']
-        current_sample_token = first_sample_token
+    writer = JsonlWriter(jsonl_path)
+    if args.cascade:
+        num_samples = len(requests)
+        requests, rule_requests = select_for_llm(requests, args.margin, args.llm_budget, args.audit_rate)
+        for r in rule_requests:
+            writer.write(to_record(rule_result(r)))
+        print(f"Cascade: {len(rule_requests)}/{num_samples} samples labeled by the rule stage, "
+              f"{len(requests)} sent to Gemini (margin < {args.margin}, budget {args.llm_budget}, audit rate {args.audit_rate}).")
+        skipped = num_samples - len(rule_requests) - len(requests)
+        if skipped:
+            print(f"Cascade: {skipped} samples with a rule label outside the LLM classes are over the budget and left for --resume.")
 
-        while current_sample_token != '':
-            if args.limit and processed_count >= args.limit:
-                break
+    num_samples = len(requests)
+    if args.clip_size > 1:
+        requests = make_clip_requests(requests, args.clip_size)
+        print(f"Clip mode: {num_samples} samples in {len(requests)} requests of up to {args.clip_size} frames.")
 
-            sample = nusc.get('sample', current_sample_token)
-            timestamp = sample['timestamp']
+    cache = None
+    if not args.no_cache:
+        max_bytes = int(args.cache_max_mb * 1e6) if args.cache_max_mb else None
+        cache = ResponseCache(args.cache, max_bytes=max_bytes, max_age_days=args.cache_max_age_days)
+        cache.evict()
 
-            # Get CAM_FRONT image
-            cam_front_data = nusc.get('sample_data', sample['data']['CAM_FRONT'])
-            cam_front_path = os.path.join(args.dataroot, cam_front_data['filename'])
-            
-            # Get CAM_BACK image (optional, but good for context)
-            cam_back_data = nusc.get('sample_data', sample['data']['CAM_BACK'])
-            cam_back_path = os.path.join(args.dataroot, cam_back_data['filename'])
+    engine = LabelingEngine(
+        transport,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        burst=args.burst,
+        max_retries=args.max_retries,
+        cache=cache,
+        preprocessor=ImagePreprocessor(args.long_edge, args.jpeg_quality, args.tile, args.preprocess_workers),
+        max_repairs=args.max_repairs,
+        retry_queue_size=args.retry_queue_size,
+    )
+    done = [0]
+    sent = {"bytes_original": 0, "bytes_sent": 0, "latencies": []}
+    llm_labels = []
 
-            images = []
-            try:
-                images.append(load_image(cam_front_path))
-                images.append(load_image(cam_back_path))
-            except Exception as e:
-                print(f"Error loading images for sample {current_sample_token}: {e}")
-                current_sample_token = sample['next']
-                continue
-
-            # Construct prompt
-            # We pass images and the system prompt.
-            # Note: Gemini API python client handles image + text list.
-            content = [SYSTEM_PROMPT, "Front Camera:", images[0], "Back Camera:", images[1]]
-
-            try:
-                response = model.generate_content(content)
-                # Parse JSON response
-                # Gemini might return markdown code block ```json ... ```
-                text = response.text
-                if "```json" in text:
-                    text = text.split("```json")[1].split("```")[0].strip()
-                elif "```" in text:
-                    text = text.split("```")[1].strip()
-                
-                data = json.loads(text)
-                
-                result_entry = {
-                    "sample_token": current_sample_token,
-                    "timestamp": timestamp,
-                    "scene_name": scene_name,
-                    "gemini_label": data
-                }
-                results.append(result_entry)
-                print(f"[{processed_count+1}] {scene_name} - {data.get('class_name', 'Unknown')}")
-
-            except Exception as e:
-                print(f"Error processing sample {current_sample_token}: {e}")
-                # Optional: Sleep to avoid rate limits if hitting them hard
-                time.sleep(1)
-
-            processed_count += 1
-            current_sample_token = sample['next']
-            
-            # Rate limiting / Sleep to be safe (adjust as needed)
-            time.sleep(1) 
-        
-        if args.limit and processed_count >= args.limit:
-            break
-
-    # Save results
-    with open(args.output, 'w') as f:
-        json.dump(results, f, indent=2)
-    print(f"Saved {len(results)} labels to {args.output}")
+    def on_result(i, result):
+        done[0] += 1
+        if not result['cached']:
+            sent["bytes_original"] += result['bytes_original']
+            sent["bytes_sent"] += result['bytes_sent']
+            sent["latencies"].append(result['latency'])
+        info = "cached" if result['cached'] else f"{result['bytes_sent'] / 1024:.0f} KB, {result['latency']:.2f} s"
+        if 'clip_tokens' in result:
+            info += f", clip of {len(result['clip_tokens'])}"
+        sample_results = expand_clip_result(result) if 'clip_tokens' in result else [result]
+        for r in sample_results:
+            r['stage'] = STAGE_LLM
+            if args.cascade:
+                llm_labels.append({key: r[key] for key in ('label', 'rule_scenario', 'stage_reason')})
+            if r['label'] is not None:
+                writer.write(to_record(r))
+        if result['label'] is not None:
+            names = ", ".join(r['label'].get('class_name', 'Unknown') for r in sample_results)
+            print(f"[{done[0]}/{len(requests)}] {result['scene_name']} - {names} ({info})")
+        else:
+            print(f"[{done[0]}/{len(requests)}] {result['sample_token']}: {result['error']} ({info})")
+
+    print(f"Labeling {num_samples} samples in {len(requests)} requests (concurrency {args.concurrency}, rate {args.rate}/s)...")
+    start_t = time.time()
+    try:
+        engine.run(requests, on_result, collect=False)
+    finally:
+        writer.close()
+    elapsed = time.time() - start_t
+    stats = engine.stats
+    print(f"Labeled {stats['succeeded']}/{len(requests)} requests in {elapsed:.2f} s "
+          f"({stats['requests']} requests, {stats['retries']} retries, {stats['failed']} failed)")
+    print(f"Parsing: {stats['replies']} replies, {stats['repaired']} repaired locally, "
+          f"{stats['invalid']} invalid ({engine.parse_failure_rate():.1%} parse failure rate), "
+          f"{stats['repair_succeeded']}/{stats['repair_requests']} repair prompts succeeded")
+    report_transfer(sent)
+    if args.cascade:
+        report_agreement(llm_labels)
+    if cache is not None:
+        cache.evict()
+        print(cache.report())
+        cache.close()
+
+    # Compact the JSONL into the per-scene layout once the run has finished
+    num_samples = compact_jsonl(jsonl_path, output_path, scene_order=[s['token'] for s in scenes])
+    print(f"Saved {num_samples} labels to {output_path}")
 
 if __name__ == "__main__":
     main()
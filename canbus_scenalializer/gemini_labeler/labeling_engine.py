@@ -0,0 +1,350 @@
+import asyncio
+import random
+import time
+
+from transports import TransientError
+from image_preprocess import ImagePreprocessor
+from response_parser import parse_response, repair_prompt, ParseError
+
+class TokenBucket:
+    """
+    Asyncio token bucket: on average `rate` acquisitions per second, bursts up to `capacity`.
+
+    Args:
+        rate (float): Tokens added per second (<= 0 disables the limit).
+        capacity (float): Bucket size (maximum burst).
+    """
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+class LabelingEngine:
+    """
+    Labels samples through a transport (SdkTransport, CliTransport, StubTransport)
+    with bounded concurrency, a shared token-bucket rate limit and exponential
+    backoff on transient errors (429s, timeouts).
+
+    A request is a dict with at least 'sample_token' and 'images'
+    (list of (camera, path)); other fields are passed through to the result.
+    Images go through an ImagePreprocessor before the transport sees them.
+
+    Replies are parsed with response_parser.parse_response (schema validation,
+    normalization, local repair). Replies that still fail are put into a bounded
+    retry queue and, after the main pass, re-asked with a text-only repair
+    prompt; the images are not sent again.
+    """
+
+    def __init__(self, transport, concurrency=4, rate=1.0, burst=1, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 cache=None, preprocessor=None, prefetch=None, max_repairs=2, retry_queue_size=100):
+        """
+        Args:
+            transport: Object with `async generate(request, parts) -> str`.
+            concurrency (int): Maximum number of requests in flight.
+            rate (float): Maximum request rate (requests/s, retries included; <= 0 = unlimited).
+            burst (int): Token bucket capacity.
+            max_retries (int): Retries per request on TransientError.
+            base_delay (float): First backoff delay in seconds, doubled on every retry.
+            max_delay (float): Backoff cap in seconds.
+            cache (ResponseCache, optional): Parsed labels are looked up here before calling the transport.
+            preprocessor (ImagePreprocessor, optional): Image resizing/re-encoding/tiling (default: send files as is).
+            prefetch (int, optional): Requests prepared ahead of the workers (default: 2 * concurrency).
+            max_repairs (int): Repair prompts per invalid reply (0 disables the retry queue).
+            retry_queue_size (int): Maximum number of invalid replies waiting for a repair;
+                                    beyond that they fail right away.
+        """
+        self.transport = transport
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cache = cache
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        self.prefetch = prefetch or 2 * self.concurrency
+        self.max_repairs = max_repairs
+        self.retry_queue_size = retry_queue_size
+        self._retry_queue = None
+        self.stats = {
+            "requests": 0, "retries": 0, "succeeded": 0, "failed": 0, "bytes_sent": 0,
+            # Parsing: replies received, fixed locally, unparseable, repair prompts sent / successful
+            "replies": 0, "repaired": 0, "invalid": 0, "repair_requests": 0, "repair_succeeded": 0,
+        }
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """
+        Delay before retry number `attempt` (0-based): exponential with jitter, at least `retry_after`.
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def parse_failure_rate(self):
+        """
+        Fraction of replies (repair replies included) that could not be parsed into a valid label.
+        """
+        return self.stats["invalid"] / self.stats["replies"] if self.stats["replies"] else 0.0
+
+    async def lookup(self, request):
+        """
+        Cache key and cached label of a request.
+
+        Returns:
+            tuple: (key or None without a cache, label or None)
+        """
+        if self.cache is None:
+            return None, None
+        model, prompt = self.transport.cache_identity()
+        cameras = [camera for camera, _ in request['images']]
+        paths = [path for _, path in request['images']]
+        prompt = "\n".join([request.get('prompt', prompt), ",".join(cameras), self.preprocessor.signature()])
+        # Hashing the images reads them from disk, so keep it off the event loop
+        key = await asyncio.to_thread(self.cache.make_key, model, prompt, paths)
+        return key, self.cache.get(key)
+
+    async def call(self, request, parts, bucket):
+        """
+        One transport call with rate limiting and retries on transient errors.
+
+        Returns:
+            tuple: (text or None, error or None, attempts, seconds spent in the transport)
+        """
+        text, error = None, None
+        attempt = 0
+        latency = 0.0
+        bytes_sent = sum(len(part['data']) for part in parts)
+        while True:
+            await bucket.acquire()
+            self.stats["requests"] += 1
+            self.stats["bytes_sent"] += bytes_sent
+            start_t = time.monotonic()
+            try:
+                text = await self.transport.generate(request, parts)
+                error = None
+                break
+            except TransientError as e:
+                error = f"TransientError: {e}"
+                if attempt >= self.max_retries:
+                    break
+                self.stats["retries"] += 1
+                latency += time.monotonic() - start_t
+                await asyncio.sleep(self.backoff_delay(attempt, e.retry_after))
+                attempt += 1
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+        latency += time.monotonic() - start_t
+        return text, error, attempt + 1, latency
+
+    def parse(self, request, text):
+        """
+        Returns:
+            tuple: (label or None, error or None)
+        """
+        self.stats["replies"] += 1
+        num_frames = len(request['clip_tokens']) if 'clip_tokens' in request else None
+        try:
+            label, repaired = parse_response(text, num_frames)
+        except ParseError as e:
+            return None, f"Invalid response: {e}"
+        self.stats["repaired"] += repaired
+        return label, None
+
+    async def label(self, request, bucket, prepared=None, cached=None, index=None):
+        """
+        Label one request, retrying transient errors.
+
+        Args:
+            request (dict): Request to label.
+            bucket (TokenBucket): Shared rate limiter.
+            prepared (awaitable, optional): Pending ImagePreprocessor.prepare_async result
+                                            (started ahead of time by label_all).
+            cached (tuple, optional): Result of lookup() if already done.
+            index (int, optional): Position in label_all's request list.
+
+        Returns:
+            dict or None: request fields + 'text' (raw response), 'label' (parsed JSON or None),
+                  'error' (str or None), 'attempts' (0 for a cache hit), 'cached',
+                  'bytes_original'/'bytes_sent' (image bytes on disk / in the request)
+                  and 'latency' (seconds spent in the transport, all attempts).
+                  None if an invalid reply was put into the retry queue (label_all
+                  reports it once the repair is done).
+        """
+        cache_key, label = cached if cached is not None else await self.lookup(request)
+        if label is not None:
+            if prepared is not None:
+                prepared.cancel()
+            self.stats["succeeded"] += 1
+            return self._result(request, None, label, None, 0, True, 0, 0, 0.0)
+
+        try:
+            if prepared is None:
+                prepared = self.preprocessor.prepare_async(request['images'])
+            parts, bytes_original = await prepared
+        except Exception as e:
+            self.stats["failed"] += 1
+            return self._result(request, None, None, f"{type(e).__name__}: {e}", 0, False, 0, 0, 0.0)
+        bytes_sent = sum(len(part['data']) for part in parts)
+
+        text, error, attempts, latency = await self.call(request, parts, bucket)
+        label = None
+        if text:
+            label, error = self.parse(request, text)
+            if label is None:
+                self.stats["invalid"] += 1
+                if self._enqueue_repair({
+                    "index": index, "request": request, "cache_key": cache_key, "text": text, "error": error,
+                    "repairs": 0, "attempts": attempts, "bytes_original": bytes_original,
+                    "bytes_sent": bytes_sent, "latency": latency,
+                }):
+                    return None
+        return self._finish(request, cache_key, text, label, error, attempts, bytes_original, bytes_sent, latency)
+
+    def _enqueue_repair(self, item):
+        if self._retry_queue is None or item["repairs"] >= self.max_repairs:
+            return False
+        try:
+            self._retry_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def repair(self, item, bucket):
+        """
+        Send a text-only repair prompt for an invalid reply from the retry queue.
+
+        Returns:
+            dict or None: Final result, or None if the item went back into the queue.
+        """
+        request = item["request"]
+        num_frames = len(request['clip_tokens']) if 'clip_tokens' in request else None
+        repair_request = dict(request, prompt=repair_prompt(item["text"], item["error"], num_frames))
+        item["repairs"] += 1
+        self.stats["repair_requests"] += 1
+
+        text, error, attempts, latency = await self.call(repair_request, [], bucket)
+        item["attempts"] += attempts
+        item["latency"] += latency
+        label = None
+        if text:
+            label, error = self.parse(request, text)
+            item["text"] = text
+            if label is None:
+                self.stats["invalid"] += 1
+            else:
+                self.stats["repair_succeeded"] += 1
+        item["error"] = error
+        if label is None and text and self._enqueue_repair(item):
+            return None
+        return self._finish(request, item["cache_key"], item["text"], label, error, item["attempts"],
+                            item["bytes_original"], item["bytes_sent"], item["latency"])
+
+    def _finish(self, request, cache_key, text, label, error, attempts, bytes_original, bytes_sent, latency):
+        self.stats["succeeded" if label is not None else "failed"] += 1
+        if cache_key is not None and label is not None:
+            self.cache.put(cache_key, label, text, self.transport.cache_identity()[0])
+        return self._result(request, text, label, error, attempts, False, bytes_original, bytes_sent, latency)
+
+    def _result(self, request, text, label, error, attempts, cached, bytes_original, bytes_sent, latency):
+        result = dict(request)
+        result.update({
+            "text": text,
+            "label": label,
+            "error": error,
+            "attempts": attempts,
+            "cached": cached,
+            "bytes_original": bytes_original,
+            "bytes_sent": bytes_sent,
+            "latency": latency,
+        })
+        return result
+
+    async def label_all(self, requests, on_result=None, collect=True):
+        """
+        Label all requests with at most `concurrency` in flight.
+
+        A producer looks each request up in the cache and starts its image
+        preprocessing in the preprocessor's thread pool up to `prefetch` requests
+        ahead of the workers, so images are ready when a worker gets a token.
+        Invalid replies wait in the retry queue until the main pass is done.
+
+        Args:
+            requests (list of dict): Requests to label.
+            on_result (callable, optional): Called with (index, result) as soon as a request finishes.
+            collect (bool): Keep and return the results. Pass False when `on_result`
+                            persists them, so memory does not grow with the dataset.
+
+        Returns:
+            list of dict: Results in request order (None entries if collect is False).
+        """
+        bucket = TokenBucket(self.rate, self.burst)
+        results = [None] * len(requests)
+        num_workers = min(self.concurrency, len(requests))
+        queue = asyncio.Queue(maxsize=self.prefetch)
+        self._retry_queue = asyncio.Queue(maxsize=self.retry_queue_size) if self.max_repairs > 0 else None
+
+        def report(i, result):
+            if on_result is not None:
+                on_result(i, result)
+            if collect:
+                results[i] = result
+
+        async def producer():
+            for i, request in enumerate(requests):
+                cached = await self.lookup(request)
+                prepared = None
+                if cached[1] is None:
+                    prepared = asyncio.ensure_future(self.preprocessor.prepare_async(request['images']))
+                await queue.put((i, prepared, cached))
+            for _ in range(num_workers):
+                await queue.put(None)
+
+        async def worker():
+            # Fixed worker pool instead of one task per request keeps memory flat on trainval
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                i, prepared, cached = item
+                result = await self.label(requests[i], bucket, prepared, cached, index=i)
+                if result is not None:
+                    report(i, result)
+
+        async def repair_worker():
+            while self._retry_queue is not None and not self._retry_queue.empty():
+                item = self._retry_queue.get_nowait()
+                result = await self.repair(item, bucket)
+                if result is not None:
+                    report(item["index"], result)
+
+        try:
+            await asyncio.gather(producer(), *(worker() for _ in range(num_workers)))
+            await asyncio.gather(*(repair_worker() for _ in range(num_workers)))
+        finally:
+            self._retry_queue = None
+        return results
+
+    def run(self, requests, on_result=None, collect=True):
+        """
+        Synchronous wrapper around label_all.
+        """
+        return asyncio.run(self.label_all(requests, on_result, collect))
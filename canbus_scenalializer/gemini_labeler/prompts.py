@@ -1,5 +1,17 @@
 # Scenario definitions based on scenario_definition.md
 
+# Class IDs used in the prompt (see the table below)
+CLASS_NAMES = {
+    1: "Left Turn",
+    2: "Right Turn",
+    3: "Lane Change",
+    4: "Pull Over",
+    5: "Reverse",
+    6: "Stop",
+    7: "Deceleration",
+    8: "Cruising",
+}
+
 SCENARIO_DEFINITIONS = """
 ## 1. Classification Policy
 
@@ -41,3 +53,30 @@ Example Output:
   "reasoning": "The vehicle is stationary behind another car at a red traffic light."
 }}
 """
+
+# Clip mode (clip_mode.py): {num_frames} consecutive keyframes in one request
+CLIP_PROMPT = """
+You are an expert autonomous driving data analyst.
+Your task is to classify the behavior of the ego vehicle (the car capturing the images) in each frame of a short clip.
+You will be given {num_frames} consecutive front camera keyframes (about 0.5 s apart, oldest first) and the CAN bus state of each frame.
+Use the motion across the frames: turns, lane changes and deceleration are only visible over time.
+
+{definitions}
+
+CAN bus state per frame (speed in m/s, steering angle in rad with positive = left, yaw rate in rad/s):
+{can_summary}
+
+Output the result in JSON format with a single key "frames": a list of exactly {num_frames} objects, one per frame in order, each with the following keys:
+- "frame": The frame number (1-{num_frames}).
+- "class_id": The ID of the scenario (1-8).
+- "class_name": The name of the scenario.
+- "reasoning": A brief explanation based on visual cues and the CAN state.
+
+Example Output:
+{{
+  "frames": [
+    {{"frame": 1, "class_id": 8, "class_name": "Cruising", "reasoning": "Driving straight in the lane at steady speed."}},
+    {{"frame": 2, "class_id": 7, "class_name": "Deceleration", "reasoning": "Speed drops while approaching a queue of cars."}}
+  ]
+}}
+"""
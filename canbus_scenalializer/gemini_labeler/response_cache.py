@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CACHE_FILENAME = 'gemini_cache.sqlite'
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of parsed Gemini labels (SQLite).
+
+    The key is a hash of the model, the prompt and the digests of the image
+    files (see make_key), so a label is reused whenever the same images are sent
+    with the same prompt to the same model, regardless of paths, runs or --limit.
+    Changing the prompt changes every key; changing one image only its sample's.
+
+    Eviction (evict) drops entries older than `max_age_days`, then the least
+    recently used entries until the stored size is below `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=None, max_age_days=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evicted": 0}
+        self._digests = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT,"
+            " label TEXT NOT NULL,"
+            " text TEXT,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.conn.commit()
+
+    def file_digest(self, path):
+        """
+        SHA-256 of a file, memoized per (path, size, mtime) for the lifetime of the cache object.
+        """
+        st = os.stat(path)
+        memo_key = (path, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self._digests[memo_key] = digest
+        return digest
+
+    def make_key(self, model, prompt, image_paths):
+        """
+        Cache key: SHA-256 over the model, the prompt and the image digests (in order).
+        """
+        h = hashlib.sha256()
+        for part in [model or '', prompt or ''] + [self.file_digest(p) for p in image_paths]:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Stored parsed label for a key, or None (counted as hit/miss).
+        """
+        row = self.conn.execute("SELECT label FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, label, text=None, model=None):
+        """
+        Store a parsed label (and the raw response text) under a key.
+        """
+        label_json = json.dumps(label)
+        size = len(label_json) + len(text or '')
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, label, text, size, created_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, model, label_json, text, size, now, now),
+        )
+        self.conn.commit()
+        self.stats["stores"] += 1
+
+    def total_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def evict(self):
+        """
+        Apply the age and size limits.
+
+        Returns:
+            int: Number of evicted entries.
+        """
+        evicted = 0
+        if self.max_age_days:
+            cutoff = time.time() - self.max_age_days * 86400
+            evicted += self.conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+        if self.max_bytes:
+            excess = self.total_bytes() - self.max_bytes
+            if excess > 0:
+                # Least recently used first
+                keys = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    if excess <= 0:
+                        break
+                    keys.append((key,))
+                    excess -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+                evicted += len(keys)
+        self.conn.commit()
+        self.stats["evicted"] += evicted
+        return evicted
+
+    def report(self):
+        """
+        One-line summary of the hit/miss stats.
+        """
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0.0
+        return (f"Cache {self.path}: {self.stats['hits']} hits, {self.stats['misses']} misses "
+                f"({hit_rate:.1%} hit rate), {self.stats['stores']} stored, {self.stats['evicted']} evicted, "
+                f"{len(self)} entries / {self.total_bytes() / 1e6:.2f} MB")
+
+    def close(self):
+        self.conn.close()
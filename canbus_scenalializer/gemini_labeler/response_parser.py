@@ -0,0 +1,224 @@
+import ast
+import json
+import re
+
+from prompts import CLASS_NAMES
+
+# Normalized class name -> class ID, plus common variants seen in replies
+CLASS_IDS = {name.lower(): class_id for class_id, name in CLASS_NAMES.items()}
+CLASS_ALIASES = {
+    "turn left": 1, "left": 1, "left turning": 1,
+    "turn right": 2, "right": 2, "right turning": 2,
+    "lane changing": 3, "changing lanes": 3, "change lane": 3,
+    "pulling over": 4, "pullover": 4, "pull-over": 4,
+    "reversing": 5, "backing up": 5,
+    "stopped": 6, "stopping": 6, "stationary": 6, "standstill": 6,
+    "decelerating": 7, "braking": 7, "slowing down": 7,
+    "cruise": 8, "driving straight": 8, "go straight": 8, "straight": 8,
+}
+
+REPAIR_PROMPT = """
+Your previous reply could not be used: {error}.
+
+Previous reply:
+{reply}
+
+Rewrite it as valid JSON that follows the requested format exactly. {schema}
+Use only these classes (class_id: class_name): {classes}.
+Output only the JSON.
+"""
+SAMPLE_SCHEMA = 'The JSON object must have the keys "class_id", "class_name" and "reasoning".'
+CLIP_SCHEMA = 'The JSON object must have a single key "frames": a list of exactly {num_frames} objects, each with the keys "frame", "class_id", "class_name" and "reasoning".'
+
+class ParseError(ValueError):
+    """
+    A reply that cannot be turned into a valid label.
+    """
+
+def parse_response(text, num_frames=None):
+    """
+    Parse a Gemini reply into a label that follows the prompt schema.
+
+    The JSON is taken from a ```json fence, any fence, or the first balanced
+    {...}/[...] in the text. Syntax slips (trailing commas, single quotes,
+    Python literals, comments) are repaired, and labels are normalized
+    (see normalize_label).
+
+    Args:
+        text (str): Raw reply.
+        num_frames (int, optional): Clip mode: expect {"frames": [...]} with this many entries.
+
+    Returns:
+        tuple: (label, repaired). repaired is True if anything had to be fixed.
+
+    Raises:
+        ParseError: If no valid label can be recovered.
+    """
+    data, repaired = extract_json_value(text)
+    if num_frames is None:
+        if isinstance(data, list) and len(data) == 1:
+            data, repaired = data[0], True
+        label, fixed = normalize_label(data)
+        return label, repaired or fixed
+
+    frames = data
+    if isinstance(data, dict):
+        frames = data.get('frames')
+    else:
+        repaired = True
+    if not isinstance(frames, list):
+        raise ParseError("missing 'frames' list")
+    if len(frames) != num_frames:
+        raise ParseError(f"expected {num_frames} frames, got {len(frames)}")
+
+    labels = []
+    for k, frame in enumerate(frames, start=1):
+        try:
+            label, fixed = normalize_label(frame)
+        except ParseError as e:
+            raise ParseError(f"frame {k}: {e}")
+        if frame.get('frame', k) != k:
+            fixed = True
+        label['frame'] = k
+        labels.append(label)
+        repaired = repaired or fixed
+    return {"frames": labels}, repaired
+
+def normalize_label(data):
+    """
+    Enforce the class_id / class_name / reasoning schema on one label.
+
+    class_id may be a number or numeric string; class_name is matched
+    case-insensitively (with aliases). If they disagree, the name wins; if one is
+    missing it is filled in from the other.
+
+    Returns:
+        tuple: (label dict, repaired)
+
+    Raises:
+        ParseError: If neither field identifies one of the 8 classes.
+    """
+    if not isinstance(data, dict):
+        raise ParseError(f"expected an object, got {type(data).__name__}")
+
+    repaired = False
+    id_from_id = _parse_class_id(data.get('class_id'))
+    id_from_name = _parse_class_name(data.get('class_name'))
+    if id_from_name is not None:
+        class_id = id_from_name
+        if data.get('class_name') != CLASS_NAMES[class_id] or id_from_id != class_id:
+            repaired = True
+    elif id_from_id is not None:
+        class_id = id_from_id
+        repaired = True
+    else:
+        raise ParseError(f"unknown class (class_id={data.get('class_id')!r}, class_name={data.get('class_name')!r})")
+
+    reasoning = data.get('reasoning')
+    if not isinstance(reasoning, str):
+        reasoning = "" if reasoning is None else str(reasoning)
+        repaired = True
+    if data.get('class_id') != class_id:
+        repaired = True
+
+    return {"class_id": class_id, "class_name": CLASS_NAMES[class_id], "reasoning": reasoning}, repaired
+
+def _parse_class_id(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value.strip())
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return value if isinstance(value, int) and value in CLASS_NAMES else None
+
+def _parse_class_name(value):
+    if not isinstance(value, str):
+        return None
+    key = re.sub(r"[\s_]+", " ", value.strip().lower())
+    if key in CLASS_IDS:
+        return CLASS_IDS[key]
+    return CLASS_ALIASES.get(key)
+
+def extract_json_value(text):
+    """
+    Find and decode the JSON value in a reply.
+
+    Returns:
+        tuple: (decoded value, repaired: True if the JSON syntax had to be fixed)
+
+    Raises:
+        ParseError: If no JSON value can be decoded.
+    """
+    if not text or not text.strip():
+        raise ParseError("empty reply")
+
+    candidates = []
+    fenced = re.findall(r"```(?:json|JSON)?\s*(.*?)```", text, flags=re.DOTALL)
+    candidates += [c.strip() for c in fenced]
+    balanced = _first_balanced(text)
+    if balanced is not None:
+        candidates.append(balanced)
+    candidates.append(text.strip())
+
+    for candidate in candidates:
+        try:
+            return json.loads(candidate), False
+        except json.JSONDecodeError:
+            pass
+    for candidate in candidates:
+        value = _repair_json(candidate)
+        if value is not None:
+            return value, True
+    raise ParseError("no valid JSON in reply")
+
+def _first_balanced(text):
+    # First balanced {...} or [...] outside of strings
+    start = None
+    stack = []
+    in_string = False
+    escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"' and start is not None:
+            in_string = True
+        elif ch in "{[":
+            if start is None:
+                start = i
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            if ch != stack.pop():
+                return None
+            if not stack:
+                return text[start:i + 1]
+    return None
+
+def _repair_json(candidate):
+    # Comments and trailing commas
+    fixed = re.sub(r"//[^\n]*", "", candidate)
+    fixed = re.sub(r",\s*([}\]])", r"\1", fixed)
+    try:
+        return json.loads(fixed)
+    except json.JSONDecodeError:
+        pass
+    # Python-style dicts: single quotes, True/False/None
+    try:
+        value = ast.literal_eval(fixed)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return value if isinstance(value, (dict, list)) else None
+
+def repair_prompt(reply, error, num_frames=None):
+    """
+    Text-only follow-up asking the model to reformat an unusable reply (no images are resent).
+    """
+    schema = SAMPLE_SCHEMA if num_frames is None else CLIP_SCHEMA.format(num_frames=num_frames)
+    classes = ", ".join(f"{class_id}: {name}" for class_id, name in CLASS_NAMES.items())
+    return REPAIR_PROMPT.format(error=error, reply=(reply or "")[:4000], schema=schema, classes=classes)
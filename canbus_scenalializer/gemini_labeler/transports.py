@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from prompts import SYSTEM_PROMPT, CLASS_NAMES
+
+# Default prompt of the CLI backend (the CLI picks up the class definitions from GEMINI.md)
+DEFAULT_CLI_PROMPT = "Describe this image and classify it according to the definitions. Output JSON."
+
+class TransientError(Exception):
+    """
+    A failure worth retrying (rate limit, timeout, temporarily unavailable).
+
+    Args:
+        message (str): Error message.
+        retry_after (float, optional): Server-suggested delay in seconds.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class SdkTransport:
+    """
+    google-generativeai backend: SYSTEM_PROMPT + titled JPEG parts in one request.
+    """
+
+    name = 'sdk'
+
+    def __init__(self, model_name="gemini-1.5-flash", api_key=None, timeout=60.0):
+        from utils import setup_gemini
+        from google.api_core import exceptions as api_exceptions
+
+        self.model_name = model_name
+        self.model = setup_gemini(api_key=api_key, model_name=model_name)
+        self.timeout = timeout
+        self._transient = (
+            api_exceptions.ResourceExhausted,  # 429
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.InternalServerError,
+        )
+
+    def cache_identity(self):
+        """
+        (model, prompt) part of the response cache key.
+        """
+        return self.model_name, SYSTEM_PROMPT
+
+    async def generate(self, request, parts):
+        content = [request.get('prompt', SYSTEM_PROMPT)]
+        for part in parts:
+            content += [f"{part['title']}:", {"mime_type": part['mime_type'], "data": part['data']}]
+
+        try:
+            response = await asyncio.wait_for(self.model.generate_content_async(content), self.timeout)
+        except asyncio.TimeoutError:
+            raise TransientError(f"Timed out after {self.timeout} s")
+        except self._transient as e:
+            raise TransientError(str(e))
+        return response.text
+
+class CliTransport:
+    """
+    `gemini` CLI backend: one subprocess per request, image paths as arguments
+    (preprocessed images are written to temporary files).
+
+    The command is run without a shell, in the current directory so that the CLI
+    picks up GEMINI.md.
+    """
+
+    name = 'cli'
+
+    def __init__(self, model="gemini-2.5-flash", prompt=DEFAULT_CLI_PROMPT, timeout=60.0, executable="gemini"):
+        self.model = model
+        self.prompt = prompt
+        self.timeout = timeout
+        # Resolve e.g. gemini.cmd on Windows, which previously needed shell=True
+        self.executable = shutil.which(executable) or executable
+
+    def cache_identity(self):
+        # GEMINI.md is part of the effective prompt of the CLI
+        prompt = self.prompt
+        if os.path.exists("GEMINI.md"):
+            with open("GEMINI.md", 'r', encoding='utf-8') as f:
+                prompt += "\n" + f.read()
+        return self.model, prompt
+
+    async def generate(self, request, parts):
+        prompt = request.get('prompt', self.prompt)
+        paths, temp_paths = [], []
+        for part in parts:
+            if part['path'] is not None:
+                paths.append(part['path'])
+                continue
+            # Preprocessed image: the CLI only takes files
+            fd, path = tempfile.mkstemp(suffix='.jpg', prefix='gemini_')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(part['data'])
+            paths.append(path)
+            temp_paths.append(path)
+        if temp_paths:
+            prompt += " Images: " + "; ".join(part['title'] for part in parts) + "."
+
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                self.executable, "-m", self.model, prompt, *paths,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise TransientError(f"Gemini CLI timed out after {self.timeout} s")
+        finally:
+            for path in temp_paths:
+                os.remove(path)
+
+        stderr = stderr.decode('utf-8', errors='replace')
+        if proc.returncode != 0:
+            if "429" in stderr or "RESOURCE_EXHAUSTED" in stderr or "rate limit" in stderr.lower():
+                raise TransientError(f"Gemini CLI rate limited: {stderr.strip()[:200]}")
+            raise RuntimeError(f"Gemini CLI exited with {proc.returncode}: {stderr.strip()[:200]}")
+        return stdout.decode('utf-8', errors='replace')
+
+class StubTransport:
+    """
+    Local backend for testing: no network, deterministic labels.
+
+    The label is derived from a hash of the sample token, so repeated runs give
+    the same output (clip requests get one label per frame). Latency, transient
+    failures (as 429s) and malformed replies can be simulated.
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency=0.05, failure_rate=0.0, invalid_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.invalid_rate = invalid_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def cache_identity(self):
+        return 'stub', ''
+
+    async def generate(self, request, parts):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.rng.random() < self.failure_rate:
+            raise TransientError("Stub: simulated 429 Too Many Requests")
+        # Malformed reply (repair prompts are sent without images and always get a valid one)
+        if parts and self.rng.random() < self.invalid_rate:
+            return "The ego vehicle seems to be waiting at the light."
+
+        if 'clip_tokens' in request:
+            frames = [dict(stub_label(token), frame=k) for k, token in enumerate(request['clip_tokens'], start=1)]
+            return f"```json\n{json.dumps({'frames': frames})}\n```"
+        return f"```json\n{json.dumps(stub_label(request['sample_token']))}\n```"
+
+def stub_label(sample_token):
+    digest = hashlib.sha1(sample_token.encode('utf-8')).digest()
+    class_id = digest[0] % len(CLASS_NAMES) + 1
+    return {
+        "class_id": class_id,
+        "class_name": CLASS_NAMES[class_id],
+        "reasoning": "Stub label (no model was called).",
+    }
+
+def make_transport(backend, model=None, prompt=None, timeout=60.0, **kwargs):
+    """
+    Create a transport by backend name ('sdk', 'cli' or 'stub').
+    """
+    if backend == 'sdk':
+        return SdkTransport(model_name=model or "gemini-1.5-flash", timeout=timeout)
+    if backend == 'cli':
+        return CliTransport(model=model or "gemini-2.5-flash", prompt=prompt or DEFAULT_CLI_PROMPT, timeout=timeout)
+    if backend == 'stub':
+        return StubTransport(**kwargs)
+    raise ValueError(f"Unknown backend: {backend}")
@@ -1,5 +1,4 @@
 import os
-import google.generativeai as genai
 from PIL import Image
 from dotenv import load_dotenv
 
@@ -9,6 +8,8 @@ def setup_gemini(api_key=None, model_name="gemini-1.5-flash"):
     """
     Configures the Gemini API.
     """
+    import google.generativeai as genai
+
     if not api_key:
         api_key = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
     
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Add current directory to sys.path to allow importing local modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+INDEX_VERSION = 1
+INDEX_DIRNAME = 'annotation_index'
+
+# Category groups of the strategy doc: category name prefixes summed into one count
+CATEGORY_GROUPS = {
+    'pedestrian': ('human.pedestrian.',),
+    'car': ('vehicle.car',),
+    'two_wheeler': ('vehicle.bicycle', 'vehicle.motorcycle'),
+    'large_vehicle': ('vehicle.bus.', 'vehicle.truck', 'vehicle.construction', 'vehicle.trailer', 'vehicle.emergency.'),
+}
+
+# Attribute ratios: name -> (numerator attributes, denominator attributes)
+ATTRIBUTE_RATIOS = {
+    'vehicle_moving_ratio': (('vehicle.moving',), ('vehicle.moving', 'vehicle.stopped', 'vehicle.parked')),
+    'vehicle_parked_ratio': (('vehicle.parked',), ('vehicle.moving', 'vehicle.stopped', 'vehicle.parked')),
+    'pedestrian_moving_ratio': (('pedestrian.moving',),
+                                ('pedestrian.moving', 'pedestrian.standing', 'pedestrian.sitting_lying_down')),
+}
+
+class AnnotationIndex:
+    """
+    Per-keyframe annotation counts of a NuScenes version.
+
+    Layout (written by build_annotation_index), <index_dir>/<version>.npz:
+
+        sample_tokens       (S,)    sorted sample tokens
+        category_names      (C,)    category.json names
+        attribute_names     (A,)    attribute.json names
+        category_counts     (S, C)  annotations per sample and category
+        attribute_counts    (S, A)  annotations per sample and attribute
+
+    Lookups are np.searchsorted on the sorted tokens, so counts of any set of
+    samples are one fancy-indexing operation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError(f"Unsupported annotation index version {int(data['version'])} in {path}")
+            self.sample_tokens = data['sample_tokens']
+            self.category_names = [str(name) for name in data['category_names']]
+            self.attribute_names = [str(name) for name in data['attribute_names']]
+            self.category_counts = data['category_counts']
+            self.attribute_counts = data['attribute_counts']
+
+    @classmethod
+    def open(cls, dataroot, version, index_dir=None):
+        """
+        Open the index of a dataroot/version, or return None if it has not been built.
+        """
+        path = index_path(dataroot, version, index_dir)
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def rows(self, sample_tokens):
+        """
+        Row of each sample token, -1 for tokens not in the index.
+        """
+        tokens = np.asarray(sample_tokens, dtype=self.sample_tokens.dtype)
+        rows = np.searchsorted(self.sample_tokens, tokens)
+        rows = np.minimum(rows, len(self.sample_tokens) - 1)
+        found = self.sample_tokens[rows] == tokens
+        return np.where(found, rows, -1)
+
+    def group_counts(self, rows=None):
+        """
+        Counts of the CATEGORY_GROUPS for the given rows (all samples by default).
+
+        Returns:
+            dict: group -> int array, one value per row.
+        """
+        counts = self.category_counts if rows is None else self.category_counts[rows]
+        return {group: counts[:, columns].sum(axis=1) for group, columns in self._group_columns().items()}
+
+    def sample_counts(self, sample_tokens):
+        """
+        Category group and attribute counts of a list of samples (zeros for unknown tokens).
+
+        Returns:
+            dict: group or attribute name -> int array, one value per token.
+        """
+        rows = self.rows(sample_tokens)
+        known = rows >= 0
+        result = {}
+        for group, values in self.group_counts(np.maximum(rows, 0)).items():
+            result[group] = np.where(known, values, 0)
+        for i, name in enumerate(self.attribute_names):
+            result[name] = np.where(known, self.attribute_counts[np.maximum(rows, 0), i], 0)
+        return result
+
+    def aggregate(self, sample_tokens_per_clip):
+        """
+        Annotation features per clip, as a grouped sum over the keyframes of each clip.
+
+        Args:
+            sample_tokens_per_clip (list of list of str): Keyframe tokens of each clip
+                                                         (the `sample_tokens` column of the clip table).
+
+        Returns:
+            dict: Column name -> array, one value per clip:
+                  ann_<group>_sum (annotations summed over the keyframes), ann_<group>_max
+                  (peak per keyframe) and the ATTRIBUTE_RATIOS (NaN without any denominator annotation).
+        """
+        lengths = np.array([len(tokens) for tokens in sample_tokens_per_clip], dtype=np.int64)
+        flat = [token for tokens in sample_tokens_per_clip for token in tokens]
+        rows = self.rows(flat) if flat else np.zeros(0, dtype=np.int64)
+        known = rows >= 0
+
+        # One matrix of per-keyframe features: group counts, then attribute counts
+        groups = list(CATEGORY_GROUPS)
+        group_columns = self._group_columns()
+        category_counts = self.category_counts[np.maximum(rows, 0)] * known[:, None]
+        features = np.empty((len(rows), len(groups) + len(self.attribute_names)), dtype=np.int64)
+        for i, group in enumerate(groups):
+            features[:, i] = category_counts[:, group_columns[group]].sum(axis=1)
+        features[:, len(groups):] = self.attribute_counts[np.maximum(rows, 0)] * known[:, None]
+
+        # Grouped sum/max: clips are contiguous runs of the flattened keyframes
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) else lengths
+        nonempty = lengths > 0
+        sums = np.zeros((len(lengths), features.shape[1]), dtype=np.int64)
+        maxima = np.zeros((len(lengths), features.shape[1]), dtype=np.int64)
+        if len(rows):
+            sums[nonempty] = np.add.reduceat(features, offsets[nonempty], axis=0)
+            maxima[nonempty] = np.maximum.reduceat(features, offsets[nonempty], axis=0)
+
+        columns = {}
+        for i, group in enumerate(groups):
+            columns[f"ann_{group}_sum"] = sums[:, i]
+            columns[f"ann_{group}_max"] = maxima[:, i]
+        attribute_sums = {name: sums[:, len(groups) + i] for i, name in enumerate(self.attribute_names)}
+        for ratio, (numerator, denominator) in ATTRIBUTE_RATIOS.items():
+            num = sum(attribute_sums.get(name, 0) for name in numerator)
+            den = sum(attribute_sums.get(name, 0) for name in denominator)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                columns[ratio] = np.where(den > 0, num / np.maximum(den, 1), np.nan)
+        return columns
+
+    def _group_columns(self):
+        return {
+            group: [i for i, name in enumerate(self.category_names) if name.startswith(prefixes)]
+            for group, prefixes in CATEGORY_GROUPS.items()
+        }
+
+def index_path(dataroot, version, index_dir=None):
+    return os.path.join(index_dir or os.path.join(dataroot, INDEX_DIRNAME), f"{version}.npz")
+
+def build_annotation_index(dataroot, version, index_dir=None):
+    """
+    One-time conversion of sample_annotation.json into per-sample count arrays.
+
+    The raw tables are parsed once; tokens are mapped to integer ids with dicts
+    and the counts are accumulated with np.bincount over (sample, category) and
+    (sample, attribute) codes, never through nusc.get.
+
+    Args:
+        dataroot (str): NuScenes data root.
+        version (str): NuScenes version (e.g. v1.0-mini, v1.0-trainval).
+        index_dir (str, optional): Output directory (default: <dataroot>/annotation_index).
+
+    Returns:
+        str: Path of the index file.
+    """
+    table_dir = os.path.join(dataroot, version)
+
+    def load_table(name):
+        with open(os.path.join(table_dir, f"{name}.json"), 'r') as f:
+            return json.load(f)
+
+    categories = load_table('category')
+    attributes = load_table('attribute')
+    category_ids = {c['token']: i for i, c in enumerate(categories)}
+    attribute_ids = {a['token']: i for i, a in enumerate(attributes)}
+    instance_category = {inst['token']: category_ids[inst['category_token']] for inst in load_table('instance')}
+
+    sample_tokens = np.array(sorted(s['token'] for s in load_table('sample')))
+    sample_ids = {token: i for i, token in enumerate(sample_tokens)}
+
+    annotations = load_table('sample_annotation')
+    ann_sample = np.fromiter((sample_ids[a['sample_token']] for a in annotations), dtype=np.int64, count=len(annotations))
+    ann_category = np.fromiter((instance_category[a['instance_token']] for a in annotations), dtype=np.int64, count=len(annotations))
+    attr_sample = np.fromiter((sample_ids[a['sample_token']] for a in annotations for _ in a['attribute_tokens']), dtype=np.int64)
+    attr_id = np.fromiter((attribute_ids[t] for a in annotations for t in a['attribute_tokens']), dtype=np.int64)
+    del annotations
+
+    num_samples, num_categories, num_attributes = len(sample_tokens), len(categories), len(attributes)
+    category_counts = np.bincount(ann_sample * num_categories + ann_category,
+                                  minlength=num_samples * num_categories).reshape(num_samples, num_categories)
+    attribute_counts = np.bincount(attr_sample * num_attributes + attr_id,
+                                   minlength=num_samples * num_attributes).reshape(num_samples, num_attributes)
+
+    path = index_path(dataroot, version, index_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temp file first so a partially written index is never picked up
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path,
+             version=INDEX_VERSION,
+             sample_tokens=sample_tokens,
+             category_names=np.array([c['name'] for c in categories]),
+             attribute_names=np.array([a['name'] for a in attributes]),
+             category_counts=category_counts.astype(np.int32),
+             attribute_counts=attribute_counts.astype(np.int32))
+    os.replace(tmp_path, path)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the per-sample annotation count index of a NuScenes version.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--version', type=str, default='v1.0-mini', help='NuScenes version (e.g., v1.0-mini, v1.0-trainval)')
+    parser.add_argument('--index_dir', type=str, default=None, help='Output directory (default: <dataroot>/annotation_index)')
+    args = parser.parse_args()
+
+    start_t = time.time()
+    path = build_annotation_index(args.dataroot, args.version, args.index_dir)
+    index = AnnotationIndex(path)
+    print(f"Annotation index written to {path} in {time.time() - start_t:.2f} seconds")
+    print(f"  {len(index.sample_tokens)} samples, {int(index.category_counts.sum())} annotations, "
+          f"{len(index.category_names)} categories, {len(index.attribute_names)} attributes")
+    for group, counts in index.group_counts().items():
+        print(f"  {group}: {int(counts.sum())} annotations")
+
+if __name__ == "__main__":
+    main()
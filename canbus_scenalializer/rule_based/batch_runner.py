@@ -0,0 +1,98 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Per-process state (classifier, CAN bus API, ...) set up once by the worker initializer
+worker_state = {}
+
+def run_scenes(tasks, process_fn, initializer, initargs=(), workers=1):
+    """
+    Run `process_fn` over independent scene tasks, optionally in a process pool.
+
+    `initializer(*initargs)` runs once per worker (once in-process when workers <= 1),
+    so heavy objects such as RuleBasedClassifier are loaded once per worker and not
+    once per scene. Results are returned in task order regardless of which worker
+    finished first, so downstream merging is deterministic.
+
+    Args:
+        tasks (list): One picklable task per scene.
+        process_fn (callable): Top-level function task -> result dict.
+        initializer (callable): Top-level function that fills `worker_state`.
+        initargs (tuple): Arguments for the initializer.
+        workers (int): Number of worker processes.
+
+    Returns:
+        tuple: (list of results in task order, wall-clock seconds)
+    """
+    start_t = time.time()
+    if workers <= 1:
+        initializer(*initargs)
+        results = [process_fn(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            # chunksize=1 hands out scenes one at a time so long scenes don't stall a shard
+            results = list(executor.map(process_fn, tasks, chunksize=1))
+    return results, time.time() - start_t
+
+def timed_result(scene_name, num_frames, start_t, **extra):
+    """
+    Result record of one scene, tagged with the worker that produced it.
+    """
+    result = {
+        "scene_name": scene_name,
+        "num_frames": num_frames,
+        "elapsed": time.time() - start_t,
+        "worker": os.getpid(),
+    }
+    result.update(extra)
+    return result
+
+def report_worker_throughput(results, wall_time):
+    """
+    Print per-worker throughput (scenes, frames, busy time, frames/s) and the overall rate.
+    """
+    per_worker = OrderedDict()
+    for r in results:
+        stats = per_worker.setdefault(r["worker"], {"scenes": 0, "frames": 0, "busy": 0.0})
+        stats["scenes"] += 1
+        stats["frames"] += r["num_frames"]
+        stats["busy"] += r["elapsed"]
+
+    print("\nPer-worker throughput:")
+    for i, (pid, stats) in enumerate(per_worker.items()):
+        fps = stats["frames"] / stats["busy"] if stats["busy"] > 0 else 0.0
+        print(f"  Worker {i} (pid {pid}): {stats['scenes']} scenes, {stats['frames']} frames, "
+              f"{stats['busy']:.2f} s busy, {fps:.2f} frames/s")
+
+    total_frames = sum(stats["frames"] for stats in per_worker.values())
+    total_busy = sum(stats["busy"] for stats in per_worker.values())
+    if wall_time > 0:
+        print(f"  Overall: {total_frames} frames in {wall_time:.2f} s wall-clock "
+              f"({total_frames / wall_time:.2f} frames/s, effective parallelism {total_busy / wall_time:.2f}x)")
+    return per_worker
+
+def merge_scene_results(base_output_dir, scene_names, filename='classification_results.json'):
+    """
+    Merge the per-scene result files written by the workers into one file.
+
+    Scenes are merged in the order of `scene_names` (the input scene order), so the
+    merged file does not depend on worker scheduling. Scenes without a result file
+    are skipped.
+
+    Returns:
+        str: Path of the merged file (<base_output_dir>/<filename>).
+    """
+    merged = []
+    for scene_name in scene_names:
+        path = os.path.join(base_output_dir, scene_name, filename)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            merged.append(json.load(f))
+
+    merged_path = os.path.join(base_output_dir, filename)
+    with open(merged_path, 'w') as f:
+        json.dump(merged, f, indent=2)
+    return merged_path
@@ -1,10 +1,20 @@
 import sys
 import os
 import time
+import argparse
 import numpy as np
 import glob
 from nuscenes.can_bus.can_bus_api import NuScenesCanBus
+
+# Add current directory to sys.path to allow importing local modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
 from classifier import RuleBasedClassifier
+from can_index import load_can_index
+from can_cache import CanBusCache
+from batch_runner import run_scenes, worker_state, timed_result, report_worker_throughput
 
 def load_all_can_data(dataroot):
     print(f"Scanning CAN bus data from {dataroot}...")
@@ -23,12 +33,74 @@ def load_all_can_data(dataroot):
     print(f"Found {len(scene_names)} scenes.")
     return scene_names
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the rule-based classifier on NuScenes CAN bus data.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (scenes are processed in parallel)')
+    return parser.parse_args()
+
+def init_worker(dataroot, config_path):
+    """
+    Load the classifier and CAN bus sources once per worker process.
+    """
+    worker_state['classifier'] = RuleBasedClassifier(config_path)
+    worker_state['nusc_can'] = NuScenesCanBus(dataroot=dataroot)
+    # Binary CAN cache (built by can_cache.py), falls back to the JSON files when absent
+    worker_state['can_cache'] = CanBusCache.open(dataroot)
+
+def benchmark_scene(scene_name):
+    """
+    Build the frames of one scene and time both classification paths on them.
+    """
+    start = time.time()
+    classifier = worker_state['classifier']
+    try:
+        # We need to construct "frames" from CAN messages.
+        # Let's assume 1 frame per pose message (pose is usually 50Hz) and use the
+        # latest steering/signal value at each pose timestamp.
+        # Building the states is "Data IO"; only the classification below is timed.
+        load_start = time.time()
+        can_index = load_can_index(worker_state['nusc_can'], scene_name, can_cache=worker_state['can_cache'])
+        pose_times = can_index.columns['pose']['utime']
+        speed = np.asarray(can_index.columns['pose']['speed'])
+        yaw_rate = np.asarray(can_index.columns['pose']['yaw_rate'])
+        steering = can_index.latest('steeranglefeedback', 'value', pose_times)
+        turn_signal = can_index.latest('vehicle_monitor', 'turn_signal', pose_times)
+        
+        scene_states = [
+            {
+                'speed': v,
+                'yaw_rate': w,
+                'steering_angle': st,
+                'turn_signal': int(sig)
+            }
+            for v, w, st, sig in zip(speed.tolist(), yaw_rate.tolist(), steering.tolist(), turn_signal.tolist())
+        ]
+        load_time = time.time() - load_start
+        
+        # Now benchmark the classification
+        start_t = time.time()
+        for state in scene_states:
+            _ = classifier._classify_frame(state)
+        frame_time = time.time() - start_t
+        
+        # Same states as contiguous columns for the vectorized path
+        start_t = time.time()
+        _ = classifier.classify_arrays(speed, steering, yaw_rate, turn_signal)
+        array_time = time.time() - start_t
+        
+    except Exception as e:
+        # print(f"Error in {scene_name}: {e}")
+        return timed_result(scene_name, 0, start, load_time=0.0, frame_time=0.0, array_time=0.0)
+
+    return timed_result(scene_name, len(scene_states), start, load_time=load_time, frame_time=frame_time, array_time=array_time)
+
 def main():
-    dataroot = 'c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes'
+    args = parse_args()
+    dataroot = args.dataroot
     
-    # Initialize Classifier
-    config_path = 'config.yaml'
-    classifier = RuleBasedClassifier(config_path)
+    # Classifier is loaded once per worker
+    config_path = os.path.join(current_dir, 'config.yaml')
     
     # Get all scenes
     scene_names = load_all_can_data(dataroot)
@@ -36,109 +108,30 @@ def main():
         print("No scenes found.")
         return
 
-    nusc_can = NuScenesCanBus(dataroot=dataroot)
-    
-    total_frames = 0
-    total_time = 0
+    print(f"CAN source: {'binary cache' if CanBusCache.open(dataroot) else 'JSON files'}")
     
-    print("Starting benchmark...")
+    print(f"Starting benchmark with {args.workers} worker(s)...")
     benchmark_start = time.time()
     
-    for scene_name in scene_names:
-        try:
-            # We need to construct "frames" from CAN messages.
-            # In a real scenario, we stream messages. 
-            # Here, we'll fetch all relevant messages and simulate a frame-by-frame loop.
-            # To be realistic, we should align them by time, but for "execution cost of classification",
-            # we just need to pass valid state dicts to the classifier.
-            
-            pose_msgs = nusc_can.get_messages(scene_name, 'pose')
-            steer_msgs = nusc_can.get_messages(scene_name, 'steeranglefeedback')
-            monitor_msgs = nusc_can.get_messages(scene_name, 'vehicle_monitor')
-            
-            # Let's assume 1 frame per pose message (approx 50Hz or 100Hz depending on can bus)
-            # Actually pose is usually 50Hz.
-            
-            # Pre-process messages into a list of states to minimize "data loading" noise 
-            # and focus on "classification" cost?
-            # The user asked for "execution cost when applying to NuScenes CAN".
-            # This likely includes the overhead of retrieving the data and running the logic.
-            # So we will measure the loop time.
-            
-            # However, nusc_can.get_messages reads the whole file at once. 
-            # So the iteration is fast.
-            
-            # Let's align roughly.
-            # We'll just iterate pose messages and find corresponding steer/signal.
-            # To avoid O(N^2) lookup in this benchmark (which would dominate), 
-            # we'll use simple index matching or just assume same frequency for benchmarking the *classifier*.
-            # But wait, the user wants "Execution Cost". If our data loading is slow, that's part of the cost.
-            # But `get_messages` is already done.
-            
-            # Let's create a list of "Vehicle States" first, then benchmark the classification loop.
-            # This separates "Data IO" from "Processing".
-            
-            # Optimization: Convert to numpy arrays or dictionaries for fast lookup?
-            # For this benchmark, let's just iterate pose and use the latest steering/signal value.
-            
-            steer_vals = [m['value'] for m in steer_msgs]
-            steer_times = [m['utime'] for m in steer_msgs]
-            
-            monitor_vals = [m['turn_signal'] for m in monitor_msgs if 'turn_signal' in m] # Simplified
-            # monitor_times = ...
-            
-            # Just use simple iteration for speed
-            current_steer = 0
-            current_signal = 0
-            steer_idx = 0
-            monitor_idx = 0
-            
-            scene_states = []
-            
-            for pose in pose_msgs:
-                timestamp = pose['utime']
-                
-                # Update steering (assuming sorted)
-                while steer_idx < len(steer_msgs) and steer_msgs[steer_idx]['utime'] <= timestamp:
-                    current_steer = steer_msgs[steer_idx]['value']
-                    steer_idx += 1
-                
-                # Update signal
-                while monitor_idx < len(monitor_msgs) and monitor_msgs[monitor_idx]['utime'] <= timestamp:
-                    if 'turn_signal' in monitor_msgs[monitor_idx]:
-                        current_signal = monitor_msgs[monitor_idx]['turn_signal']
-                    monitor_idx += 1
-                
-                state = {
-                    'speed': np.linalg.norm([pose['vel'][0], pose['vel'][1]]),
-                    'yaw_rate': pose['rotation_rate'][2],
-                    'steering_angle': current_steer,
-                    'turn_signal': current_signal
-                }
-                scene_states.append(state)
-            
-            # Now benchmark the classification
-            start_t = time.time()
-            for state in scene_states:
-                _ = classifier._classify_frame(state)
-            end_t = time.time()
-            
-            total_time += (end_t - start_t)
-            total_frames += len(scene_states)
-            
-        except Exception as e:
-            # print(f"Error in {scene_name}: {e}")
-            continue
-            
+    results, wall_time = run_scenes(scene_names, benchmark_scene, init_worker, (dataroot, config_path), args.workers)
+    
+    total_frames = sum(r['num_frames'] for r in results)
+    total_load_time = sum(r['load_time'] for r in results)
+    total_time = sum(r['frame_time'] for r in results)
+    total_array_time = sum(r['array_time'] for r in results)
+    
     benchmark_end = time.time()
     total_benchmark_time = benchmark_end - benchmark_start
     
     print(f"\nBenchmark Results:")
     print(f"Total Scenes Processed: {len(scene_names)}")
     print(f"Total Frames Processed: {total_frames}")
+    print(f"Total CAN Loading Time (Data IO): {total_load_time:.4f} seconds")
     print(f"Total Classification Time (Pure Logic): {total_time:.4f} seconds")
     print(f"Average Time per Frame: {total_time / total_frames * 1000:.4f} ms")
     print(f"Projected FPS: {total_frames / total_time:.2f}")
+    print(f"Total Classification Time (Vectorized classify_arrays): {total_array_time:.4f} seconds")
+    print(f"Throughput: per-frame {total_frames / total_time:.2f} frames/s, vectorized {total_frames / total_array_time:.2f} frames/s")
     
     # Estimate for full NuScenes (850 scenes, ~20s each, 50Hz? -> ~1000 frames/scene -> 850,000 frames)
     # NuScenes is 1000 scenes. 20s each. 20Hz keyframes, but CAN is higher freq.
@@ -147,6 +140,10 @@ def main():
     estimated_total_time = (total_time / total_frames) * estimated_total_frames
     
     print(f"\nEstimated Time for Full NuScenes (1M frames): {estimated_total_time:.2f} seconds ({estimated_total_time/60:.2f} minutes)")
+    estimated_array_time = (total_array_time / total_frames) * estimated_total_frames
+    print(f"Estimated Time for Full NuScenes (1M frames, vectorized): {estimated_array_time:.2f} seconds")
+    
+    report_worker_throughput(results, wall_time)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,187 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Add current directory to sys.path to allow importing local modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from can_index import messages_to_columns
+
+CACHE_VERSION = 1
+CACHE_DIRNAME = 'can_bus_cache'
+# Message channels of the nuScenes CAN bus expansion (scene-XXXX_<channel>.json)
+CAN_CHANNELS = ('ms_imu', 'pose', 'steeranglefeedback', 'vehicle_monitor', 'zoe_veh_info', 'zoesensors')
+CACHE_CHANNELS = ('pose', 'steeranglefeedback', 'vehicle_monitor', 'ms_imu')
+
+class CanBusCache:
+    """
+    Memory-mapped binary cache of NuScenes CAN bus channels.
+
+    Layout (written by build_can_cache):
+
+        <cache_dir>/index.json                  channels, column dtypes/shapes and per-scene offsets
+        <cache_dir>/<channel>/<column>.npy      all scenes concatenated, sorted by utime within a scene
+
+    Columns are opened with np.load(mmap_mode='r'), so a scene's columns are
+    read-only views into the page cache and need no parsing or copies.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != CACHE_VERSION:
+            raise ValueError(f"Unsupported CAN cache version {self.index.get('version')} in {cache_dir}")
+        self._arrays = {}
+
+    @classmethod
+    def open(cls, dataroot, cache_dir=None):
+        """
+        Open the cache of a dataroot, or return None if it has not been built.
+        """
+        cache_dir = cache_dir or os.path.join(dataroot, CACHE_DIRNAME)
+        if not os.path.exists(os.path.join(cache_dir, 'index.json')):
+            return None
+        return cls(cache_dir)
+
+    @property
+    def scene_names(self):
+        return sorted(self.index['scenes'].keys())
+
+    @property
+    def channels(self):
+        return list(self.index['channels'].keys())
+
+    def has_scene(self, scene_name):
+        return scene_name in self.index['scenes']
+
+    def get_columns(self, scene_name, channel):
+        """
+        Columns of one channel for one scene.
+
+        Args:
+            scene_name (str): Scene name (e.g. "scene-0061").
+            channel (str): CAN channel name.
+
+        Returns:
+            dict: column name -> read-only memory-mapped np.ndarray view.
+        """
+        start, stop = self.index['scenes'][scene_name].get(channel, (0, 0))
+        return {
+            column: self._array(channel, column)[start:stop]
+            for column in self.index['channels'][channel]['columns']
+        }
+
+    def _array(self, channel, column):
+        key = (channel, column)
+        if key not in self._arrays:
+            path = os.path.join(self.cache_dir, channel, f"{column}.npy")
+            self._arrays[key] = np.load(path, mmap_mode='r')
+        return self._arrays[key]
+
+def find_scene_names(can_bus_dir):
+    """
+    List scene names that have CAN bus data (scene-*_meta.json).
+    """
+    scene_meta_files = glob.glob(os.path.join(can_bus_dir, 'scene-*_meta.json'))
+    scene_names = [os.path.basename(f).replace('_meta.json', '') for f in scene_meta_files]
+    scene_names.sort()
+    return scene_names
+
+def build_can_cache(dataroot, cache_dir=None, channels=CACHE_CHANNELS):
+    """
+    One-time conversion of the CAN bus JSON files into the binary cache.
+
+    Args:
+        dataroot (str): NuScenes data root (containing can_bus/).
+        cache_dir (str, optional): Output directory (default: <dataroot>/can_bus_cache).
+        channels (tuple of str): Channels to convert.
+
+    Returns:
+        str: Path of the cache directory.
+    """
+    from nuscenes.can_bus.can_bus_api import NuScenesCanBus
+
+    # A misspelled channel would otherwise be skipped for every scene
+    unknown = [channel for channel in channels if channel not in CAN_CHANNELS]
+    if unknown:
+        raise ValueError(f"Unknown CAN channels {unknown}, expected some of {list(CAN_CHANNELS)}")
+
+    cache_dir = cache_dir or os.path.join(dataroot, CACHE_DIRNAME)
+    nusc_can = NuScenesCanBus(dataroot=dataroot)
+    scene_names = find_scene_names(os.path.join(dataroot, 'can_bus'))
+    print(f"Converting {len(scene_names)} scenes into {cache_dir}...")
+
+    chunks = {channel: [] for channel in channels}
+    keys = {channel: None for channel in channels}
+    offsets = {channel: 0 for channel in channels}
+    scenes = {}
+
+    for scene_name in scene_names:
+        scene_offsets = {}
+        for channel in channels:
+            try:
+                msgs = nusc_can.get_messages(scene_name, channel, print_warnings=False)
+            except Exception as e:
+                # Blacklisted scenes or missing channel files
+                print(f"Skipping {scene_name} {channel}: {e}")
+                continue
+            if keys[channel] is None and msgs:
+                keys[channel] = [k for k in messages_to_columns(msgs[:1]) if k != 'utime']
+            columns = messages_to_columns(msgs, keys[channel] or [])
+
+            order = np.argsort(columns['utime'], kind='stable')
+            columns = {k: v[order] for k, v in columns.items()}
+            chunks[channel].append(columns)
+
+            n = len(columns['utime'])
+            scene_offsets[channel] = [offsets[channel], offsets[channel] + n]
+            offsets[channel] += n
+        if scene_offsets:
+            scenes[scene_name] = scene_offsets
+
+    # A rebuild overwrites the columns in place: drop the old index first, so a
+    # cache interrupted mid-rebuild is reported as missing instead of mixing old and new data
+    index_path = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    index = {'version': CACHE_VERSION, 'channels': {}, 'scenes': scenes}
+    for channel in channels:
+        channel_dir = os.path.join(cache_dir, channel)
+        os.makedirs(channel_dir, exist_ok=True)
+        column_names = ['utime'] + (keys[channel] or [])
+        index['channels'][channel] = {'columns': column_names}
+        for column in column_names:
+            parts = [c[column] for c in chunks[channel] if len(c['utime']) > 0]
+            if parts:
+                data = np.concatenate(parts)
+            else:
+                data = np.zeros(0, dtype=np.int64 if column == 'utime' else np.float64)
+            np.save(os.path.join(channel_dir, f"{column}.npy"), data)
+
+    # Write the index last so a partially written cache is never picked up
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return cache_dir
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert NuScenes CAN bus JSON files into a memory-mapped binary cache.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Output directory (default: <dataroot>/can_bus_cache)')
+    parser.add_argument('--channels', type=str, nargs='+', default=list(CACHE_CHANNELS), choices=CAN_CHANNELS, help='CAN channels to convert')
+    args = parser.parse_args()
+
+    start_t = time.time()
+    cache_dir = build_can_cache(args.dataroot, args.cache_dir, tuple(args.channels))
+    print(f"CAN cache written to {cache_dir} in {time.time() - start_t:.2f} seconds")
+
+if __name__ == "__main__":
+    main()
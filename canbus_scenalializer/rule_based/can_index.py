@@ -0,0 +1,263 @@
+import numpy as np
+
+# Default matching tolerance between a sample timestamp and a CAN message (microseconds, 50ms)
+DEFAULT_TOLERANCE = 50000
+
+def get_scene_samples(nusc, scene):
+    """
+    Walk the sample chain of a scene.
+
+    Args:
+        nusc (NuScenes): NuScenes instance.
+        scene (dict): Scene record.
+
+    Returns:
+        list of dict: Sample records in timestamp order.
+    """
+    samples = []
+    current_sample_token = scene['first_sample_token']
+    while current_sample_token != '':
+        sample = nusc.get('sample', current_sample_token)
+        samples.append(sample)
+        current_sample_token = sample['next']
+    return samples
+
+def load_can_index(nusc_can, scene_name, channels=None, can_cache=None):
+    """
+    Build a CanBusIndex from the binary cache when it has the scene, otherwise from the JSON files.
+
+    Args:
+        nusc_can (NuScenesCanBus): CAN bus API, used as the fallback source.
+        scene_name (str): Scene name.
+        channels (tuple of str, optional): Channels to load (default: CanBusIndex.CHANNELS).
+        can_cache (CanBusCache, optional): Cache opened with CanBusCache.open.
+
+    Returns:
+        CanBusIndex
+    """
+    channels = channels or CanBusIndex.CHANNELS
+    if can_cache is not None and can_cache.has_scene(scene_name):
+        return CanBusIndex.from_cache(can_cache, scene_name, channels)
+    return CanBusIndex.from_can_bus(nusc_can, scene_name, channels)
+
+def monitor_turn_signal(monitor):
+    """
+    Decode the turn signal from a vehicle_monitor message (0: None, 1: Left, 2: Right).
+    """
+    if 'turn_signal' in monitor:
+        return monitor['turn_signal']
+    elif 'left_turn_signal' in monitor and 'right_turn_signal' in monitor:
+        return 1 if monitor['left_turn_signal'] else (2 if monitor['right_turn_signal'] else 0)
+    return 0
+
+class CanBusIndex:
+    """
+    Time-indexed CAN bus data of a single scene.
+
+    Each channel is loaded once into contiguous NumPy arrays sorted by utime, so
+    nearest-message lookups for a whole batch of sample timestamps cost a single
+    np.searchsorted call instead of one list rebuild + bisect per sample.
+    """
+
+    CHANNELS = ('pose', 'steeranglefeedback', 'vehicle_monitor')
+
+    def __init__(self, scene_name, columns):
+        """
+        Args:
+            scene_name (str): Scene name (e.g. "scene-0061").
+            columns (dict): channel -> dict of equally long arrays, including 'utime'.
+        """
+        self.scene_name = scene_name
+        self.columns = {}
+        for channel, cols in columns.items():
+            cols = derive_columns(channel, cols)
+            utime = np.asarray(cols['utime'], dtype=np.int64)
+            if np.all(utime[1:] >= utime[:-1]):
+                # Already sorted (e.g. memory-mapped cache): keep the arrays as they are, no copies
+                self.columns[channel] = {key: np.asarray(val) for key, val in cols.items()}
+            else:
+                order = np.argsort(utime, kind='stable')
+                self.columns[channel] = {key: np.asarray(val)[order] for key, val in cols.items()}
+
+    @classmethod
+    def from_can_bus(cls, nusc_can, scene_name, channels=CHANNELS):
+        """
+        Load the given channels of a scene through NuScenesCanBus.get_messages.
+        """
+        columns = {}
+        for channel in channels:
+            msgs = nusc_can.get_messages(scene_name, channel)
+            columns[channel] = messages_to_columns(msgs)
+        return cls(scene_name, columns)
+
+    @classmethod
+    def from_cache(cls, can_cache, scene_name, channels=CHANNELS):
+        """
+        Build the index from memory-mapped columns of a CanBusCache (see can_cache.py).
+        """
+        columns = {channel: can_cache.get_columns(scene_name, channel) for channel in channels}
+        return cls(scene_name, columns)
+
+    def __len__(self):
+        return sum(len(cols['utime']) for cols in self.columns.values())
+
+    def has_channel(self, channel):
+        return channel in self.columns and len(self.columns[channel]['utime']) > 0
+
+    def lookup(self, channel, timestamps, tolerance=DEFAULT_TOLERANCE):
+        """
+        Find the closest message of a channel for each timestamp.
+
+        Matches find_closest_msg: on a tie the later message wins, and a message
+        further than `tolerance` away is not a match.
+
+        Args:
+            channel (str): CAN channel name.
+            timestamps (array-like): Sample timestamps in microseconds.
+            tolerance (int): Maximum allowed distance in microseconds.
+
+        Returns:
+            tuple: (indices into the channel arrays, boolean mask of valid matches)
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not self.has_channel(channel):
+            return np.zeros(len(timestamps), dtype=np.int64), np.zeros(len(timestamps), dtype=bool)
+
+        times = self.columns[channel]['utime']
+        n = len(times)
+        right = np.searchsorted(times, timestamps, side='left')
+        left = right - 1
+
+        right_c = np.minimum(right, n - 1)
+        left_c = np.maximum(left, 0)
+        diff_right = np.where(right < n, np.abs(times[right_c] - timestamps), np.iinfo(np.int64).max)
+        diff_left = np.where(left >= 0, np.abs(times[left_c] - timestamps), np.iinfo(np.int64).max)
+
+        use_right = diff_right <= diff_left
+        idx = np.where(use_right, right_c, left_c)
+        valid = np.minimum(diff_right, diff_left) <= tolerance
+        return idx, valid
+
+    def get(self, channel, key, timestamps, tolerance=DEFAULT_TOLERANCE, fill=np.nan):
+        """
+        Nearest-within-tolerance values of one column, `fill` where there is no match.
+        """
+        idx, valid = self.lookup(channel, timestamps, tolerance)
+        if not self.has_channel(channel):
+            return np.full(len(idx), fill, dtype=np.float64)
+        values = self.columns[channel][key][idx].astype(np.float64)
+        values[~valid] = fill
+        return values
+
+    def latest(self, channel, key, timestamps, fill=0.0):
+        """
+        Value of the last message at or before each timestamp (forward fill), `fill` before the first message.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if not self.has_channel(channel):
+            return np.full(len(timestamps), fill, dtype=np.float64)
+        idx = np.searchsorted(self.columns[channel]['utime'], timestamps, side='right') - 1
+        values = self.columns[channel][key][np.maximum(idx, 0)].astype(np.float64)
+        values[idx < 0] = fill
+        return values
+
+    def vehicle_state_arrays(self, timestamps, tolerance=DEFAULT_TOLERANCE):
+        """
+        Columnar vehicle states for a batch of timestamps.
+
+        Missing values are NaN (turn_signal defaults to 0), which is what
+        RuleBasedClassifier.classify_arrays expects.
+
+        Returns:
+            dict: 'speed', 'yaw_rate', 'steering_angle', 'turn_signal' arrays.
+        """
+        return {
+            'speed': self.get('pose', 'speed', timestamps, tolerance),
+            'yaw_rate': self.get('pose', 'yaw_rate', timestamps, tolerance),
+            'steering_angle': self.get('steeranglefeedback', 'value', timestamps, tolerance),
+            'turn_signal': self.get('vehicle_monitor', 'turn_signal', timestamps, tolerance, fill=0).astype(np.int64),
+        }
+
+    def vehicle_states(self, timestamps, tolerance=DEFAULT_TOLERANCE):
+        """
+        Vehicle state dicts for a batch of timestamps, in the `vehicle_state`
+        layout of data_format.md (keys without a matching message are omitted,
+        turn_signal defaults to 0 when vehicle_monitor is not loaded).
+
+        Args:
+            timestamps (array-like): Sample timestamps in microseconds.
+            tolerance (int): Maximum allowed distance in microseconds.
+
+        Returns:
+            list of dict: One state per timestamp.
+        """
+        pose_idx, pose_ok = self.lookup('pose', timestamps, tolerance)
+        steer_idx, steer_ok = self.lookup('steeranglefeedback', timestamps, tolerance)
+        monitor_idx, monitor_ok = self.lookup('vehicle_monitor', timestamps, tolerance)
+
+        pose = self.columns.get('pose')
+        steer = self.columns.get('steeranglefeedback')
+        monitor = self.columns.get('vehicle_monitor')
+
+        states = []
+        for i in range(len(pose_idx)):
+            state = {}
+            if pose_ok[i]:
+                state['speed'] = float(pose['speed'][pose_idx[i]])
+                state['yaw_rate'] = float(pose['yaw_rate'][pose_idx[i]])
+            if steer_ok[i]:
+                state['steering_angle'] = float(steer['value'][steer_idx[i]])
+            if monitor_ok[i]:
+                state['turn_signal'] = int(monitor['turn_signal'][monitor_idx[i]])
+            else:
+                state['turn_signal'] = 0
+            states.append(state)
+        return states
+
+def messages_to_columns(msgs, keys=None):
+    """
+    Convert a list of CAN messages into raw columns.
+
+    Every numeric field becomes a float64 column (vector fields such as 'vel'
+    become (N, k) arrays), 'utime' stays int64. Non-numeric fields are skipped.
+
+    Args:
+        msgs (list of dict): CAN messages of one channel.
+        keys (list of str, optional): Fields to extract; defaults to the numeric fields of the first message.
+
+    Returns:
+        dict: column name -> np.ndarray
+    """
+    columns = {'utime': np.array([m['utime'] for m in msgs], dtype=np.int64)}
+    if keys is None:
+        keys = [k for k, v in msgs[0].items() if k != 'utime' and _is_numeric(v)] if msgs else []
+    for key in keys:
+        columns[key] = np.array([m.get(key, np.nan) for m in msgs], dtype=np.float64)
+    return columns
+
+def derive_columns(channel, columns):
+    """
+    Add the derived columns CanBusIndex looks up ('speed'/'yaw_rate' for pose,
+    'turn_signal' for vehicle_monitor) to raw channel columns.
+    """
+    columns = dict(columns)
+    n = len(columns['utime'])
+    if channel == 'pose' and 'speed' not in columns:
+        vel = np.asarray(columns.get('vel', np.zeros((n, 3)))).reshape(-1, 3)
+        rotation_rate = np.asarray(columns.get('rotation_rate', np.zeros((n, 3)))).reshape(-1, 3)
+        columns['speed'] = np.sqrt(vel[:, 0] ** 2 + vel[:, 1] ** 2) # vel is [vx, vy, vz]
+        columns['yaw_rate'] = rotation_rate[:, 2] # rotation_rate is [rx, ry, rz]
+    elif channel == 'vehicle_monitor' and 'turn_signal' not in columns:
+        # Same decoding as monitor_turn_signal
+        if 'left_turn_signal' in columns and 'right_turn_signal' in columns:
+            left = np.asarray(columns['left_turn_signal']) != 0
+            right = np.asarray(columns['right_turn_signal']) != 0
+            columns['turn_signal'] = np.where(left, 1, np.where(right, 2, 0)).astype(np.int64)
+        else:
+            columns['turn_signal'] = np.zeros(n, dtype=np.int64)
+    return columns
+
+def _is_numeric(value):
+    if isinstance(value, (list, tuple)):
+        return len(value) > 0 and all(isinstance(v, (int, float)) for v in value)
+    return isinstance(value, (int, float))
@@ -2,11 +2,31 @@ import yaml
 import json
 import numpy as np
 
+# Label-id table for the columnar path. The order is the priority order used by
+# _classify_frame, so label id i is the i-th rule that fires.
+SCENARIO_LABELS = (
+    "Stop",
+    "Reverse",
+    "U-Turn",
+    "Left Turn",
+    "Right Turn",
+    "Pull Over",
+    "Lane Change",
+    "Deceleration",
+    "Cruising",
+)
+LABEL_IDS = {name: i for i, name in enumerate(SCENARIO_LABELS)}
+
+# Threshold for significant deceleration (m/s^2)
+DECELERATION_THRESHOLD = -1.0
+
 class RuleBasedClassifier:
     def __init__(self, config_path):
         with open(config_path, 'r') as f:
-            self.config = yaml.safe_load(f)
-            self.config = json.load(f)
+            if config_path.endswith('.json'):
+                self.config = json.load(f)
+            else:
+                self.config = yaml.safe_load(f)
         self.thresholds = self.config['thresholds']
     def classify(self, can_data):
         """
@@ -24,6 +44,100 @@ class RuleBasedClassifier:
             results.append(self._classify_frame(frame))
         return results
 
+    def classify_arrays(self, speed, steering, yaw_rate=None, turn_signal=None, gear=None, accel=None):
+        """
+        Classify columnar CAN data in one vectorized pass.
+
+        Gives the same label as _classify_frame on every row. NaN entries are
+        treated like missing keys in a frame dict (i.e. as 0.0).
+
+        Args:
+            speed (array-like): Vehicle speed (m/s).
+            steering (array-like): Signed steering angle (rad, positive = left).
+            yaw_rate (array-like, optional): Yaw rate (rad/s). Not used by the current rules.
+            turn_signal (array-like, optional): 0: None, 1: Left, 2: Right.
+            gear (array-like, optional): Gear position, 'R' means reverse.
+            accel (array-like, optional): Longitudinal acceleration (m/s^2).
+
+        Returns:
+            np.ndarray: int8 label ids, indexing into SCENARIO_LABELS.
+        """
+        speed = _as_column(speed)
+        n = len(speed)
+        steering_signed = _as_column(steering, n)
+        steering = np.abs(steering_signed)
+        turn_signal = _as_column(turn_signal, n)
+        accel = _as_column(accel, n)
+        if gear is None:
+            reverse = np.zeros(n, dtype=bool)
+        else:
+            reverse = np.asarray(gear, dtype=object) == 'R'
+
+        t = self.thresholds
+        signal_on = turn_signal != 0
+        lane_change_steer = steering > t['lane_change_steering_threshold']
+        turn = steering > t['turn_steering_threshold']
+
+        # np.select picks the first matching condition, which mirrors the
+        # early returns in _classify_frame.
+        conditions = [
+            speed < t['stop_speed_threshold'],
+            reverse,
+            steering > t['u_turn_steering_threshold'],
+            turn & (steering_signed > 0),
+            turn,
+            signal_on & lane_change_steer & (speed < t['pull_over_speed_threshold']),
+            signal_on & lane_change_steer,
+            accel < DECELERATION_THRESHOLD,
+        ]
+        choices = [LABEL_IDS[name] for name in SCENARIO_LABELS[:-1]]
+        return np.select(conditions, choices, default=LABEL_IDS["Cruising"]).astype(np.int8)
+
+    def decision_margins(self, label_ids, speed, steering, turn_signal=None, accel=None):
+        """
+        Confidence margin of classify_arrays labels: the relative distance of the
+        sample to the nearest threshold that the rule chain compared it against.
+
+        A comparison counts only if it was evaluated before the label's rule fired
+        (e.g. a Stop label only depends on the stop speed), and its margin is
+        |value - threshold| / |threshold|, capped at 1. A margin near 0 means a
+        small change of the CAN values (or of config.yaml) would flip the label.
+
+        Args:
+            label_ids (np.ndarray): Output of classify_arrays for the same inputs.
+            speed, steering, turn_signal, accel: As in classify_arrays.
+
+        Returns:
+            np.ndarray: float64 margins in [0, 1]. Samples without CAN speed get 0.
+        """
+        label_ids = np.asarray(label_ids)
+        speed_raw = np.asarray(speed, dtype=np.float64)
+        speed = _as_column(speed)
+        n = len(speed)
+        steering = np.abs(_as_column(steering, n))
+        signal_on = _as_column(turn_signal, n) != 0
+        accel = _as_column(accel, n)
+        t = self.thresholds
+
+        def rel(values, threshold):
+            return np.minimum(1.0, np.abs(values - threshold) / max(abs(threshold), 1e-9))
+
+        lane_change_steer = steering > t['lane_change_steering_threshold']
+        # (margin, evaluated) per comparison of the rule chain
+        comparisons = [
+            (rel(speed, t['stop_speed_threshold']), label_ids >= LABEL_IDS["Stop"]),
+            (rel(steering, t['u_turn_steering_threshold']), label_ids >= LABEL_IDS["U-Turn"]),
+            (rel(steering, t['turn_steering_threshold']), label_ids >= LABEL_IDS["Left Turn"]),
+            (rel(steering, t['lane_change_steering_threshold']), signal_on & (label_ids >= LABEL_IDS["Pull Over"])),
+            (rel(speed, t['pull_over_speed_threshold']), signal_on & lane_change_steer & (label_ids >= LABEL_IDS["Pull Over"])),
+            (rel(accel, DECELERATION_THRESHOLD), label_ids >= LABEL_IDS["Deceleration"]),
+        ]
+        margins = np.ones(n, dtype=np.float64)
+        for margin, evaluated in comparisons:
+            margins = np.where(evaluated, np.minimum(margins, margin), margins)
+        margins[np.isnan(speed_raw)] = 0.0
+        return margins
+
     def _classify_frame(self, frame):
         """
         Classify a single frame of CAN data.
@@ -74,8 +188,21 @@ class RuleBasedClassifier:
 
         # 5. Deceleration (Need previous frame or acceleration field, simplified here)
         accel = frame.get('acceleration', 0.0)
-        if accel < -1.0: # Threshold for significant deceleration
+        if accel < DECELERATION_THRESHOLD:
             return "Deceleration"
 
         # 6. Cruising (Default)
         return "Cruising"
+
+def labels_to_names(label_ids):
+    """
+    Convert label ids returned by classify_arrays into scenario names.
+    """
+    return [SCENARIO_LABELS[i] for i in label_ids]
+
+def _as_column(values, n=None):
+    # Missing columns / NaN entries behave like missing keys in a frame dict.
+    if values is None:
+        return np.zeros(n, dtype=np.float64)
+    arr = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(arr), 0.0, arr)
@@ -0,0 +1,425 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Add current directory to sys.path to allow importing local modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from annotation_index import AnnotationIndex, build_annotation_index
+from batch_runner import run_scenes, worker_state, timed_result, report_worker_throughput
+from can_cache import CanBusCache
+from can_index import load_can_index
+from road_context import RoadContextTagger, clip_road_columns
+
+US_PER_S = 1000000
+
+# Columns of the clip table, in output order (units in data_format.md, "Clip Table")
+CLIP_COLUMNS = (
+    'clip_id', 'scene_token', 'scene_name', 'location', 'description', 'clip_index',
+    'start_utime', 'end_utime', 'duration_s',
+    'num_samples', 'sample_tokens',
+    'num_pose_msgs', 'num_steer_msgs', 'max_pose_gap_s', 'valid',
+    'mean_speed', 'max_speed', 'max_decel', 'steering_change', 'steering_travel', 'max_abs_yaw_rate',
+)
+
+def load_scene_samples(dataroot, version):
+    """
+    Scenes with their keyframe tokens and timestamps, read directly from the
+    NuScenes tables (scene, sample, log) without loading the whole database.
+
+    Args:
+        dataroot (str): NuScenes data root.
+        version (str): NuScenes version (e.g. v1.0-mini, v1.0-trainval).
+
+    Returns:
+        list of dict: Per scene (in scene.json order): scene_token, scene_name, location,
+                      description, sample_tokens and timestamps (int64 array), sorted by timestamp.
+    """
+    table_dir = os.path.join(dataroot, version)
+
+    def load_table(name):
+        with open(os.path.join(table_dir, f"{name}.json"), 'r') as f:
+            return json.load(f)
+
+    locations = {log['token']: log['location'] for log in load_table('log')}
+    per_scene = {}
+    for sample in load_table('sample'):
+        per_scene.setdefault(sample['scene_token'], []).append((sample['timestamp'], sample['token']))
+
+    scenes = []
+    for scene in load_table('scene'):
+        samples = sorted(per_scene.get(scene['token'], []))
+        scenes.append({
+            "scene_token": scene['token'],
+            "scene_name": scene['name'],
+            "location": locations.get(scene['log_token'], ''),
+            "description": scene.get('description', ''),
+            "sample_tokens": [token for _, token in samples],
+            "timestamps": np.array([t for t, _ in samples], dtype=np.int64),
+        })
+    return scenes
+
+def clip_windows(first_utime, last_utime, length, stride=None, min_fraction=0.9):
+    """
+    Fixed (stride == length) or sliding (stride < length) windows over a scene.
+
+    Windows start at the first keyframe and never cross the scene boundary; a
+    window is kept if at least `min_fraction` of it lies within [first, last keyframe]
+    (a 20 s scene at 2 Hz spans 19.5 s, which still gives four 5 s clips).
+
+    Args:
+        first_utime (int): First keyframe timestamp (microseconds).
+        last_utime (int): Last keyframe timestamp (microseconds).
+        length (float): Clip length in seconds.
+        stride (float, optional): Offset between clip starts in seconds (default: length).
+        min_fraction (float): Minimum covered fraction of the last clip.
+
+    Returns:
+        tuple: (starts, ends) int64 arrays of [start, end) microsecond windows.
+    """
+    length_us = int(round(length * US_PER_S))
+    stride_us = int(round((stride or length) * US_PER_S))
+    span = last_utime - first_utime
+    # Number of windows whose covered part (span - offset) is at least min_fraction * length
+    count = int(np.floor((span - min_fraction * length_us) / stride_us)) + 1 if span >= min_fraction * length_us else 0
+    starts = first_utime + stride_us * np.arange(max(count, 0), dtype=np.int64)
+    return starts, starts + length_us
+
+def window_sum(utime, values, starts, ends):
+    """
+    Sum and count of the non-NaN values with utime in each [start, end) window, via cumulative sums.
+    """
+    lo = np.searchsorted(utime, starts, side='left')
+    hi = np.searchsorted(utime, ends, side='left')
+    valid = ~np.isnan(values)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    ccount = np.concatenate(([0], np.cumsum(valid)))
+    return csum[hi] - csum[lo], ccount[hi] - ccount[lo]
+
+def reduce_ranges(ufunc, values, lo, hi):
+    """
+    ufunc (np.fmax / np.fmin) over values[lo:hi] for each pair of bounds, NaN for empty ranges.
+
+    One ufunc.reduceat call over interleaved (lo, hi) bounds handles overlapping
+    (sliding) windows too; every second result is a range.
+    """
+    if len(lo) == 0:
+        return np.zeros(0, dtype=np.float64)
+    # Sentinel so that `hi` may point one past the last value
+    values = np.asarray(values, dtype=np.float64)
+    padded = np.append(values, np.nan)
+    bounds = np.empty(2 * len(lo), dtype=np.int64)
+    bounds[0::2] = np.minimum(lo, len(values))
+    bounds[1::2] = np.minimum(hi, len(values))
+    result = ufunc.reduceat(padded, bounds)[0::2]
+    result[hi <= lo] = np.nan
+    return result
+
+def window_reduce(ufunc, utime, values, starts, ends):
+    """
+    reduce_ranges over the values with utime in each [start, end) window.
+    """
+    lo = np.searchsorted(utime, starts, side='left')
+    hi = np.searchsorted(utime, ends, side='left')
+    return reduce_ranges(ufunc, values, lo, hi)
+
+def smooth(utime, values, window):
+    """
+    Centered moving average over `window` seconds (a low-pass filter for noisy
+    CAN signals such as accelerations), NaN-aware, via cumulative sums.
+    """
+    if window <= 0 or len(utime) == 0:
+        return np.asarray(values, dtype=np.float64)
+    half = int(round(window * US_PER_S / 2))
+    total, count = window_sum(utime, np.asarray(values, dtype=np.float64), utime - half, utime + half + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+def max_gap(utime, starts, ends):
+    """
+    Longest interval without a message in each [start, end) window, including
+    the edges of the window (an empty window has a gap of its full length).
+    """
+    if len(utime) == 0:
+        return (ends - starts).astype(np.float64)
+    lo = np.searchsorted(utime, starts, side='left')
+    hi = np.searchsorted(utime, ends, side='left')
+    # gaps[j] lies between messages j and j + 1; both are in the window for j in [lo, hi - 1)
+    inner = reduce_ranges(np.fmax, np.diff(utime), lo, np.maximum(hi - 1, lo))
+    has_msgs = hi > lo
+    first = np.where(has_msgs, utime[np.minimum(lo, len(utime) - 1)] - starts, ends - starts)
+    last = np.where(has_msgs, ends - utime[np.maximum(hi - 1, 0)], 0)
+    return np.fmax(np.fmax(inner, first), last).astype(np.float64)
+
+def aggregate_clips(columns, starts, ends, smooth_window=0.5):
+    """
+    Per-clip CAN features of one scene.
+
+    Args:
+        columns (dict): CanBusIndex.columns ('pose' and 'steeranglefeedback').
+        starts (np.ndarray): Clip start times (microseconds).
+        ends (np.ndarray): Clip end times (microseconds, exclusive).
+        smooth_window (float): Moving average window (seconds) applied to the
+                               longitudinal acceleration before taking the maximum.
+
+    Returns:
+        dict: Column name -> array with one value per clip: num_pose_msgs,
+              num_steer_msgs, max_pose_gap_s, mean_speed, max_speed, max_decel,
+              steering_change, steering_travel, max_abs_yaw_rate (NaN without data).
+    """
+    empty = {'utime': np.zeros(0, dtype=np.int64)}
+    pose = columns.get('pose', empty)
+    steer = columns.get('steeranglefeedback', empty)
+    pose_t = np.asarray(pose['utime'], dtype=np.int64)
+    steer_t = np.asarray(steer['utime'], dtype=np.int64)
+
+    def pose_column(key):
+        return np.asarray(pose[key], dtype=np.float64) if key in pose else np.full(len(pose_t), np.nan)
+
+    speed = pose_column('speed')
+    yaw_rate = pose_column('yaw_rate')
+    if 'accel' in pose and len(pose_t) > 0:
+        # Ego frame, x forward: deceleration is the negative longitudinal acceleration
+        accel_x = np.asarray(pose['accel'], dtype=np.float64).reshape(len(pose_t), -1)[:, 0]
+    else:
+        accel_x = np.full(len(pose_t), np.nan)
+    steering = np.asarray(steer['value'], dtype=np.float64) if 'value' in steer else np.full(len(steer_t), np.nan)
+
+    speed_sum, speed_count = window_sum(pose_t, speed, starts, ends)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_speed = np.where(speed_count > 0, speed_sum / np.maximum(speed_count, 1), np.nan)
+
+    # Steering travel: total absolute steering movement between consecutive messages of the window
+    steer_lo = np.searchsorted(steer_t, starts, side='left')
+    steer_hi = np.searchsorted(steer_t, ends, side='left')
+    steer_count = steer_hi - steer_lo
+    step_sum = np.concatenate(([0.0], np.cumsum(np.nan_to_num(np.abs(np.diff(steering))))))
+    last_step = len(step_sum) - 1
+    steer_travel = step_sum[np.minimum(np.maximum(steer_hi - 1, steer_lo), last_step)] - step_sum[np.minimum(steer_lo, last_step)]
+    steer_travel = np.where(steer_count >= 2, steer_travel, np.nan)
+
+    return {
+        'num_pose_msgs': (np.searchsorted(pose_t, ends) - np.searchsorted(pose_t, starts)).astype(np.int64),
+        'num_steer_msgs': steer_count.astype(np.int64),
+        'max_pose_gap_s': max_gap(pose_t, starts, ends) / US_PER_S,
+        'mean_speed': mean_speed,
+        'max_speed': window_reduce(np.fmax, pose_t, speed, starts, ends),
+        'max_decel': -window_reduce(np.fmin, pose_t, smooth(pose_t, accel_x, smooth_window), starts, ends),
+        'steering_change': window_reduce(np.fmax, steer_t, steering, starts, ends)
+                           - window_reduce(np.fmin, steer_t, steering, starts, ends),
+        'steering_travel': steer_travel,
+        'max_abs_yaw_rate': window_reduce(np.fmax, pose_t, np.abs(yaw_rate), starts, ends),
+    }
+
+def scene_clip_columns(scene, can_columns, length, stride=None, min_fraction=0.9, smooth_window=0.5, max_pose_gap=0.5):
+    """
+    Clip rows of one scene, as columns.
+
+    Args:
+        scene (dict): Entry of load_scene_samples.
+        can_columns (dict): CanBusIndex.columns of the scene ({} without CAN data).
+        length, stride, min_fraction: See clip_windows.
+        smooth_window (float): See aggregate_clips.
+        max_pose_gap (float): Clips with a longer pose message gap (seconds) are marked invalid.
+
+    Returns:
+        dict: CLIP_COLUMNS -> list or array, one entry per clip.
+    """
+    timestamps = np.asarray(scene['timestamps'], dtype=np.int64)
+    if len(timestamps) == 0:
+        starts = ends = np.zeros(0, dtype=np.int64)
+    else:
+        starts, ends = clip_windows(int(timestamps[0]), int(timestamps[-1]), length, stride, min_fraction)
+    n = len(starts)
+
+    sample_lo = np.searchsorted(timestamps, starts, side='left')
+    sample_hi = np.searchsorted(timestamps, ends, side='left')
+    features = aggregate_clips(can_columns, starts, ends, smooth_window)
+
+    columns = {
+        'clip_id': [f"{scene['scene_name']}_{i:03d}" for i in range(n)],
+        'scene_token': [scene['scene_token']] * n,
+        'scene_name': [scene['scene_name']] * n,
+        'location': [scene['location']] * n,
+        'description': [scene.get('description', '')] * n,
+        'clip_index': np.arange(n, dtype=np.int64),
+        'start_utime': starts,
+        'end_utime': ends,
+        'duration_s': (ends - starts) / US_PER_S,
+        'num_samples': (sample_hi - sample_lo).astype(np.int64),
+        'sample_tokens': [scene['sample_tokens'][lo:hi] for lo, hi in zip(sample_lo, sample_hi)],
+        'valid': (features['num_pose_msgs'] > 0) & (features['max_pose_gap_s'] <= max_pose_gap) & (sample_hi > sample_lo),
+    }
+    columns.update(features)
+    return {name: columns[name] for name in CLIP_COLUMNS}
+
+def concat_columns(parts):
+    """
+    Concatenate per-scene column dicts into one table (lists for strings/tokens, arrays otherwise).
+    """
+    table = {}
+    for name in (parts[0] if parts else CLIP_COLUMNS):
+        values = [part[name] for part in parts]
+        if values and isinstance(values[0], np.ndarray):
+            table[name] = np.concatenate(values)
+        else:
+            table[name] = [v for part in values for v in part]
+    return table
+
+def check_output_format(path):
+    """
+    Fail before any processing if the output format needs pyarrow and it is not installed.
+    """
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet requires pyarrow (pip install pyarrow), or use a .jsonl output path")
+
+def write_clip_table(path, table):
+    """
+    Write the clip table as Parquet (.parquet, requires pyarrow) or JSON Lines (any other extension).
+    Columns are written in the order of `table` (CLIP_COLUMNS, then optional feature columns).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    check_output_format(path)
+    if path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table(table), path)
+        return path
+
+    num_rows = len(table['clip_id'])
+    with open(path, 'w') as f:
+        for i in range(num_rows):
+            row = {}
+            for name, values in table.items():
+                value = values[i]
+                if isinstance(value, np.generic):
+                    value = value.item()
+                if isinstance(value, float) and np.isnan(value):
+                    value = None
+                row[name] = value
+            f.write(json.dumps(row) + '\n')
+    return path
+
+def read_clip_table(path):
+    """
+    Read a clip table written by write_clip_table.
+
+    Returns:
+        dict: Column name -> list.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pydict()
+    table = {}
+    with open(path, 'r') as f:
+        for line in f:
+            for name, value in json.loads(line).items():
+                table.setdefault(name, []).append(value)
+    return table
+
+def init_worker(dataroot, road_context=False):
+    """
+    Open the CAN bus sources (and the map tagger) once per worker process.
+    """
+    from nuscenes.can_bus.can_bus_api import NuScenesCanBus
+
+    worker_state['nusc_can'] = NuScenesCanBus(dataroot=dataroot)
+    # Binary CAN cache (built by can_cache.py), falls back to the JSON files when absent
+    worker_state['can_cache'] = CanBusCache.open(dataroot)
+    # Maps are loaded on first use per location and stay cached for the worker's scenes
+    worker_state['road_tagger'] = RoadContextTagger(dataroot) if road_context else None
+
+def process_scene_clips(task):
+    """
+    Load the CAN channels of one scene and compute its clip rows.
+    """
+    start_t = time.time()
+    scene = task['scene']
+    try:
+        can_index = load_can_index(worker_state['nusc_can'], scene['scene_name'],
+                                   ('pose', 'steeranglefeedback'), worker_state['can_cache'])
+        can_columns = can_index.columns
+        error = None
+    except Exception as e:
+        # Scenes without CAN bus data: the clips are kept but marked invalid
+        can_columns = {}
+        error = str(e)
+    columns = scene_clip_columns(scene, can_columns, **task['options'])
+    if worker_state['road_tagger'] is not None:
+        # Tag every pose message (pos is the ego position in the map frame, like ego_pose)
+        pose = can_columns.get('pose', {})
+        if 'pos' in pose:
+            pose_t = np.asarray(pose['utime'], dtype=np.int64)
+            masks = worker_state['road_tagger'].tag(scene['location'], pose['pos'])
+        else:
+            # No pose positions: the road columns are still added, empty for every clip
+            pose_t = np.zeros(0, dtype=np.int64)
+            masks = np.zeros(0, dtype=np.int64)
+        columns.update(clip_road_columns(pose_t, masks, columns['start_utime'], columns['end_utime']))
+    return timed_result(scene['scene_name'], len(scene['sample_tokens']), start_t, columns=columns, error=error)
+
+def main():
+    parser = argparse.ArgumentParser(description="Split NuScenes scenes into clips and aggregate CAN bus features per clip.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--version', type=str, default='v1.0-mini', help='NuScenes version (e.g., v1.0-mini, v1.0-trainval)')
+    parser.add_argument('--output', type=str, default=None, help='Output .parquet or .jsonl (default: ../output/clips_<version>.parquet)')
+    parser.add_argument('--length', type=float, default=5.0, help='Clip length in seconds')
+    parser.add_argument('--stride', type=float, default=None, help='Offset between clip starts in seconds (default: --length, i.e. non-overlapping clips)')
+    parser.add_argument('--min_clip_fraction', type=float, default=0.9, help='Minimum fraction of a clip covered by its scene')
+    parser.add_argument('--smooth', type=float, default=0.5, help='Moving average window (s) of the acceleration used for max_decel')
+    parser.add_argument('--max_gap', type=float, default=0.5, help='Clips with a longer gap (s) between pose messages are marked invalid')
+    parser.add_argument('--drop_invalid', action='store_true', help='Drop invalid clips instead of writing them with valid=false')
+    parser.add_argument('--annotations', action='store_true',
+                        help='Add per-clip annotation counts and attribute ratios (builds the annotation index if needed)')
+    parser.add_argument('--road_context', action='store_true',
+                        help='Add road context columns (share of poses on intersections, lane connectors, ... and road_type) from the map')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(current_dir, '..', 'output', f"clips_{args.version}.parquet")
+    check_output_format(output)
+    start_t = time.time()
+    scenes = load_scene_samples(args.dataroot, args.version)
+    print(f"Loaded {len(scenes)} scenes in {time.time() - start_t:.2f} seconds")
+
+    options = {
+        "length": args.length,
+        "stride": args.stride,
+        "min_fraction": args.min_clip_fraction,
+        "smooth_window": args.smooth,
+        "max_pose_gap": args.max_gap,
+    }
+    tasks = [{"scene": scene, "options": options} for scene in scenes]
+    results, wall_time = run_scenes(tasks, process_scene_clips, init_worker, (args.dataroot, args.road_context), args.workers)
+    report_worker_throughput(results, wall_time)
+
+    for r in results:
+        if r['error']:
+            print(f"  {r['scene_name']}: no CAN bus data ({r['error']})")
+    table = concat_columns([r['columns'] for r in results])
+    valid = np.asarray(table['valid'], dtype=bool)
+    print(f"{len(valid)} clips, {np.count_nonzero(~valid)} invalid (missing CAN data or pose gaps > {args.max_gap} s)")
+    if args.annotations:
+        annotation_index = AnnotationIndex.open(args.dataroot, args.version)
+        if annotation_index is None:
+            print("Building the annotation index (once per version)...")
+            annotation_index = AnnotationIndex(build_annotation_index(args.dataroot, args.version))
+        table.update(annotation_index.aggregate(table['sample_tokens']))
+    if args.drop_invalid:
+        table = {name: (values[valid] if isinstance(values, np.ndarray) else [v for v, ok in zip(values, valid) if ok])
+                 for name, values in table.items()}
+
+    write_clip_table(output, table)
+    print(f"Clip table ({len(table['clip_id'])} rows) written to {output} in {time.time() - start_t:.2f} seconds")
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,8 @@ try:
     from nuscenes.nuscenes import NuScenes
     from nuscenes.can_bus.can_bus_api import NuScenesCanBus
     from classifier import RuleBasedClassifier
+    from can_index import load_can_index, get_scene_samples
+    from can_cache import CanBusCache
 except Exception as e:
     with open('c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\canbus_scenalializer\\rule_based\\error_log.txt', 'w') as f:
         f.write(f"Import Error: {traceback.format_exc()}")
@@ -32,6 +34,8 @@ def main():
     try:
         nusc = NuScenes(version='v1.0-mini', dataroot=dataroot, verbose=True)
         nusc_can = NuScenesCanBus(dataroot=dataroot)
+        # Binary CAN cache (built by can_cache.py), falls back to the JSON files when absent
+        can_cache = CanBusCache.open(dataroot)
     except Exception as e:
         print(f"Error initializing NuScenes: {e}")
         return
@@ -57,8 +61,10 @@ def main():
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     out = None
 
-    first_sample_token = scene['first_sample_token']
-    current_sample_token = first_sample_token
+    # Load the scene's CAN channels once and look up all sample timestamps in one batch
+    can_index = load_can_index(nusc_can, scene_name, can_cache=can_cache)
+    samples = get_scene_samples(nusc, scene)
+    vehicle_states = can_index.vehicle_states([s['timestamp'] for s in samples])
     
     results = []
     frame_count = 0
@@ -73,12 +79,10 @@ def main():
     total_classification_time = 0
     classification_count = 0
 
-    while current_sample_token != '':
-        sample = nusc.get('sample', current_sample_token)
+    for sample, vehicle_state in zip(samples, vehicle_states):
+        current_sample_token = sample['token']
         timestamp = sample['timestamp'] # Microseconds
 
-        vehicle_state = get_vehicle_state(nusc_can, scene_name, timestamp)
-        
         start_time = time.time()
         scenario = classifier._classify_frame(vehicle_state)
         end_time = time.time()
@@ -102,7 +106,6 @@ def main():
         im_path = os.path.join(dataroot, cam_front_data['filename'])
         if not os.path.exists(im_path):
             print(f"Image not found: {im_path}")
-            current_sample_token = sample['next']
             continue
 
         img = cv2.imread(im_path)
@@ -123,8 +126,6 @@ def main():
         frame_count += 1
         if frame_count % 10 == 0:
             print(f"Processed {frame_count} frames...")
-
-        current_sample_token = sample['next']
         
     if classification_count > 0:
         avg_time = total_classification_time / classification_count
@@ -144,87 +145,6 @@ def main():
         json.dump(classification_data, f, indent=2)
     print(f"Classification results saved to {output_json_path}")
 
-def get_vehicle_state(nusc_can, scene_name, timestamp, tolerance=50000):
-    """
-    Find closest CAN messages to the timestamp.
-    timestamp: microseconds
-    tolerance: microseconds (default 50ms)
-    """
-    # Ideally, we should index CAN messages by time for fast lookup.
-    # For this demo, we'll do a linear search or assume we have a helper.
-    # Since nusc_can.get_messages returns a list, we can search.
-    
-    # NOTE: This is slow for a loop. In production, pre-process CAN data into a time-indexed dataframe.
-    # Here we will mock it or implement a simple search if data is small.
-    
-    # Let's try to get 'pose' and 'steer_angle_feedback'
-    # This part requires efficient implementation.
-    # For the sake of the 'demo', let's assume we implement a simple finder.
-    
-    pose_msgs = nusc_can.get_messages(scene_name, 'pose')
-    steer_msgs = nusc_can.get_messages(scene_name, 'steeranglefeedback')
-    monitor_msgs = nusc_can.get_messages(scene_name, 'vehicle_monitor')
-    
-    # Find message closest to timestamp
-    pose = find_closest_msg(pose_msgs, timestamp, tolerance)
-    steer = find_closest_msg(steer_msgs, timestamp, tolerance)
-    monitor = find_closest_msg(monitor_msgs, timestamp, tolerance)
-    
-    state = {}
-    if pose:
-        state['speed'] = np.linalg.norm([pose['vel'][0], pose['vel'][1]]) # vel is [vx, vy, vz]
-        state['yaw_rate'] = pose['rotation_rate'][2] # rotation_rate is [rx, ry, rz]
-    
-    if steer:
-        state['steering_angle'] = steer['value']
-
-    if monitor:
-        # Debug: Print keys if we haven't seen them
-        # print(f"Monitor keys: {monitor.keys()}")
-        # Check for known keys
-        if 'turn_signal' in monitor:
-            state['turn_signal'] = monitor['turn_signal']
-        elif 'left_turn_signal' in monitor and 'right_turn_signal' in monitor:
-             # Maybe separate signals?
-             state['turn_signal'] = 1 if monitor['left_turn_signal'] else (2 if monitor['right_turn_signal'] else 0)
-        else:
-             # print(f"Warning: turn_signal not found in monitor message: {monitor}")
-             state['turn_signal'] = 0
-    else:
-        state['turn_signal'] = 0 
-    
-    return state
-
-def find_closest_msg(msgs, timestamp, tolerance):
-    # Binary search or simple linear scan if sorted. CAN messages are usually sorted by utime.
-    # Let's do a simple linear scan for robustness in this snippet, or binary search if len is large.
-    # Since we are iterating sequentially in main, we could keep an index.
-    # For simplicity:
-    if not msgs:
-        return None
-    
-    # Binary search for closest
-    times = [m['utime'] for m in msgs]
-    import bisect
-    idx = bisect.bisect_left(times, timestamp)
-    
-    candidates = []
-    if idx < len(msgs):
-        candidates.append(msgs[idx])
-    if idx > 0:
-        candidates.append(msgs[idx-1])
-        
-    best_msg = None
-    min_diff = float('inf')
-    
-    for msg in candidates:
-        diff = abs(msg['utime'] - timestamp)
-        if diff < min_diff and diff <= tolerance:
-            min_diff = diff
-            best_msg = msg
-            
-    return best_msg
-
 if __name__ == '__main__':
     try:
         main()
@@ -1,9 +1,10 @@
 import sys
 import os
 import traceback
+import argparse
 import datetime
 import json
-import cv2
+import time
 import numpy as np
 
 # Add current directory to sys.path to allow importing local modules
@@ -15,25 +16,55 @@ try:
     from nuscenes.nuscenes import NuScenes
     from nuscenes.can_bus.can_bus_api import NuScenesCanBus
     from classifier import RuleBasedClassifier
+    from can_index import load_can_index, get_scene_samples
+    from can_cache import CanBusCache
+    from segment_output import write_segments
+    from batch_runner import run_scenes, worker_state, timed_result, report_worker_throughput, merge_scene_results
+    from video_output import VIDEO_ENCODERS, FramePrefetcher, draw_overlay, ffmpeg_available, open_video_writer
+    from highlights import RARE_SCENARIOS, write_highlight_reel
+    from road_context import RoadContextTagger, tags_from_mask
 except Exception as e:
     with open(os.path.join(current_dir, 'error_log.txt'), 'w') as f:
         f.write(f"Import Error: {traceback.format_exc()}")
     print("Import Error occurred. See error_log.txt")
     sys.exit(1)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate rule-based demo videos and classification results for NuScenes scenes.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--version', type=str, default='v1.0-mini', help='NuScenes version (e.g., v1.0-mini, v1.0-trainval)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (scenes are processed in parallel)')
+    parser.add_argument('--output_format', type=str, default='json', choices=['json', 'segments', 'both'],
+                        help="'json': per-sample classification_results.json, 'segments': compact label runs + NPZ state sidecar (see segment_output.py)")
+    parser.add_argument('--no-video', dest='no_video', action='store_true', help='Only write classification results (no image decoding or video encoding)')
+    parser.add_argument('--video_encoder', type=str, default='mp4v', choices=VIDEO_ENCODERS,
+                        help="'mp4v': cv2.VideoWriter, 'ffmpeg': pipe frames to an ffmpeg subprocess (libx264)")
+    parser.add_argument('--ffmpeg_threads', type=int, default=2, help='Encoder threads per ffmpeg process (one process per worker)')
+    parser.add_argument('--prefetch', type=int, default=8, help='Number of images decoded ahead of the video writer')
+    parser.add_argument('--highlights', action='store_true',
+                        help='Render one highlight reel around label transitions and rare scenarios instead of per-scene videos')
+    parser.add_argument('--highlight_window', type=int, default=2, help='Samples kept before and after each highlight event')
+    parser.add_argument('--highlight_classes', type=str, default=','.join(RARE_SCENARIOS),
+                        help='Comma-separated rare scenarios that are always highlighted')
+    parser.add_argument('--road_context', action='store_true',
+                        help='Add the map road context tags (intersection, lane_connector, stop_line, ...) of each sample to the results')
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if not args.no_video and args.video_encoder == 'ffmpeg' and not ffmpeg_available():
+        print("Error: --video_encoder ffmpeg requires ffmpeg on the PATH.")
+        return
+
     # Initialize NuScenes
-    dataroot = 'c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes'
+    dataroot = args.dataroot
     try:
-        nusc = NuScenes(version='v1.0-mini', dataroot=dataroot, verbose=True)
-        nusc_can = NuScenesCanBus(dataroot=dataroot)
+        nusc = NuScenes(version=args.version, dataroot=dataroot, verbose=True)
     except Exception as e:
         print(f"Error initializing NuScenes: {e}")
         return
 
-    # Initialize Classifier
     config_path = os.path.join(current_dir, 'config.yaml')
-    classifier = RuleBasedClassifier(config_path)
 
     # Output directory setup (Run ID)
     run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -41,141 +72,173 @@ def main():
     os.makedirs(base_output_dir, exist_ok=True)
     print(f"Base output directory created: {base_output_dir}")
 
-    # Process all scenes
+    # Process all scenes. The sample chains are resolved here, so workers don't need to load NuScenes.
     scenes_to_process = nusc.scene
-    print(f"Processing {len(scenes_to_process)} scenes...")
-
-    for i, scene in enumerate(scenes_to_process):
-        scene_name = scene['name']
-        scene_token = scene['token']
-        print(f"[{i+1}/{len(scenes_to_process)}] Processing scene: {scene_name}")
+    video = None if args.no_video else {
+        "encoder": args.video_encoder,
+        "ffmpeg_threads": args.ffmpeg_threads,
+        "prefetch": args.prefetch
+    }
+    # With --highlights the workers only classify; the reel is rendered once all scenes are done
+    highlights = args.highlights and video is not None
+    tasks = [collect_scene_task(nusc, scene, dataroot, base_output_dir, args.output_format,
+                                None if highlights else video, highlights, args.road_context)
+             for scene in scenes_to_process]
+    print(f"Processing {len(tasks)} scenes with {args.workers} worker(s)...")
+
+    results, wall_time = run_scenes(tasks, process_scene, init_worker, (dataroot, config_path, args.road_context), args.workers)
+
+    report_worker_throughput(results, wall_time)
+    if args.output_format != 'segments':
+        merged_path = merge_scene_results(base_output_dir, [t['scene_name'] for t in tasks])
+        print(f"Merged classification results saved to {merged_path}")
+
+    if highlights:
+        by_scene = {r['scene_name']: r for r in results}
+        scenes = [dict(t, scenarios=by_scene[t['scene_name']]['scenarios'],
+                       vehicle_states=by_scene[t['scene_name']]['vehicle_states'])
+                  for t in tasks if t['scene_name'] in by_scene]
+        rare = tuple(c.strip() for c in args.highlight_classes.split(',') if c.strip())
+        index_path, written, total = write_highlight_reel(base_output_dir, scenes, video, args.highlight_window, rare)
+        with open(index_path, 'r') as f:
+            num_windows = len(json.load(f)['highlights'])
+        print(f"Highlights: {num_windows} windows, {written} of {total} frames rendered "
+              f"({written / max(total, 1):.1%}), index saved to {index_path}")
+
+def collect_scene_task(nusc, scene, dataroot, base_output_dir, output_format='json', video=None, highlights=False,
+                       road_context=False):
+    """
+    Everything a worker needs to process one scene, as plain picklable data.
 
-        # Scene specific output directory
-        scene_output_dir = os.path.join(base_output_dir, f"{scene_name}")
-        os.makedirs(scene_output_dir, exist_ok=True)
+    `video` holds the video options (encoder, ffmpeg_threads, prefetch); None skips the video.
+    With `highlights`, the worker returns the scenarios and vehicle states for the highlight reel.
+    With `road_context`, each sample carries its ego position and the scene its map location.
+    """
+    samples = []
+    for sample in get_scene_samples(nusc, scene):
+        # Get camera image (CAM_FRONT)
+        cam_front_data = nusc.get('sample_data', sample['data']['CAM_FRONT'])
+        samples.append({
+            "sample_token": sample['token'],
+            "timestamp": sample['timestamp'],
+            "im_path": os.path.join(dataroot, cam_front_data['filename'])
+        })
+        if road_context:
+            samples[-1]["ego_xy"] = nusc.get('ego_pose', cam_front_data['ego_pose_token'])['translation'][:2]
+    return {
+        "scene_name": scene['name'],
+        "scene_token": scene['token'],
+        "samples": samples,
+        "output_dir": os.path.join(base_output_dir, scene['name']),
+        "output_format": output_format,
+        "video": video,
+        "highlights": highlights,
+        "location": nusc.get('log', scene['log_token'])['location'] if road_context else None
+    }
+
+def init_worker(dataroot, config_path, road_context=False):
+    """
+    Load the classifier and CAN bus sources (and the map tagger) once per worker process.
+    """
+    worker_state['classifier'] = RuleBasedClassifier(config_path)
+    worker_state['nusc_can'] = NuScenesCanBus(dataroot=dataroot)
+    # Binary CAN cache (built by can_cache.py), falls back to the JSON files when absent
+    worker_state['can_cache'] = CanBusCache.open(dataroot)
+    worker_state['road_tagger'] = RoadContextTagger(dataroot) if road_context else None
 
-        # Video writer setup
-        output_video_path = os.path.join(scene_output_dir, 'demo_output.mp4')
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = None
+def process_scene(task):
+    """
+    Classify one scene and write its demo video (unless disabled) and classification_results.json.
+    """
+    start_t = time.time()
+    classifier = worker_state['classifier']
+    scene_name = task['scene_name']
+    print(f"[pid {os.getpid()}] Processing scene: {scene_name}")
 
-        first_sample_token = scene['first_sample_token']
-        current_sample_token = first_sample_token
-        
-        classification_data = {
-            "scene_token": scene_token,
-            "scene_name": scene_name,
-            "samples": []
-        }
+    # Scene specific output directory
+    scene_output_dir = task['output_dir']
+    os.makedirs(scene_output_dir, exist_ok=True)
 
-        frame_count = 0
+    # Turn signal is in 'vehicle_monitor' usually, but might not be populated in all datasets.
+    # We only load pose/steering, so turn_signal defaults to 0.
+    can_index = load_can_index(worker_state['nusc_can'], scene_name, ('pose', 'steeranglefeedback'), worker_state['can_cache'])
+    samples = task['samples']
+    vehicle_states = can_index.vehicle_states([s['timestamp'] for s in samples])
+    
+    classification_data = {
+        "scene_token": task['scene_token'],
+        "scene_name": scene_name,
+        "samples": []
+    }
+
+    if task['location'] is not None:
+        road_masks = worker_state['road_tagger'].tag(task['location'], [s['ego_xy'] for s in samples])
+    else:
+        road_masks = None
+
+    scenarios = []
+    for i, (sample, vehicle_state) in enumerate(zip(samples, vehicle_states)):
+        scenario = classifier._classify_frame(vehicle_state)
+        scenarios.append(scenario)
         
-        while current_sample_token != '':
-            sample = nusc.get('sample', current_sample_token)
-            timestamp = sample['timestamp'] # Microseconds
-
-            vehicle_state = get_vehicle_state(nusc_can, scene_name, timestamp)
-            
-            scenario = classifier._classify_frame(vehicle_state)
-            
-            # Collect structured data
-            classification_data["samples"].append({
-                "sample_token": current_sample_token,
-                "timestamp": timestamp,
-                "scenario": scenario,
-                "vehicle_state": vehicle_state
-            })
-            
-            # Visualization
-            # Get camera image (CAM_FRONT)
-            cam_front_data = nusc.get('sample_data', sample['data']['CAM_FRONT'])
-            im_path = os.path.join(dataroot, cam_front_data['filename'])
-            if not os.path.exists(im_path):
-                print(f"Image not found: {im_path}")
-                current_sample_token = sample['next']
-                continue
-
-            img = cv2.imread(im_path)
-            
-            if out is None:
-                height, width, layers = img.shape
-                out = cv2.VideoWriter(output_video_path, fourcc, 2, (width, height)) # 2 FPS approx
-
-            # Overlay Text
-            text = f"Scenario: {scenario}"
-            cv2.putText(img, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
-            
-            # Add vehicle state info for debug
-            info_text = f"Speed: {vehicle_state.get('speed', 0):.2f} m/s, Steer: {vehicle_state.get('steering_angle', 0):.2f} rad"
-            cv2.putText(img, info_text, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
-
-            out.write(img)
-            frame_count += 1
-            
-            current_sample_token = sample['next']
-
-        if out:
-            out.release()
+        # Collect structured data
+        classification_data["samples"].append({
+            "sample_token": sample['sample_token'],
+            "timestamp": sample['timestamp'], # Microseconds
+            "scenario": scenario,
+            "vehicle_state": vehicle_state
+        })
+        if road_masks is not None:
+            classification_data["samples"][-1]["road_tags"] = tags_from_mask(road_masks[i])
+
+    if task['video'] is not None:
+        output_video_path = os.path.join(scene_output_dir, 'demo_output.mp4')
+        render_video(output_video_path, samples, scenarios, vehicle_states, task['video'])
         print(f"  Video saved to {output_video_path}")
-        
-        # Save JSON output
+    
+    # Save JSON output
+    if task['output_format'] in ('json', 'both'):
         output_json_path = os.path.join(scene_output_dir, 'classification_results.json')
         with open(output_json_path, 'w') as f:
             json.dump(classification_data, f, indent=2)
         print(f"  Classification results saved to {output_json_path}")
+    if task['output_format'] in ('segments', 'both'):
+        segments_path, states_path = write_segments(scene_output_dir, classification_data)
+        print(f"  Classification segments saved to {segments_path} (+ {os.path.basename(states_path)})")
+
+    if task['highlights']:
+        return timed_result(scene_name, len(samples), start_t, scenarios=scenarios, vehicle_states=vehicle_states)
+    return timed_result(scene_name, len(samples), start_t)
 
-def get_vehicle_state(nusc_can, scene_name, timestamp, tolerance=50000):
+def render_video(output_video_path, samples, scenarios, vehicle_states, video):
     """
-    Find closest CAN messages to the timestamp.
-    timestamp: microseconds
-    tolerance: microseconds (default 50ms)
+    Write the demo video of one scene: CAM_FRONT frames with the scenario and vehicle state overlaid.
+
+    Images are decoded on a prefetch thread while the current frame is drawn and
+    encoded (by cv2.VideoWriter, or by an ffmpeg subprocess with video['encoder'] == 'ffmpeg').
+
+    Returns:
+        int: Number of frames written.
     """
-    pose_msgs = nusc_can.get_messages(scene_name, 'pose')
-    steer_msgs = nusc_can.get_messages(scene_name, 'steeranglefeedback')
-    
-    # Find message closest to timestamp
-    pose = find_closest_msg(pose_msgs, timestamp, tolerance)
-    steer = find_closest_msg(steer_msgs, timestamp, tolerance)
-    
-    state = {}
-    if pose:
-        state['speed'] = np.linalg.norm([pose['vel'][0], pose['vel'][1]]) # vel is [vx, vy, vz]
-        state['yaw_rate'] = pose['rotation_rate'][2] # rotation_rate is [rx, ry, rz]
-    
-    if steer:
-        state['steering_angle'] = steer['value']
+    out = None
+    frame_count = 0
+    with FramePrefetcher([s['im_path'] for s in samples], depth=video['prefetch']) as frames:
+        for (im_path, img), scenario, vehicle_state in zip(frames, scenarios, vehicle_states):
+            # Visualization
+            if img is None:
+                print(f"Image not found: {im_path}")
+                continue
 
-    # Turn signal is in 'vehicle_monitor' usually, but might not be populated in all datasets.
-    # We'll default to 0.
-    state['turn_signal'] = 0 
-    
-    return state
+            if out is None:
+                height, width, layers = img.shape
+                out = open_video_writer(output_video_path, 2, (width, height), video['encoder'], video['ffmpeg_threads']) # 2 FPS approx
 
-def find_closest_msg(msgs, timestamp, tolerance):
-    if not msgs:
-        return None
-    
-    # Binary search for closest
-    times = [m['utime'] for m in msgs]
-    import bisect
-    idx = bisect.bisect_left(times, timestamp)
-    
-    candidates = []
-    if idx < len(msgs):
-        candidates.append(msgs[idx])
-    if idx > 0:
-        candidates.append(msgs[idx-1])
-        
-    best_msg = None
-    min_diff = float('inf')
-    
-    for msg in candidates:
-        diff = abs(msg['utime'] - timestamp)
-        if diff < min_diff and diff <= tolerance:
-            min_diff = diff
-            best_msg = msg
-            
-    return best_msg
+            out.write(draw_overlay(img, scenario, vehicle_state))
+            frame_count += 1
+
+    if out:
+        out.release()
+    return frame_count
 
 if __name__ == '__main__':
     try:
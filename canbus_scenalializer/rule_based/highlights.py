@@ -0,0 +1,145 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+from video_output import FramePrefetcher, draw_overlay, open_video_writer
+
+HIGHLIGHTS_VIDEO = 'highlights.mp4'
+HIGHLIGHTS_INDEX = 'highlights.json'
+
+# Scenarios worth reviewing whenever they occur
+RARE_SCENARIOS = ('U-Turn', 'Reverse', 'Pull Over')
+
+def select_highlights(scenarios, window=2, rare=RARE_SCENARIOS):
+    """
+    Select the sample windows of one scene worth reviewing.
+
+    An event is a label transition (sample i has a different scenario than i-1)
+    or a sample of a rare scenario. Each event covers samples [i - window, i + window];
+    overlapping or adjacent windows are merged.
+
+    Args:
+        scenarios (list of str): Per-sample scenario labels of the scene.
+        window (int): Samples kept before and after each event.
+        rare (tuple of str): Rare scenarios.
+
+    Returns:
+        list of dict: {"start", "end" (exclusive sample indices), "events"}. Events are
+                      {"index", "type": "transition", "from", "to"} or {"index", "type": "rare", "scenario"}.
+    """
+    n = len(scenarios)
+    if n == 0:
+        return []
+    labels = np.asarray(scenarios, dtype=object)
+    transition = np.zeros(n, dtype=bool)
+    transition[1:] = labels[1:] != labels[:-1]
+    is_rare = np.isin(labels, list(rare))
+    event_idx = np.flatnonzero(transition | is_rare)
+    if len(event_idx) == 0:
+        return []
+
+    # Coverage of all event windows through a difference array
+    coverage = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(coverage, np.maximum(event_idx - window, 0), 1)
+    np.add.at(coverage, np.minimum(event_idx + window + 1, n), -1)
+    covered = np.cumsum(coverage[:-1]) > 0
+    edges = np.diff(np.concatenate(([0], covered.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    highlights = []
+    for start, end in zip(starts, ends):
+        events = []
+        for i in event_idx[(event_idx >= start) & (event_idx < end)]:
+            if transition[i]:
+                events.append({"index": int(i), "type": "transition", "from": scenarios[i - 1], "to": scenarios[i]})
+            # A rare run is reported once, at its first sample
+            if is_rare[i] and (i == 0 or transition[i]):
+                events.append({"index": int(i), "type": "rare", "scenario": scenarios[i]})
+        highlights.append({"start": int(start), "end": int(end), "events": events})
+    return highlights
+
+def write_highlight_reel(output_dir, scenes, video, window=2, rare=RARE_SCENARIOS, fps=2):
+    """
+    Render the highlight windows of all scenes into one review video plus a JSON index.
+
+    Only the frames inside a window are decoded and encoded.
+
+    Args:
+        output_dir (str): Directory of highlights.mp4 and highlights.json.
+        scenes (list of dict): Per scene: scene_name, scene_token, samples (sample_token,
+                               timestamp, im_path), scenarios, vehicle_states.
+        video (dict): Video options (encoder, ffmpeg_threads, prefetch), see generate_demo_scenes.py.
+        window (int): Samples kept before and after each event.
+        rare (tuple of str): Rare scenarios.
+        fps (float): Frame rate of the reel.
+
+    Returns:
+        tuple: (index path, number of frames rendered, number of samples in all scenes)
+    """
+    # Frames to render, in reel order, plus the index entries
+    frames = []
+    index = []
+    for scene in scenes:
+        samples = scene['samples']
+        for h in select_highlights(scene['scenarios'], window, rare):
+            reason = ", ".join(
+                f"{e['from']} -> {e['to']}" if e['type'] == 'transition' else e['scenario'] for e in h['events'])
+            entry = {
+                "scene_name": scene['scene_name'],
+                "scene_token": scene['scene_token'],
+                "start_utime": samples[h['start']]['timestamp'],
+                "end_utime": samples[h['end'] - 1]['timestamp'],
+                "sample_tokens": [s['sample_token'] for s in samples[h['start']:h['end']]],
+                "events": [dict(e, timestamp=samples[e['index']]['timestamp'], sample_token=samples[e['index']]['sample_token'])
+                           for e in h['events']],
+                "video_start_frame": len(frames),
+            }
+            for i in range(h['start'], h['end']):
+                if not os.path.exists(samples[i]['im_path']):
+                    print(f"Image not found: {samples[i]['im_path']}")
+                    continue
+                frames.append((samples[i]['im_path'], scene['scenarios'][i], scene['vehicle_states'][i],
+                               f"{scene['scene_name']}: {reason}"))
+            entry["video_end_frame"] = len(frames)
+            index.append(entry)
+
+    os.makedirs(output_dir, exist_ok=True)
+    out = None
+    size = None
+    written = 0
+    # Frames written before each planned frame, to map the index onto the actual video
+    offsets = [0]
+    with FramePrefetcher([f[0] for f in frames], depth=video['prefetch']) as images:
+        for (im_path, img), (_, scenario, vehicle_state, title) in zip(images, frames):
+            if img is None:
+                # Unreadable file: a black frame once the size is known, else it is dropped (see offsets)
+                print(f"Could not read image: {im_path}")
+                if size is None:
+                    offsets.append(written)
+                    continue
+                img = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+            if out is None:
+                size = (img.shape[1], img.shape[0])
+                out = open_video_writer(os.path.join(output_dir, HIGHLIGHTS_VIDEO), fps, size,
+                                        video['encoder'], video['ffmpeg_threads'])
+            elif (img.shape[1], img.shape[0]) != size:
+                img = cv2.resize(img, size)
+            out.write(draw_overlay(img, scenario, vehicle_state, title))
+            written += 1
+            offsets.append(written)
+    if out:
+        out.release()
+
+    # Unreadable frames before the first readable one are not in the video
+    for entry in index:
+        entry["video_start_frame"] = offsets[entry["video_start_frame"]]
+        entry["video_end_frame"] = offsets[entry["video_end_frame"]]
+        entry["video_start_sec"] = entry["video_start_frame"] / fps
+        entry["video_end_sec"] = entry["video_end_frame"] / fps
+
+    index_path = os.path.join(output_dir, HIGHLIGHTS_INDEX)
+    with open(index_path, 'w') as f:
+        json.dump({"fps": fps, "window": window, "rare_scenarios": list(rare), "highlights": index}, f, indent=2)
+    return index_path, written, sum(len(scene['samples']) for scene in scenes)
@@ -0,0 +1,370 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# Add current directory to sys.path to allow importing local modules
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.append(current_dir)
+
+from clips import read_clip_table
+
+# Label of the extra bin every axis has for missing or out-of-range values
+UNKNOWN = 'unknown'
+
+# Joint tables up to this many bins are counted densely with np.bincount, larger ones sparsely
+DENSE_LIMIT = 1 << 24
+
+class Axis:
+    """
+    One scenario axis: maps a clip table column to bin indices.
+
+    Bin i < len(labels) is a regular bin, bin len(labels) is UNKNOWN (missing value,
+    unexpected category or a value outside the numeric range).
+    """
+
+    def __init__(self, name, column, labels, edges=None, scale=1.0, keywords=None):
+        """
+        Args:
+            name (str): Axis name.
+            column (str): Clip table column.
+            labels (tuple of str): Bin labels.
+            edges (tuple of float, optional): Numeric axis: inner bin edges (len(labels) - 1 values,
+                                              a bin includes its lower edge).
+            scale (float): Numeric axis: factor applied before binning (e.g. 3.6 for m/s -> km/h).
+            keywords (dict, optional): Text axis: label -> tuple of keywords that must all appear
+                                       (case-insensitive); the first matching label wins.
+        """
+        self.name = name
+        self.column = column
+        self.labels = tuple(labels)
+        self.edges = None if edges is None else np.asarray(edges, dtype=np.float64)
+        self.scale = scale
+        self.keywords = keywords
+        if self.edges is not None and len(self.edges) != len(self.labels) - 1:
+            raise ValueError(f"Axis {name}: {len(self.labels)} labels need {len(self.labels) - 1} edges")
+
+    @property
+    def size(self):
+        return len(self.labels) + 1
+
+    @property
+    def all_labels(self):
+        return self.labels + (UNKNOWN,)
+
+    def encode(self, values):
+        """
+        Bin index of each value.
+
+        Args:
+            values (list or np.ndarray): Column values.
+
+        Returns:
+            np.ndarray: int64 bin indices in [0, size).
+        """
+        unknown = len(self.labels)
+        if self.edges is not None:
+            x = np.array([np.nan if v is None else v for v in values], dtype=np.float64) \
+                if isinstance(values, list) else np.asarray(values, dtype=np.float64)
+            codes = np.searchsorted(self.edges, x * self.scale, side='right')
+            codes[~np.isfinite(x)] = unknown
+            return codes.astype(np.int64)
+
+        # Categorical / text: each distinct value is resolved once (scene descriptions repeat per clip)
+        lookup = {}
+
+        def category(value):
+            if value not in lookup:
+                lookup[value] = self._category('' if value is None else str(value))
+            return lookup[value]
+
+        return np.fromiter((category(value) for value in values), dtype=np.int64, count=len(values))
+
+    def _category(self, value):
+        if value == '':
+            return len(self.labels)
+        if self.keywords is None:
+            return self.labels.index(value) if value in self.labels else len(self.labels)
+        text = value.lower()
+        for label, words in self.keywords.items():
+            if all(word in text for word in words):
+                return self.labels.index(label)
+        return len(self.labels)
+
+# Scenario axes of the strategy doc (docs/high_level_strategy_and_structure.md, step 1)
+DEFAULT_AXES = (
+    Axis('weather', 'description', ('night_rain', 'rain', 'night', 'day'),
+         keywords={'night_rain': ('night', 'rain'), 'rain': ('rain',), 'night': ('night',), 'day': ()}),
+    Axis('road_type', 'road_type', ('road_segment', 'intersection', 'lane_connector', 'carpark_area', 'other')),
+    Axis('speed', 'mean_speed', ('stop', 'low', 'mid', 'high'), edges=(1, 30, 60), scale=3.6),  # km/h
+    Axis('yaw_rate', 'max_abs_yaw_rate', ('straight', 'curve', 'sharp'), edges=(0.1, 0.3)),  # rad/s
+    Axis('pedestrians', 'ann_pedestrian_max', ('0', '1-2', '3+'), edges=(1, 3)),
+)
+
+class ScenarioHistogram:
+    """
+    Multi-dimensional histogram over scenario axes.
+
+    Each clip's bin indices are packed into one mixed-radix integer key
+    (np.ravel_multi_index over the axis sizes). The joint histogram is kept
+    sparse: sorted non-empty keys and their counts. Marginals and cross tabs
+    are derived from it without touching the clips again, and histograms of
+    disjoint batches (workers, ingestion runs) merge by adding counts.
+    """
+
+    def __init__(self, axis_names, axis_labels, keys=None, counts=None):
+        """
+        Args:
+            axis_names (list of str): Axis names.
+            axis_labels (list of tuple): Bin labels per axis (including UNKNOWN).
+            keys (np.ndarray, optional): Sorted unique joint keys.
+            counts (np.ndarray, optional): Count of each key.
+        """
+        self.axis_names = list(axis_names)
+        self.axis_labels = [tuple(labels) for labels in axis_labels]
+        self.sizes = tuple(len(labels) for labels in self.axis_labels)
+        if np.prod(self.sizes, dtype=np.float64) >= np.iinfo(np.int64).max:
+            raise ValueError(f"Too many joint bins for int64 keys: {self.sizes}")
+        self.keys = np.zeros(0, dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def for_axes(cls, axes):
+        return cls([axis.name for axis in axes], [axis.all_labels for axis in axes])
+
+    @property
+    def num_bins(self):
+        return int(np.prod(self.sizes, dtype=np.int64))
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def encode(self, codes):
+        """
+        Joint keys of per-axis bin indices.
+
+        Args:
+            codes (np.ndarray): (N, D) bin indices, columns in axis order.
+
+        Returns:
+            np.ndarray: (N,) int64 keys.
+        """
+        codes = np.asarray(codes, dtype=np.int64).reshape(-1, len(self.sizes))
+        return np.ravel_multi_index(tuple(codes.T), self.sizes).astype(np.int64)
+
+    def decode(self, keys):
+        """
+        Inverse of encode: (N, D) bin indices of joint keys.
+        """
+        return np.stack(np.unravel_index(np.asarray(keys, dtype=np.int64), self.sizes), axis=1)
+
+    def add_keys(self, keys):
+        """
+        Count a batch of joint keys into the histogram.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(keys) == 0:
+            return self
+        if self.num_bins <= DENSE_LIMIT:
+            dense = np.bincount(keys, minlength=self.num_bins)
+            batch_keys = np.flatnonzero(dense)
+            batch_counts = dense[batch_keys]
+        else:
+            batch_keys, batch_counts = np.unique(keys, return_counts=True)
+        self._accumulate(batch_keys, batch_counts)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram over the same axes (e.g. a worker's partial result).
+        """
+        if other.axis_names != self.axis_names or other.axis_labels != self.axis_labels:
+            raise ValueError(f"Cannot merge histograms over different axes: {self.axis_names} vs {other.axis_names}")
+        self._accumulate(other.keys, other.counts)
+        return self
+
+    def _accumulate(self, keys, counts):
+        all_keys = np.concatenate((self.keys, keys))
+        all_counts = np.concatenate((self.counts, counts))
+        self.keys, inverse = np.unique(all_keys, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=all_counts, minlength=len(self.keys)).astype(np.int64)
+
+    def count(self, keys):
+        """
+        Joint count of each key (0 for empty bins), e.g. N_bin per clip for sampling weights.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        return np.where(self.keys[idx] == keys, self.counts[idx], 0)
+
+    def crosstab(self, axes):
+        """
+        Dense count table over a subset of axes, summed from the joint histogram.
+
+        Args:
+            axes (list of str): Axis names (1 for a marginal, 2-3 for cross tabs).
+
+        Returns:
+            np.ndarray: Counts with one dimension per axis, in the given order.
+        """
+        positions = [self.axis_names.index(name) for name in axes]
+        sub_sizes = tuple(self.sizes[p] for p in positions)
+        coords = np.unravel_index(self.keys, self.sizes)
+        sub_keys = np.ravel_multi_index(tuple(coords[p] for p in positions), sub_sizes)
+        table = np.bincount(sub_keys, weights=self.counts, minlength=int(np.prod(sub_sizes, dtype=np.int64)))
+        return table.astype(np.int64).reshape(sub_sizes)
+
+    def marginal(self, axis):
+        return self.crosstab([axis])
+
+    def summary(self, rare_threshold=10):
+        """
+        Summary metrics of the joint histogram (Issue 0004, step 2).
+
+        Returns:
+            dict: total, num_bins, nonzero_bins, zero_bins, mean/var of the counts over all bins,
+                  rare_bins (non-empty bins below rare_threshold) and their share of the clips.
+        """
+        num_bins = self.num_bins
+        total = self.total
+        mean = total / num_bins
+        # Variance over all bins, empty ones included
+        var = (np.sum(self.counts.astype(np.float64) ** 2) / num_bins) - mean ** 2
+        rare = self.counts < rare_threshold
+        return {
+            "total": total,
+            "num_bins": num_bins,
+            "nonzero_bins": len(self.keys),
+            "zero_bins": num_bins - len(self.keys),
+            "mean_count": mean,
+            "var_count": var,
+            "rare_bins": int(np.count_nonzero(rare)),
+            "rare_share": float(self.counts[rare].sum() / total) if total else 0.0,
+        }
+
+    def save(self, path):
+        """
+        Save as NPZ: axis names, all bin labels concatenated with the axis sizes, keys and counts.
+        """
+        np.savez(path, axis_names=np.array(self.axis_names), sizes=np.array(self.sizes, dtype=np.int64),
+                 labels=np.array([label for labels in self.axis_labels for label in labels]),
+                 keys=self.keys, counts=self.counts)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            bounds = np.cumsum(data['sizes'])[:-1]
+            labels = [tuple(str(label) for label in part) for part in np.split(data['labels'], bounds)]
+            return cls([str(name) for name in data['axis_names']], labels, data['keys'], data['counts'])
+
+def encode_clips(table, axes=DEFAULT_AXES):
+    """
+    Per-axis bin indices of a clip table.
+
+    Args:
+        table (dict): Clip table columns (read_clip_table).
+        axes (tuple of Axis): Scenario axes.
+
+    Returns:
+        np.ndarray: (N, D) int64 bin indices. Columns missing from the table are all UNKNOWN.
+    """
+    num_rows = len(next(iter(table.values()))) if table else 0
+    codes = np.empty((num_rows, len(axes)), dtype=np.int64)
+    for d, axis in enumerate(axes):
+        if axis.column in table:
+            codes[:, d] = axis.encode(table[axis.column])
+        else:
+            print(f"Column {axis.column} not in the clip table, axis {axis.name} is all '{UNKNOWN}'")
+            codes[:, d] = len(axis.labels)
+    return codes
+
+def format_table(hist, axes):
+    """
+    Text rendering of a marginal (1 axis) or cross tab (2 axes; 3 axes as one 2-axis table per bin of the first).
+    """
+    table = hist.crosstab(axes)
+    labels = [hist.axis_labels[hist.axis_names.index(name)] for name in axes]
+    lines = []
+    if len(axes) == 1:
+        width = max(len(label) for label in labels[0])
+        for label, count in zip(labels[0], table):
+            lines.append(f"  {label:<{width}} {count:>9} ({count / max(hist.total, 1):6.2%})")
+        return lines
+    if len(axes) == 3:
+        for label, sub in zip(labels[0], table):
+            lines.append(f"  {axes[0]} = {label}:")
+            lines.extend("  " + line for line in _format_2d(sub, labels[1], labels[2], axes[1], axes[2]))
+        return lines
+    return _format_2d(table, labels[0], labels[1], axes[0], axes[1])
+
+def _format_2d(table, row_labels, col_labels, row_name, col_name):
+    header = f"{row_name} / {col_name}"
+    width = max(len(label) for label in tuple(row_labels) + (header,))
+    col_width = max(max(len(label) for label in col_labels), 7)
+    lines = [f"  {header:<{width}} " + " ".join(f"{label:>{col_width}}" for label in col_labels)]
+    for label, row in zip(row_labels, table):
+        lines.append(f"  {label:<{width}} " + " ".join(f"{count:>{col_width}}" for count in row))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Scenario-vector histograms of a clip table (Issue 0004).")
+    parser.add_argument('--clips', type=str, nargs='*', default=[],
+                        help='Clip tables (clips.py output); each one is counted as a separate batch')
+    parser.add_argument('--merge', type=str, nargs='*', default=[], help='Partial histograms (.npz) to merge in')
+    parser.add_argument('--output', type=str, default=None, help='Save the joint histogram (.npz) for later merging/sampling')
+    parser.add_argument('--cross', type=str, action='append', default=[],
+                        help="Comma-separated 2-3 axes to cross-tabulate, e.g. 'weather,road_type' (repeatable)")
+    parser.add_argument('--rare_threshold', type=int, default=10, help='Non-empty bins with fewer clips are reported as rare')
+    args = parser.parse_args()
+
+    start_t = time.time()
+    hist = ScenarioHistogram.for_axes(DEFAULT_AXES)
+    for path in args.clips:
+        table = read_clip_table(path)
+        if 'valid' in table:
+            valid = np.asarray(table['valid'], dtype=bool)
+            print(f"{path}: {len(valid)} clips, {np.count_nonzero(~valid)} invalid clips skipped")
+            table = {name: [v for v, ok in zip(values, valid) if ok] for name, values in table.items()}
+        codes = encode_clips(table)
+        for d, axis in enumerate(DEFAULT_AXES):
+            unknown = np.count_nonzero(codes[:, d] == len(axis.labels))
+            if unknown:
+                print(f"  {axis.name}: {unknown} clips without a valid '{axis.column}' value")
+        hist.add_keys(hist.encode(codes))
+    for path in args.merge:
+        hist.merge(ScenarioHistogram.load(path))
+    if hist.total == 0:
+        print("No clips.")
+        return
+    print(f"Histogram of {hist.total} clips in {time.time() - start_t:.2f} seconds")
+
+    summary = hist.summary(args.rare_threshold)
+    print(f"\nJoint bins: {summary['num_bins']} ({summary['nonzero_bins']} non-empty, {summary['zero_bins']} empty)")
+    print(f"  Count per bin: mean {summary['mean_count']:.2f}, variance {summary['var_count']:.2f}")
+    print(f"  Rare bins (< {args.rare_threshold} clips): {summary['rare_bins']}, holding {summary['rare_share']:.2%} of the clips")
+
+    for name in hist.axis_names:
+        print(f"\n{name}:")
+        print("\n".join(format_table(hist, [name])))
+    for cross in args.cross:
+        axes = [name.strip() for name in cross.split(',') if name.strip()]
+        unknown_axes = [name for name in axes if name not in hist.axis_names]
+        if unknown_axes:
+            print(f"\nSkipping --cross {cross}: unknown axes {unknown_axes} (axes: {', '.join(hist.axis_names)})")
+            continue
+        print(f"\n{' x '.join(axes)}:")
+        print("\n".join(format_table(hist, axes)))
+
+    if args.output:
+        hist.save(args.output)
+        print(f"\nHistogram saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
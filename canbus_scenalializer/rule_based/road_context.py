@@ -0,0 +1,165 @@
+import numpy as np
+
+# Road context tags, one bit each in a tag mask (bit i = ROAD_TAGS[i])
+ROAD_TAGS = ('road_segment', 'intersection', 'lane_connector', 'stop_line', 'ped_crossing', 'carpark_area')
+ROAD_TAG_BITS = {tag: 1 << i for i, tag in enumerate(ROAD_TAGS)}
+
+# Map layers providing the tags (road_segment records with is_intersection become 'intersection')
+MAP_LAYERS = ('road_segment', 'lane_connector', 'stop_line', 'ped_crossing', 'carpark_area')
+
+# Polygons grown by this many meters, so that "near the stop line" matches before the line itself
+LAYER_BUFFERS = {'stop_line': 5.0}
+
+# Clip road_type by priority: the first tag covering at least `min_ratio` of the clip's poses
+ROAD_TYPE_PRIORITY = ('intersection', 'lane_connector', 'road_segment', 'carpark_area')
+
+def tags_from_mask(mask):
+    """
+    Tag names of one tag mask.
+    """
+    return [tag for tag in ROAD_TAGS if int(mask) & ROAD_TAG_BITS[tag]]
+
+class RoadContextTagger:
+    """
+    Tags ego positions with the nuScenes map layers they lie on.
+
+    Per location, the map polygons are loaded once and put into an STRtree.
+    A batch of positions is quantized to `resolution` meters; only cells that are
+    not cached yet are evaluated, by one tree query with their bounding box and
+    one vectorized point-in-polygon test per candidate polygon, instead of one
+    NuScenesMap.layers_on_point call per pose.
+    """
+
+    def __init__(self, dataroot, resolution=0.5, buffers=None):
+        """
+        Args:
+            dataroot (str): NuScenes data root (containing maps/expansion).
+            resolution (float): Cache cell size in meters (positions are tagged at their cell center).
+            buffers (dict, optional): Layer -> buffer distance in meters (default: LAYER_BUFFERS).
+        """
+        self.dataroot = dataroot
+        self.resolution = resolution
+        self.buffers = LAYER_BUFFERS if buffers is None else buffers
+        self._maps = {}
+        self._cache = {}
+
+    def tag(self, location, xy):
+        """
+        Tag masks of a batch of map-frame positions.
+
+        Args:
+            location (str): Map location (log.location, e.g. "singapore-onenorth").
+            xy (array-like): (N, 2+) positions in meters; rows with NaN get mask 0.
+
+        Returns:
+            np.ndarray: (N,) int64 tag masks (see ROAD_TAG_BITS), all 0 if the map can't be loaded.
+        """
+        xy = np.asarray(xy, dtype=np.float64)
+        if len(xy) == 0:
+            return np.zeros(0, dtype=np.int64)
+        xy = xy.reshape(len(xy), -1)[:, :2]
+        masks = np.zeros(len(xy), dtype=np.int64)
+        finite = np.all(np.isfinite(xy), axis=1)
+        if not np.any(finite) or self._load(location) is None:
+            return masks
+
+        cells, inverse = np.unique(np.round(xy[finite] / self.resolution).astype(np.int64), axis=0, return_inverse=True)
+        cache = self._cache[location]
+        cell_masks = np.array([cache.get((x, y), -1) for x, y in cells.tolist()], dtype=np.int64)
+        missing = cell_masks < 0
+        if np.any(missing):
+            cell_masks[missing] = self._query(location, cells[missing] * self.resolution)
+            cache.update(zip(map(tuple, cells[missing].tolist()), cell_masks[missing].tolist()))
+        masks[finite] = cell_masks[inverse.ravel()]
+        return masks
+
+    def _load(self, location):
+        """
+        Polygons, tag bits and STRtree of a location (None if the map is not available).
+        """
+        if location in self._maps:
+            return self._maps[location]
+        from nuscenes.map_expansion.map_api import NuScenesMap
+        from shapely.strtree import STRtree
+
+        try:
+            nusc_map = NuScenesMap(dataroot=self.dataroot, map_name=location)
+        except Exception as e:
+            print(f"Map {location} not available, road context tags are left empty: {e}")
+            self._maps[location] = None
+            self._cache[location] = {}
+            return None
+
+        geoms = []
+        bits = []
+        for layer in MAP_LAYERS:
+            for record in getattr(nusc_map, layer):
+                polygon = nusc_map.extract_polygon(record['polygon_token'])
+                if layer in self.buffers:
+                    polygon = polygon.buffer(self.buffers[layer])
+                tag = 'intersection' if layer == 'road_segment' and record.get('is_intersection') else layer
+                geoms.append(polygon)
+                bits.append(ROAD_TAG_BITS[tag])
+        self._maps[location] = {
+            "geoms": geoms,
+            "bits": np.array(bits, dtype=np.int64),
+            "tree": STRtree(geoms),
+            # Shapely < 2 returns geometries from STRtree.query instead of indices
+            "ids": {id(geom): i for i, geom in enumerate(geoms)},
+        }
+        self._cache[location] = {}
+        return self._maps[location]
+
+    def _query(self, location, points):
+        """
+        Tag masks of (M, 2) points, evaluated against the map polygons.
+        """
+        from shapely import vectorized
+        from shapely.geometry import box
+
+        loaded = self._maps[location]
+        masks = np.zeros(len(points), dtype=np.int64)
+        x, y = points[:, 0], points[:, 1]
+        # One tree query for the whole batch; candidates are then tested against all points at once
+        hits = loaded["tree"].query(box(x.min(), y.min(), x.max(), y.max()))
+        for hit in hits:
+            i = int(hit) if isinstance(hit, (int, np.integer)) else loaded["ids"][id(hit)]
+            geom = loaded["geoms"][i]
+            min_x, min_y, max_x, max_y = geom.bounds
+            near = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+            if not np.any(near):
+                continue
+            inside = np.zeros(len(points), dtype=bool)
+            inside[near] = vectorized.contains(geom, x[near], y[near])
+            masks[inside] |= loaded["bits"][i]
+        return masks
+
+def clip_road_columns(utime, masks, starts, ends, min_ratio=0.2):
+    """
+    Road context of clips from the tag masks of the poses within them.
+
+    Args:
+        utime (np.ndarray): Sorted pose timestamps (microseconds).
+        masks (np.ndarray): Tag mask of each pose (RoadContextTagger.tag).
+        starts, ends (np.ndarray): Clip windows [start, end) in microseconds.
+        min_ratio (float): Share of poses a tag needs to become the clip's road_type.
+
+    Returns:
+        dict: <tag>_ratio per ROAD_TAGS (NaN without poses) and road_type
+              (first tag of ROAD_TYPE_PRIORITY with at least min_ratio, 'other' or '' without poses).
+    """
+    lo = np.searchsorted(utime, starts, side='left')
+    hi = np.searchsorted(utime, ends, side='left')
+    count = hi - lo
+    columns = {}
+    for tag in ROAD_TAGS:
+        # Share of poses with the tag, via a cumulative count
+        ccount = np.concatenate(([0], np.cumsum((masks & ROAD_TAG_BITS[tag]) != 0)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns[f"{tag}_ratio"] = np.where(count > 0, (ccount[hi] - ccount[lo]) / np.maximum(count, 1), np.nan)
+
+    road_type = np.where(count > 0, 'other', '').astype(object)
+    for tag in reversed(ROAD_TYPE_PRIORITY):
+        road_type[columns[f"{tag}_ratio"] >= min_ratio] = tag
+    columns['road_type'] = road_type.tolist()
+    return columns
@@ -0,0 +1,151 @@
+import json
+import os
+
+import numpy as np
+
+from classifier import SCENARIO_LABELS, LABEL_IDS
+from road_context import ROAD_TAG_BITS, tags_from_mask
+
+SEGMENTS_FILENAME = 'classification_segments.json'
+STATES_FILENAME = 'vehicle_states.npz'
+
+# Integer-valued vehicle_state fields (everything else is stored as float64)
+INT_STATE_KEYS = ('turn_signal',)
+# Placeholder for a missing integer field in the sidecar (missing floats are NaN)
+MISSING_INT = -1
+
+def encode_runs(samples):
+    """
+    Run-length encode per-sample classification results.
+
+    Args:
+        samples (list of dict): `samples` list of classification_results.json.
+
+    Returns:
+        list of dict: One entry per run of identical consecutive scenarios with
+                      start/end utime, scenario_id, sample range and summary stats.
+    """
+    runs = []
+    start = 0
+    for i in range(1, len(samples) + 1):
+        if i < len(samples) and samples[i]['scenario'] == samples[start]['scenario']:
+            continue
+        run_samples = samples[start:i]
+        states = [s['vehicle_state'] for s in run_samples]
+        speeds = [st['speed'] for st in states if 'speed' in st]
+        steerings = [abs(st['steering_angle']) for st in states if 'steering_angle' in st]
+        yaw_rates = [abs(st['yaw_rate']) for st in states if 'yaw_rate' in st]
+        runs.append({
+            "start_utime": run_samples[0]['timestamp'],
+            "end_utime": run_samples[-1]['timestamp'],
+            "scenario_id": LABEL_IDS.get(run_samples[0]['scenario'], -1),
+            "scenario": run_samples[0]['scenario'],
+            "start_index": start,
+            "num_samples": len(run_samples),
+            "mean_speed": float(np.mean(speeds)) if speeds else None,
+            "max_speed": float(np.max(speeds)) if speeds else None,
+            "max_abs_steering": float(np.max(steerings)) if steerings else None,
+            "max_abs_yaw_rate": float(np.max(yaw_rates)) if yaw_rates else None,
+        })
+        start = i
+    return runs
+
+def write_segments(scene_output_dir, classification_data):
+    """
+    Write a scene in the compact format: label runs (JSON) + columnar vehicle states (NPZ sidecar).
+
+    Args:
+        scene_output_dir (str): Scene output directory.
+        classification_data (dict): Scene results in the classification_results.json schema.
+
+    Returns:
+        tuple: (segments path, sidecar path)
+    """
+    samples = classification_data['samples']
+    state_keys = []
+    for s in samples:
+        for key in s['vehicle_state']:
+            if key not in state_keys:
+                state_keys.append(key)
+
+    columns = {
+        'sample_token': np.array([s['sample_token'] for s in samples], dtype=str),
+        'timestamp': np.array([s['timestamp'] for s in samples], dtype=np.int64),
+    }
+    for key in state_keys:
+        if key in INT_STATE_KEYS:
+            columns[f'state.{key}'] = np.array([s['vehicle_state'].get(key, MISSING_INT) for s in samples], dtype=np.int64)
+        else:
+            columns[f'state.{key}'] = np.array([s['vehicle_state'].get(key, np.nan) for s in samples], dtype=np.float64)
+
+    if samples and 'road_tags' in samples[0]:
+        # Road context tags (generate_demo_scenes.py --road_context) as one bitmask per sample
+        columns['road_mask'] = np.array([sum(ROAD_TAG_BITS[tag] for tag in s['road_tags']) for s in samples], dtype=np.int64)
+
+    states_path = os.path.join(scene_output_dir, STATES_FILENAME)
+    np.savez_compressed(states_path, **columns)
+
+    segments = {
+        "scene_token": classification_data['scene_token'],
+        "scene_name": classification_data['scene_name'],
+        "labels": list(SCENARIO_LABELS),
+        "num_samples": len(samples),
+        "state_keys": state_keys,
+        "states_file": STATES_FILENAME,
+        "segments": encode_runs(samples),
+    }
+    segments_path = os.path.join(scene_output_dir, SEGMENTS_FILENAME)
+    with open(segments_path, 'w') as f:
+        json.dump(segments, f)
+    return segments_path, states_path
+
+def read_segments(scene_output_dir, expand=True):
+    """
+    Read a scene written by write_segments.
+
+    Args:
+        scene_output_dir (str): Scene output directory.
+        expand (bool): Expand the runs back into the classification_results.json schema.
+                       If False, only the segments JSON is returned (the sidecar is not read).
+
+    Returns:
+        dict: Scene results (expanded) or the raw segments document.
+    """
+    with open(os.path.join(scene_output_dir, SEGMENTS_FILENAME), 'r') as f:
+        segments = json.load(f)
+    if not expand:
+        return segments
+
+    with np.load(os.path.join(scene_output_dir, segments['states_file'])) as npz:
+        columns = {key: npz[key] for key in npz.files}
+
+    scenarios = [None] * segments['num_samples']
+    for run in segments['segments']:
+        for i in range(run['start_index'], run['start_index'] + run['num_samples']):
+            scenarios[i] = run['scenario']
+
+    samples = []
+    for i in range(segments['num_samples']):
+        vehicle_state = {}
+        for key in segments['state_keys']:
+            value = columns[f'state.{key}'][i]
+            if key in INT_STATE_KEYS:
+                if value != MISSING_INT:
+                    vehicle_state[key] = int(value)
+            elif not np.isnan(value):
+                vehicle_state[key] = float(value)
+        sample = {
+            "sample_token": str(columns['sample_token'][i]),
+            "timestamp": int(columns['timestamp'][i]),
+            "scenario": scenarios[i],
+            "vehicle_state": vehicle_state,
+        }
+        if 'road_mask' in columns:
+            sample["road_tags"] = tags_from_mask(columns['road_mask'][i])
+        samples.append(sample)
+
+    return {
+        "scene_token": segments['scene_token'],
+        "scene_name": segments['scene_name'],
+        "samples": samples,
+    }
@@ -0,0 +1,155 @@
+import heapq
+import math
+from collections import deque
+
+from classifier import RuleBasedClassifier
+from can_index import monitor_turn_signal
+
+# Defaults for the temporal state, can be overridden by a `streaming:` section in config.yaml
+STREAMING_DEFAULTS = {
+    'accel_window_us': 500000,   # Speed history used to derive acceleration (microseconds)
+    'accel_history': 64,         # Ring buffer capacity (pose messages); bounds memory
+    'yaw_rate_alpha': 0.2,       # EMA factor for yaw-rate smoothing (1.0 = no smoothing)
+    'signal_debounce': 3,        # Consecutive vehicle_monitor messages before a signal change is accepted
+    'max_steer_age_us': 50000,   # Steering older than this is treated as missing
+    'max_signal_age_us': 1000000, # vehicle_monitor is ~2Hz, so the signal is held longer
+}
+
+class StreamingScenarioClassifier:
+    """
+    Online scenario classifier over a timestamp-ordered CAN message stream.
+
+    Messages are pushed one at a time (or in micro-batches). The state is O(1):
+    a fixed-size ring buffer of recent speeds (for acceleration), an EMA of the
+    yaw rate, the latest steering value and a debounced turn signal. Every pose
+    message emits one label, computed only from messages seen so far, so the
+    latency is bounded by one pose period.
+
+    The rules themselves are RuleBasedClassifier._classify_frame; this class
+    only fills in the fields that need history ('acceleration' in particular).
+    """
+
+    def __init__(self, config_path, **overrides):
+        self.classifier = RuleBasedClassifier(config_path)
+        params = dict(STREAMING_DEFAULTS)
+        params.update(self.classifier.config.get('streaming') or {})
+        params.update(overrides)
+        self.params = params
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all temporal state (e.g. at a scene boundary).
+        """
+        self._speed_history = deque(maxlen=self.params['accel_history'])
+        self._yaw_rate = None
+        self._steer = None
+        self._signal = 0
+        self._signal_candidate = 0
+        self._signal_count = 0
+        self._signal_utime = None
+        self._last_utime = None
+
+    def push(self, channel, msg):
+        """
+        Consume one CAN message.
+
+        Args:
+            channel (str): 'pose', 'steeranglefeedback' or 'vehicle_monitor' (others are ignored).
+            msg (dict): CAN message with 'utime'.
+
+        Returns:
+            dict or None: For pose messages, {'utime', 'scenario', 'vehicle_state'}; otherwise None.
+        """
+        utime = msg['utime']
+        if self._last_utime is not None and utime < self._last_utime:
+            raise ValueError(f"Out-of-order CAN message on {channel}: {utime} < {self._last_utime}")
+        self._last_utime = utime
+
+        if channel == 'steeranglefeedback':
+            self._steer = (utime, msg['value'])
+        elif channel == 'vehicle_monitor':
+            self._update_signal(utime, monitor_turn_signal(msg))
+        elif channel == 'pose':
+            return self._on_pose(utime, msg)
+        return None
+
+    def push_batch(self, messages):
+        """
+        Consume a micro-batch of (channel, msg) pairs in timestamp order.
+
+        Returns:
+            list of dict: Emitted labels, in order.
+        """
+        out = []
+        for channel, msg in messages:
+            result = self.push(channel, msg)
+            if result is not None:
+                out.append(result)
+        return out
+
+    def _update_signal(self, utime, signal):
+        # A new signal value only takes effect after `signal_debounce` consecutive messages
+        if signal == self._signal_candidate:
+            self._signal_count += 1
+        else:
+            self._signal_candidate = signal
+            self._signal_count = 1
+        if self._signal_count >= self.params['signal_debounce']:
+            self._signal = self._signal_candidate
+        self._signal_utime = utime
+
+    def _on_pose(self, utime, msg):
+        vel = msg['vel'] # [vx, vy, vz]
+        speed = math.sqrt(vel[0] ** 2 + vel[1] ** 2)
+        yaw_rate = msg['rotation_rate'][2] # [rx, ry, rz]
+
+        alpha = self.params['yaw_rate_alpha']
+        self._yaw_rate = yaw_rate if self._yaw_rate is None else alpha * yaw_rate + (1 - alpha) * self._yaw_rate
+
+        # Drop history older than the acceleration window, then differentiate against the oldest sample
+        history = self._speed_history
+        while history and utime - history[0][0] > self.params['accel_window_us']:
+            history.popleft()
+        acceleration = 0.0
+        if history and utime > history[0][0]:
+            t0, v0 = history[0]
+            acceleration = (speed - v0) / ((utime - t0) * 1e-6)
+        history.append((utime, speed))
+
+        state = {
+            'speed': speed,
+            'yaw_rate': self._yaw_rate,
+        }
+        if self._steer is not None and utime - self._steer[0] <= self.params['max_steer_age_us']:
+            state['steering_angle'] = self._steer[1]
+        if self._signal_utime is not None and utime - self._signal_utime <= self.params['max_signal_age_us']:
+            state['turn_signal'] = self._signal
+        else:
+            state['turn_signal'] = 0
+        state['acceleration'] = acceleration
+
+        return {
+            'utime': utime,
+            'scenario': self.classifier._classify_frame(state),
+            'vehicle_state': state,
+        }
+
+def merge_can_streams(channel_msgs):
+    """
+    Merge per-channel message lists into one timestamp-ordered (channel, msg) stream.
+
+    Args:
+        channel_msgs (dict): channel -> list of messages sorted by utime
+                             (e.g. from NuScenesCanBus.get_messages).
+
+    Returns:
+        iterator of (channel, msg)
+    """
+    streams = [_tag_channel(channel, msgs) for channel, msgs in channel_msgs.items()]
+    for _, channel, msg in heapq.merge(*streams, key=lambda item: item[0]):
+        yield channel, msg
+
+def _tag_channel(channel, msgs):
+    for msg in msgs:
+        yield msg['utime'], channel, msg
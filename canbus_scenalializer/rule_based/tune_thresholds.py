@@ -13,8 +13,12 @@ if current_dir not in sys.path:
     sys.path.append(current_dir)
 
 import glob
+from concurrent.futures import ProcessPoolExecutor
 
-def load_can_only_data(dataroot):
+from can_index import load_can_index
+from can_cache import CanBusCache
+
+def load_can_only_data(dataroot, max_samples=None):
     print(f"Scanning CAN bus data directly from {dataroot}...")
     can_bus_dir = os.path.join(dataroot, 'can_bus')
     if not os.path.exists(can_bus_dir):
@@ -33,36 +37,9 @@ def load_can_only_data(dataroot):
     print(f"Found {len(scene_names)} scenes in {can_bus_dir}")
     
     nusc_can = NuScenesCanBus(dataroot=dataroot)
-    
-    speeds = []
-    steerings = []
-    yaw_rates = []
-    
-    for scene_name in scene_names:
-        try:
-            # Get all pose messages for speed and yaw rate
-            pose_msgs = nusc_can.get_messages(scene_name, 'pose')
-            for msg in pose_msgs:
-                vel = msg['vel'] # [vx, vy, vz]
-                speed = np.linalg.norm([vel[0], vel[1]])
-                speeds.append(speed)
-                
-                rot_rate = msg['rotation_rate'] # [rx, ry, rz]
-                yaw_rate = abs(rot_rate[2])
-                yaw_rates.append(yaw_rate)
-                
-            # Get all steer messages
-            steer_msgs = nusc_can.get_messages(scene_name, 'steeranglefeedback')
-            for msg in steer_msgs:
-                steering = abs(msg['value'])
-                steerings.append(steering)
-        except Exception as e:
-            print(f"Error processing {scene_name}: {e}")
-            continue
-            
-    return np.array(speeds), np.array(steerings), np.array(yaw_rates)
+    return extract_can_arrays(nusc_can, scene_names, CanBusCache.open(dataroot), report_errors=True, max_samples=max_samples)
 
-def load_data(dataroot, version='v1.0-mini'):
+def load_data(dataroot, version='v1.0-mini', max_samples=None):
     print(f"Loading NuScenes from {dataroot}...")
     try:
         nusc = NuScenes(version=version, dataroot=dataroot, verbose=True)
@@ -70,39 +47,97 @@ def load_data(dataroot, version='v1.0-mini'):
     except Exception as e:
         print(f"NuScenes initialization failed: {e}")
         print("Falling back to CAN-only mode...")
-        return load_can_only_data(dataroot)
+        return load_can_only_data(dataroot, max_samples)
 
     nusc_can = NuScenesCanBus(dataroot=dataroot)
     
-    speeds = []
-    steerings = []
-    yaw_rates = []
-    
     print("Extracting CAN bus data...")
-    for scene_name in scenes:
+    return extract_can_arrays(nusc_can, scenes, CanBusCache.open(dataroot), max_samples=max_samples)
+
+def extract_can_arrays(nusc_can, scene_names, can_cache=None, report_errors=False, max_samples=None):
+    """
+    Collect speed, |steering| and |yaw rate| samples of all scenes in one streaming pass.
+
+    Each scene's arrays are fed into a reservoir sample of at most `max_samples`
+    values per signal, so memory stays bounded on trainval. When a signal has no
+    more than `max_samples` values in total, the result is the full data in
+    the original order. Reads the binary CAN cache when available (see can_cache.py),
+    otherwise the JSON files.
+    """
+    speeds = ReservoirSample(max_samples, seed=0)
+    steerings = ReservoirSample(max_samples, seed=1)
+    yaw_rates = ReservoirSample(max_samples, seed=2)
+    
+    for scene_name in scene_names:
         try:
-            # Get all pose messages for speed and yaw rate
-            pose_msgs = nusc_can.get_messages(scene_name, 'pose')
-            for msg in pose_msgs:
-                vel = msg['vel'] # [vx, vy, vz]
-                speed = np.linalg.norm([vel[0], vel[1]])
-                speeds.append(speed)
-                
-                rot_rate = msg['rotation_rate'] # [rx, ry, rz]
-                yaw_rate = abs(rot_rate[2])
-                yaw_rates.append(yaw_rate)
-                
-            # Get all steer messages
-            steer_msgs = nusc_can.get_messages(scene_name, 'steeranglefeedback')
-            for msg in steer_msgs:
-                steering = abs(msg['value'])
-                steerings.append(steering)
+            can_index = load_can_index(nusc_can, scene_name, ('pose', 'steeranglefeedback'), can_cache)
+            # pose gives speed and yaw rate, steeranglefeedback gives steering
+            speed = np.asarray(can_index.columns['pose']['speed'])
+            yaw_rate = np.abs(can_index.columns['pose']['yaw_rate'])
+            steering = np.abs(can_index.columns['steeranglefeedback']['value'])
         except Exception as e:
             # Some scenes might not have CAN bus data
-            # print(f"Skipping {scene_name}: {e}")
+            if report_errors:
+                print(f"Error processing {scene_name}: {e}")
             continue
+        speeds.add(speed)
+        yaw_rates.add(yaw_rate)
+        steerings.add(steering)
+    
+    for name, sample in (('speed', speeds), ('steering', steerings), ('yaw rate', yaw_rates)):
+        if sample.seen > len(sample):
+            print(f"Subsampled {name}: kept {len(sample)} of {sample.seen} values")
             
-    return np.array(speeds), np.array(steerings), np.array(yaw_rates)
+    return speeds.values, steerings.values, yaw_rates.values
+
+class ReservoirSample:
+    """
+    Uniform reservoir sample (Algorithm R) over a stream of 1-D chunks.
+
+    With capacity None (or 0) every value is kept.
+    """
+
+    def __init__(self, capacity=None, seed=0):
+        self.capacity = capacity or None
+        self.rng = np.random.default_rng(seed)
+        self.seen = 0
+        self._chunks = []
+        self._reservoir = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if self.capacity is None:
+            self._chunks.append(values)
+            self.seen += len(values)
+            return
+
+        if self._reservoir is None:
+            self._reservoir = np.empty(0, dtype=np.float64)
+        # Fill phase: keep values in order until the reservoir is full
+        n_fill = min(len(values), self.capacity - len(self._reservoir))
+        if n_fill > 0:
+            self._reservoir = np.concatenate([self._reservoir, values[:n_fill]])
+            self.seen += n_fill
+            values = values[n_fill:]
+        if len(values) == 0:
+            return
+
+        # Value with global index i replaces slot r ~ U[0, i] if r < capacity.
+        # Later values win on duplicate slots, as in the sequential algorithm.
+        global_idx = self.seen + np.arange(len(values))
+        slots = (self.rng.random(len(values)) * (global_idx + 1)).astype(np.int64)
+        accepted = slots < self.capacity
+        self._reservoir[slots[accepted]] = values[accepted]
+        self.seen += len(values)
+
+    @property
+    def values(self):
+        if self.capacity is None:
+            return np.concatenate(self._chunks) if self._chunks else np.array([])
+        return self._reservoir if self._reservoir is not None else np.array([])
 
 def fit_gmm_and_find_thresholds(data, n_components, sigma=2.0):
     # Reshape for sklearn
@@ -163,40 +198,36 @@ def plot_distribution(data, gmm, thresholds, title, xlabel, filename):
     plt.savefig(filename)
     plt.close()
 
-import argparse
+def fit_all(speeds, steerings, yaw_rates, workers=3):
+    """
+    Fit the speed (3), steering (3) and yaw rate (2) GMMs, in parallel processes when workers > 1.
 
-def main():
-    parser = argparse.ArgumentParser(description="Tune CAN bus thresholds using GMM.")
-    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
-    parser.add_argument('--version', type=str, default='v1.0-mini', help='NuScenes version (e.g., v1.0-mini, v1.0-trainval)')
-    args = parser.parse_args()
+    Returns:
+        tuple: ((speed_thresholds, speed_gmm), (steer_thresholds, steer_gmm), (yaw_thresholds, yaw_gmm))
+    """
+    jobs = [(speeds, 3), (steerings, 3), (yaw_rates, 2)]
+    if workers <= 1:
+        return tuple(fit_gmm_and_find_thresholds(data, n) for data, n in jobs)
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = [executor.submit(fit_gmm_and_find_thresholds, data, n) for data, n in jobs]
+        return tuple(f.result() for f in futures)
 
-    dataroot = args.dataroot
-    version = args.version
-    
-    print(f"Running with dataroot: {dataroot}, version: {version}")
+def thresholds_from_fits(speed_fit, steer_fit, yaw_fit):
+    """
+    Derive the config.yaml thresholds from the three GMM fits.
+
+    Returns:
+        tuple: (thresholds dict, steering thresholds to plot)
+    """
+    speed_thresholds, speed_gmm = speed_fit
+    steer_thresholds, steer_gmm = steer_fit
+    yaw_thresholds, yaw_gmm = yaw_fit
 
-    speeds, steerings, yaw_rates = load_data(dataroot, version=version)
-    
-    print(f"Data loaded: {len(speeds)} speed samples, {len(steerings)} steering samples, {len(yaw_rates)} yaw samples.")
-    
-    output_dir = os.path.dirname(os.path.abspath(__file__))
-    
     # 1. Speed Thresholds (Stop -> Slow/Pull Over -> Cruising)
-    # Fit 3 components
-    print("Fitting Speed GMM (3 components)...")
-    speed_thresholds, speed_gmm = fit_gmm_and_find_thresholds(speeds, n_components=3)
     stop_speed_threshold = speed_thresholds[0]
     pull_over_speed_threshold = speed_thresholds[1]
     
-    plot_distribution(speeds, speed_gmm, speed_thresholds, 'Speed Distribution', 'Speed (m/s)', os.path.join(output_dir, 'dist_speed.png'))
-    
     # 2. Steering Thresholds (Straight -> Lane Change -> Turn -> U-Turn)
-    # Fit 3 components: Straight, Turn, U-Turn
-    # We want to capture "Normal Turns" which might be the lower end of the "Turn" component.
-    print("Fitting Steering GMM (3 components)...")
-    steer_thresholds, steer_gmm = fit_gmm_and_find_thresholds(steerings, n_components=3)
-    
     # Threshold 0: Straight -> Turn (Use this for Lane Change start?)
     # Threshold 1: Turn -> U-Turn
     
@@ -227,27 +258,68 @@ def main():
     
     u_turn_steering_threshold = steer_thresholds[1]
     
-    plot_distribution(steerings, steer_gmm, [lane_change_steering_threshold, turn_steering_threshold, u_turn_steering_threshold], 'Steering Angle Distribution', 'Steering Angle (rad)', os.path.join(output_dir, 'dist_steering.png'))
-    
     # 3. Yaw Rate Threshold (Straight -> Turn)
-    # Fit 2 components (Keep simple for now, or 3 if we want sharp turns)
-    print("Fitting Yaw Rate GMM (2 components)...")
-    yaw_thresholds, yaw_gmm = fit_gmm_and_find_thresholds(yaw_rates, n_components=2)
     yaw_rate_threshold = yaw_thresholds[0]
     
-    plot_distribution(yaw_rates, yaw_gmm, yaw_thresholds, 'Yaw Rate Distribution', 'Yaw Rate (rad/s)', os.path.join(output_dir, 'dist_yaw.png'))
+    thresholds = {
+        "stop_speed_threshold": float(stop_speed_threshold),
+        "pull_over_speed_threshold": float(pull_over_speed_threshold),
+        "lane_change_steering_threshold": float(lane_change_steering_threshold),
+        "turn_steering_threshold": float(turn_steering_threshold),
+        "u_turn_steering_threshold": float(u_turn_steering_threshold),
+        "yaw_rate_threshold": float(yaw_rate_threshold),
+        "turn_signal_on_threshold": 0.5 # Keep default
+    }
+    return thresholds, [lane_change_steering_threshold, turn_steering_threshold, u_turn_steering_threshold]
+
+def estimate_tolerance(speeds, steerings, yaw_rates, workers=3, seed=0):
+    """
+    Estimate how much the thresholds depend on the subsample: refit on two random
+    halves and report half of the absolute difference per threshold.
+    """
+    rng = np.random.default_rng(seed)
+    halves = []
+    for data in (speeds, steerings, yaw_rates):
+        perm = rng.permutation(len(data))
+        halves.append((data[perm[:len(data) // 2]], data[perm[len(data) // 2:]]))
+    thresholds_a, _ = thresholds_from_fits(*fit_all(*(h[0] for h in halves), workers=workers))
+    thresholds_b, _ = thresholds_from_fits(*fit_all(*(h[1] for h in halves), workers=workers))
+    return {key: abs(thresholds_a[key] - thresholds_b[key]) / 2 for key in thresholds_a}
+
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune CAN bus thresholds using GMM.")
+    parser.add_argument('--dataroot', type=str, default='c:\\Users\\chiba\\project\\DriveDataFilterExperiments\\data\\nuscenes', help='Path to NuScenes data root')
+    parser.add_argument('--version', type=str, default='v1.0-mini', help='NuScenes version (e.g., v1.0-mini, v1.0-trainval)')
+    parser.add_argument('--max_samples', type=int, default=500000, help='Memory cap: reservoir size per signal (0 = keep all values)')
+    parser.add_argument('--fit_workers', type=int, default=3, help='Processes used to fit the speed/steering/yaw GMMs in parallel')
+    parser.add_argument('--report_tolerance', action='store_true', help='Refit on two random halves and report the threshold tolerance')
+    args = parser.parse_args()
+
+    dataroot = args.dataroot
+    version = args.version
+    
+    print(f"Running with dataroot: {dataroot}, version: {version}")
+
+    speeds, steerings, yaw_rates = load_data(dataroot, version=version, max_samples=args.max_samples)
+    
+    print(f"Data loaded: {len(speeds)} speed samples, {len(steerings)} steering samples, {len(yaw_rates)} yaw samples.")
+    
+    output_dir = os.path.dirname(os.path.abspath(__file__))
+    
+    # Speed: 3 components, Steering: 3 components (Straight, Turn, U-Turn), Yaw Rate: 2 components
+    print(f"Fitting Speed (3), Steering (3) and Yaw Rate (2) GMMs with {args.fit_workers} worker(s)...")
+    speed_fit, steer_fit, yaw_fit = fit_all(speeds, steerings, yaw_rates, workers=args.fit_workers)
+    thresholds, steer_plot_thresholds = thresholds_from_fits(speed_fit, steer_fit, yaw_fit)
+    
+    plot_distribution(speeds, speed_fit[1], speed_fit[0], 'Speed Distribution', 'Speed (m/s)', os.path.join(output_dir, 'dist_speed.png'))
+    plot_distribution(steerings, steer_fit[1], steer_plot_thresholds, 'Steering Angle Distribution', 'Steering Angle (rad)', os.path.join(output_dir, 'dist_steering.png'))
+    plot_distribution(yaw_rates, yaw_fit[1], yaw_fit[0], 'Yaw Rate Distribution', 'Yaw Rate (rad/s)', os.path.join(output_dir, 'dist_yaw.png'))
     
     # Generate Config
     new_config = {
-        "thresholds": {
-            "stop_speed_threshold": float(stop_speed_threshold),
-            "pull_over_speed_threshold": float(pull_over_speed_threshold),
-            "lane_change_steering_threshold": float(lane_change_steering_threshold),
-            "turn_steering_threshold": float(turn_steering_threshold),
-            "u_turn_steering_threshold": float(u_turn_steering_threshold),
-            "yaw_rate_threshold": float(yaw_rate_threshold),
-            "turn_signal_on_threshold": 0.5 # Keep default
-        }
+        "thresholds": thresholds
     }
     
     config_out_path = os.path.join(output_dir, 'config_suggested.yaml')
@@ -259,5 +331,11 @@ def main():
     print("Thresholds:")
     print(json.dumps(new_config, indent=2))
 
+    if args.report_tolerance:
+        print("Estimating threshold tolerance (split-half refit)...")
+        tolerance = estimate_tolerance(speeds, steerings, yaw_rates, workers=args.fit_workers)
+        for key, value in tolerance.items():
+            print(f"  {key}: {thresholds[key]:.4f} +/- {value:.4f}")
+
 if __name__ == "__main__":
     main()
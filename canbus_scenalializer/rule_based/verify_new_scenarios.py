@@ -5,7 +5,10 @@ import os
 # Add current directory to path so we can import classifier
 sys.path.append(os.getcwd())
 
-from classifier import RuleBasedClassifier
+import numpy as np
+
+from classifier import RuleBasedClassifier, labels_to_names
+from streaming_classifier import StreamingScenarioClassifier, merge_can_streams
 
 def verify_scenarios():
     config_path = 'config.yaml'
@@ -69,6 +72,90 @@ def verify_scenarios():
         print("\nAll tests passed!")
     else:
         print("\nSome tests failed.")
+    return all_passed
+
+def verify_vectorized_equivalence(n_frames=100000, seed=0):
+    """
+    Check that classify_arrays gives the same label as _classify_frame on every row.
+    """
+    config_path = 'config.yaml'
+    classifier = RuleBasedClassifier(config_path)
+    rng = np.random.default_rng(seed)
+
+    speed = rng.uniform(0.0, 20.0, n_frames)
+    speed[rng.random(n_frames) < 0.1] = 0.0
+    steering = rng.uniform(-6.0, 6.0, n_frames) * rng.choice([0.05, 0.3, 1.0], n_frames)
+    yaw_rate = rng.normal(0.0, 0.1, n_frames)
+    turn_signal = rng.choice([0, 1, 2], n_frames, p=[0.7, 0.15, 0.15])
+    gear = rng.choice(['D', 'R'], n_frames, p=[0.95, 0.05])
+    accel = rng.normal(0.0, 1.0, n_frames)
+
+    frames = [
+        {
+            "speed": float(speed[i]),
+            "steering_angle": float(steering[i]),
+            "yaw_rate": float(yaw_rate[i]),
+            "turn_signal": int(turn_signal[i]),
+            "gear": str(gear[i]),
+            "acceleration": float(accel[i]),
+        }
+        for i in range(n_frames)
+    ]
+    expected = classifier.classify(frames)
+    got = labels_to_names(classifier.classify_arrays(speed, steering, yaw_rate, turn_signal, gear, accel))
+
+    mismatches = sum(1 for e, g in zip(expected, got) if e != g)
+    if mismatches == 0:
+        print(f"[PASS] Vectorized equivalence: {n_frames} frames match")
+    else:
+        print(f"[FAIL] Vectorized equivalence: {mismatches}/{n_frames} frames differ")
+    return mismatches == 0
+
+def verify_streaming_deceleration():
+    """
+    Check that the streaming classifier derives Deceleration from the speed history.
+    """
+    streaming = StreamingScenarioClassifier('config.yaml')
+    # 50Hz pose: 2s cruising at 15 m/s, then braking at -3 m/s^2, straight steering throughout
+    pose_msgs = []
+    for i in range(200):
+        t = i * 0.02
+        speed = 15.0 if t < 2.0 else 15.0 - 3.0 * (t - 2.0)
+        pose_msgs.append({'utime': int(t * 1e6), 'vel': [speed, 0.0, 0.0], 'rotation_rate': [0.0, 0.0, 0.0]})
+    steer_msgs = [{'utime': int(i * 0.01 * 1e6), 'value': 0.0} for i in range(400)]
+
+    labels = [r['scenario'] for r in streaming.push_batch(merge_can_streams({'pose': pose_msgs, 'steeranglefeedback': steer_msgs}))]
+    passed = labels[50] == "Cruising" and labels[-1] == "Deceleration" and len(streaming._speed_history) <= streaming.params['accel_history']
+    status = "PASS" if passed else "FAIL"
+    print(f"[{status}] Streaming deceleration: before braking '{labels[50]}', while braking '{labels[-1]}'")
+    return passed
+
+def verify_decision_margins():
+    """
+    Check the confidence margins: clear-cut frames get 1, frames next to a threshold get ~0.
+    """
+    classifier = RuleBasedClassifier('config.yaml')
+    t = classifier.thresholds
+    # (speed, steering, turn_signal, expected margin is small)
+    cases = [
+        (10.0, 0.0, 0, False),                                    # Plain cruising
+        (0.0, 0.0, 0, False),                                     # Standing still
+        (10.0, t['turn_steering_threshold'] * 1.01, 0, True),    # Just a turn
+        (10.0, t['turn_steering_threshold'] * 0.99, 0, True),    # Just not a turn
+        (10.0, t['lane_change_steering_threshold'] * 1.01, 1, True), # Borderline lane change
+        (10.0, t['lane_change_steering_threshold'] * 1.01, 0, False), # Same steering without signal: not compared
+        (np.nan, 0.0, 0, True),                                   # No CAN data
+    ]
+    speed, steering, signal, expect_small = (np.array(c, dtype=np.float64) for c in zip(*cases))
+    ids = classifier.classify_arrays(speed, steering, turn_signal=signal)
+    margins = classifier.decision_margins(ids, speed, steering, turn_signal=signal)
+    passed = bool(np.all((margins < 0.05) == expect_small.astype(bool)))
+    status = "PASS" if passed else "FAIL"
+    print(f"[{status}] Decision margins: {np.round(margins, 3).tolist()}")
+    return passed
 
 if __name__ == "__main__":
     verify_scenarios()
+    verify_vectorized_equivalence()
+    verify_streaming_deceleration()
+    verify_decision_margins()
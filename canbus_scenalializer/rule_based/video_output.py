@@ -0,0 +1,123 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import cv2
+
+VIDEO_ENCODERS = ('mp4v', 'ffmpeg')
+
+class FramePrefetcher:
+    """
+    Decode images on a background thread, `depth` frames ahead of the consumer.
+
+    cv2.imread releases the GIL, so decoding overlaps with overlay drawing and
+    encoding on the main thread. Iterating yields (path, image) in input order;
+    image is None if the file is missing or unreadable.
+    """
+
+    def __init__(self, paths, depth=8):
+        self.paths = list(paths)
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for path in self.paths:
+            img = cv2.imread(path) if os.path.exists(path) else None
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put((path, img), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if self.stopped.is_set():
+                return
+
+    def __iter__(self):
+        for _ in self.paths:
+            yield self.queue.get()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FfmpegVideoWriter:
+    """
+    cv2.VideoWriter-like writer that pipes raw BGR frames into an ffmpeg
+    subprocess encoding H.264 (libx264). Encoding runs in the ffmpeg process,
+    concurrently with decoding and drawing in Python.
+    """
+
+    def __init__(self, path, fps, size, threads=2, preset='veryfast', crf=23):
+        width, height = size
+        cmd = [
+            'ffmpeg', '-y', '-loglevel', 'error', '-nostats',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+            '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-threads', str(threads),
+            '-pix_fmt', 'yuv420p', path,
+        ]
+        self.path = path
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, img):
+        try:
+            self.proc.stdin.write(img.tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early; release() raises with its error message
+            self.release()
+            raise
+
+    def release(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = self.proc.stderr.read().decode(errors='replace')
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed writing {self.path}: {stderr.strip()}")
+
+def draw_overlay(img, scenario, vehicle_state, title=None):
+    """
+    Draw the scenario and vehicle state (and an optional title line) onto a frame in place.
+    """
+    # Overlay Text
+    text = f"Scenario: {scenario}"
+    cv2.putText(img, text, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+
+    # Add vehicle state info for debug
+    info_text = f"Speed: {vehicle_state.get('speed', 0):.2f} m/s, Steer: {vehicle_state.get('steering_angle', 0):.2f} rad"
+    cv2.putText(img, info_text, (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_AA)
+
+    if title:
+        cv2.putText(img, title, (50, 150), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 0), 2, cv2.LINE_AA)
+    return img
+
+def ffmpeg_available():
+    return shutil.which('ffmpeg') is not None
+
+def open_video_writer(path, fps, size, encoder='mp4v', ffmpeg_threads=2):
+    """
+    Create a video writer.
+
+    Args:
+        path (str): Output .mp4 path.
+        fps (float): Frame rate.
+        size (tuple): (width, height) of the frames.
+        encoder (str): 'mp4v' (cv2.VideoWriter) or 'ffmpeg' (libx264 through a pipe).
+        ffmpeg_threads (int): Encoder threads per ffmpeg process.
+
+    Returns:
+        Object with write(img) and release().
+    """
+    if encoder == 'ffmpeg':
+        return FfmpegVideoWriter(path, fps, size, threads=ffmpeg_threads)
+    return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
@@ -3,12 +3,16 @@ from unittest.mock import MagicMock, patch
 import numpy as np
 import cv2
 import sys
+import tempfile
 from pathlib import Path
 
 # Add tools directory to path to import inference
 sys.path.append(str(Path(__file__).parent.parent / "tools"))
 
-from inference import RoadMarkingDetector, CLASSES
+from inference import (RoadMarkingDetector, CLASSES, StageTimer, parse_horizon, prepare_input, restore_mask,
+                       run_pipeline)
+from manifest import Manifest
+from output_store import InstanceReader, InstanceWriter, MaskReader, NpzMaskStore, PngMaskStore
 
 class TestRoadMarkingDetector(unittest.TestCase):
     def setUp(self):
@@ -53,6 +57,45 @@ class TestRoadMarkingDetector(unittest.TestCase):
         class_ids = sorted([inst['class_id'] for inst in instances])
         self.assertEqual(class_ids, [1, 2])
 
+    def test_extract_instances_touching_classes(self):
+        mask = np.zeros((100, 100), dtype=np.uint8)
+        # Stop line (5) touching a solid line (1), plus noise below min_area
+        mask[20:80, 40:50] = 1
+        mask[40:50, 50:90] = 5
+        mask[90:95, 5:10] = 2
+
+        instances = self.detector.extract_instances(mask)
+        self.assertEqual([inst['class_id'] for inst in instances], [1, 5])
+        self.assertEqual(instances[0]['bbox'], [40, 20, 10, 60])
+        self.assertEqual(instances[1]['bbox'], [50, 40, 40, 10])
+
+        # Simplified polygon of a rectangle is its 4 corners; polygons can be skipped
+        simplified = self.detector.extract_instances(mask, epsilon=2.0)
+        self.assertEqual(len(simplified[0]['polygon']), 8)
+        no_polygon = self.detector.extract_instances(mask, polygon=False)
+        self.assertEqual(no_polygon[1]['polygon'], [])
+        self.assertEqual(no_polygon[1]['bbox'], [50, 40, 40, 10])
+
+    def test_roi_mapping(self):
+        self.assertEqual(parse_horizon("0.45"), {'default': 0.45})
+        self.assertEqual(parse_horizon("CAM_FRONT=0.5,default=0.4"), {'CAM_FRONT': 0.5, 'default': 0.4})
+
+        img = np.zeros((90, 160, 3), dtype=np.uint8)
+        model_input = prepare_input(img, roi_top=0.5, input_scale=0.5)
+        self.assertEqual(model_input.shape[:2], (22, 80))
+
+        # A marking found in the crop keeps its full-frame position
+        mask = np.zeros(model_input.shape[:2], dtype=np.uint8)
+        mask[5:15, 10:30] = 2
+        full = restore_mask(mask, img.shape, roi_top=0.5)
+        self.assertEqual(full.shape, (90, 160))
+        self.assertFalse(full[:45].any())
+        instances = self.detector.extract_instances(full)
+        self.assertEqual(len(instances), 1)
+        x, y, w, h = instances[0]['bbox']
+        self.assertEqual((x, w), (20, 40))
+        self.assertAlmostEqual(y, 45 + 5 * 45 / 22, delta=2)
+
     def test_process_batch_flow(self):
         # Mock inferencer return value for batch
         dummy_mask1 = np.zeros((512, 1024), dtype=np.uint8)
@@ -73,5 +116,98 @@ class TestRoadMarkingDetector(unittest.TestCase):
         self.assertEqual(args[0], ["img1.jpg", "img2.jpg"])
         self.assertEqual(kwargs['batch_size'], 2)
 
+    def test_run_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            tasks = []
+            for k in range(5):
+                img_path = tmp / f"img{k}.jpg"
+                cv2.imwrite(str(img_path), np.full((90, 160, 3), 128, dtype=np.uint8))
+                tasks.append({'sample_token': f"s{k}", 'cam_name': 'CAM_FRONT', 'img_path': str(img_path), 'filename': img_path.name})
+            tasks.append({'sample_token': 'missing', 'cam_name': 'CAM_FRONT', 'img_path': str(tmp / "missing.jpg"), 'filename': "missing.jpg"})
+
+            # Masks are predicted at the (pre-resized) input resolution
+            def infer(inputs, batch_size, return_datasamples):
+                masks = []
+                for img in inputs:
+                    mask = np.zeros(img.shape[:2], dtype=np.int64)
+                    mask[10:30, 10:30] = 1
+                    masks.append(mask)
+                return {'predictions': masks}
+            self.detector.inferencer.side_effect = infer
+
+            mask_dir = tmp / "masks"
+            mask_store = PngMaskStore(mask_dir)
+            timer = StageTimer()
+            outputs = run_pipeline(self.detector, tasks, batch_size=2, read_workers=2, write_workers=2,
+                                   queue_size=2, input_scale=0.5, mask_store=mask_store, timer=timer)
+            mask_store.close()
+
+            # Unreadable images are skipped, the others keep task order
+            self.assertEqual([task['sample_token'] for task, _ in outputs], [f"s{k}" for k in range(5)])
+            self.assertEqual(self.detector.inferencer.call_count, 3)
+            for task, entry in outputs:
+                saved = cv2.imread(str(mask_dir / entry['mask_path']), cv2.IMREAD_UNCHANGED)
+                self.assertEqual(saved.shape, (90, 160))
+                self.assertEqual(entry['instances'][0]['bbox'], [20, 20, 40, 40])
+            self.assertEqual(timer.counts['infer'], 5)
+
+    def test_interrupted_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            tasks = []
+            for k in range(5):
+                img_path = tmp / f"img{k}.jpg"
+                cv2.imwrite(str(img_path), np.full((90, 160, 3), 128, dtype=np.uint8))
+                tasks.append({'sample_token': f"s{k}", 'cam_name': 'CAM_FRONT', 'img_path': str(img_path),
+                              'filename': img_path.name, 'fingerprint': {'size': k}})
+
+            # The run stops at the 5th image, before the stores are closed
+            def infer(inputs, batch_size, return_datasamples):
+                if infer.calls == 4:
+                    raise KeyboardInterrupt
+                infer.calls += 1
+                mask = np.zeros(inputs[0].shape[:2], dtype=np.int64)
+                mask[10:30, 10:30] = 1
+                return {'predictions': [mask]}
+            infer.calls = 0
+            self.detector.inferencer.side_effect = infer
+
+            mask_store = NpzMaskStore(tmp / "masks", shard_size=3)
+            instance_writer = InstanceWriter(tmp)
+            manifest = Manifest(tmp, "signature")
+            with self.assertRaises(KeyboardInterrupt):
+                run_pipeline(self.detector, tasks, write_workers=1, mask_store=mask_store,
+                             instance_writer=instance_writer, manifest=manifest)
+
+            # Only the first NPZ shard was saved: the 4th mask was still buffered
+            manifest = Manifest(tmp, "signature")
+            self.assertEqual([manifest.status(task) for task in tasks], ['done', 'done', 'done', 'new', 'new'])
+            # The tasks recorded as done can be read back without the indexes written on close()
+            masks = MaskReader(tmp / "masks")
+            instances = InstanceReader(tmp)
+            for task in tasks[:3]:
+                self.assertEqual(masks.get(task['sample_token'], 'CAM_FRONT').shape, (90, 160))
+                self.assertEqual(len(instances.get(task['sample_token'])['CAM_FRONT']['instances']), 1)
+
+            # The incremental rerun processes the remaining tasks
+            rerun = [task for task in tasks if manifest.status(task) != 'done']
+            infer.calls = 0
+            mask_store = NpzMaskStore(tmp / "masks", shard_size=3)
+            instance_writer = InstanceWriter(tmp)
+            outputs = run_pipeline(self.detector, rerun, write_workers=1, mask_store=mask_store,
+                                   instance_writer=instance_writer, manifest=manifest)
+            mask_store.close()
+            instance_writer.close()
+            for task, _ in outputs:
+                manifest.add(task)
+            manifest.close()
+
+            self.assertEqual([task['sample_token'] for task, _ in outputs], ['s3', 's4'])
+            manifest = Manifest(tmp, "signature")
+            self.assertEqual([manifest.status(task) for task in tasks], ['done'] * 5)
+            self.assertEqual(len(MaskReader(tmp / "masks").keys()), 5)
+            self.assertEqual(sorted(InstanceReader(tmp).tokens()), [f"s{k}" for k in range(5)])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Add tools directory to path to import manifest
+sys.path.append(str(Path(__file__).parent.parent / "tools"))
+
+from manifest import Manifest, image_fingerprint, model_signature
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        (self.dir / "config.py").write_text("model = dict()")
+        (self.dir / "model.pth").write_bytes(b"weights")
+        self.images = []
+        for k in range(3):
+            path = self.dir / f"img{k}.jpg"
+            path.write_bytes(b"image %d" % k)
+            self.images.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def tasks(self, use_hash=False):
+        return [{'sample_token': f"s{k}", 'cam_name': 'CAM_FRONT', 'img_path': str(path),
+                 'fingerprint': image_fingerprint(path, use_hash)} for k, path in enumerate(self.images)]
+
+    def signature(self, **options):
+        return model_signature(self.dir / "config.py", self.dir / "model.pth", options)
+
+    def test_skip_unchanged(self):
+        manifest = Manifest(self.dir, self.signature())
+        tasks = self.tasks()
+        self.assertEqual([manifest.status(t) for t in tasks], ['new', 'new', 'new'])
+        manifest.add(tasks[0])
+        manifest.add(tasks[1])
+        manifest.close()
+
+        # New run: image 1 was rewritten, image 2 never finished
+        self.images[1].write_bytes(b"new content")
+        os.utime(self.images[1], ns=(0, 0))
+        manifest = Manifest(self.dir, self.signature())
+        self.assertEqual([manifest.status(t) for t in self.tasks()], ['done', 'changed', 'new'])
+
+    def test_model_change(self):
+        manifest = Manifest(self.dir, self.signature())
+        for task in self.tasks():
+            manifest.add(task)
+        manifest.close()
+
+        self.assertEqual(Manifest(self.dir, self.signature()).status(self.tasks()[0]), 'done')
+        self.assertEqual(Manifest(self.dir, self.signature(input_scale=0.5)).status(self.tasks()[0]), 'model')
+        (self.dir / "model.pth").write_bytes(b"retrained weights")
+        self.assertEqual(Manifest(self.dir, self.signature()).status(self.tasks()[0]), 'model')
+
+    def test_content_hash(self):
+        manifest = Manifest(self.dir, self.signature())
+        for task in self.tasks(use_hash=True):
+            manifest.add(task)
+        manifest.close()
+
+        # Touching the file (e.g. re-sync) does not count as a change when hashing
+        os.utime(self.images[0], ns=(0, 0))
+        manifest = Manifest(self.dir, self.signature())
+        self.assertEqual(manifest.status(self.tasks(use_hash=True)[0]), 'done')
+        self.assertEqual(manifest.status(self.tasks()[0]), 'changed')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+import sys
+import tempfile
+from pathlib import Path
+
+# Add tools directory to path to import output_store
+sys.path.append(str(Path(__file__).parent.parent / "tools"))
+
+from output_store import (InstanceReader, InstanceWriter, MaskReader, MaskStore, decode_mask, encode_mask,
+                          make_mask_store, string_to_counts)
+
+class TestMaskEncoding(unittest.TestCase):
+    def test_rle_roundtrip(self):
+        rng = np.random.default_rng(0)
+        masks = [rng.integers(0, 6, size=(37, 23)).astype(np.uint8), np.zeros((4, 5), np.uint8), np.full((4, 5), 3, np.uint8)]
+        for mask in masks:
+            rle = encode_mask(mask)
+            self.assertEqual(sorted(rle), sorted(str(c) for c in np.unique(mask) if c != 0))
+            np.testing.assert_array_equal(decode_mask(rle, mask.shape), mask)
+
+    def test_rle_is_coco_compatible(self):
+        # Column-major runs starting with 0s, as pycocotools.mask.encode produces them
+        mask = np.zeros((3, 4), dtype=np.uint8)
+        mask[0:2, 1] = 2
+        mask[2, 3] = 2
+        rle = encode_mask(mask)["2"]
+        self.assertEqual(rle["size"], [3, 4])
+        self.assertEqual(string_to_counts(rle["counts"]), [3, 2, 6, 1])
+        self.assertEqual(rle["counts"], "326O")  # pycocotools.mask.encode of the same mask
+
+class TestStores(unittest.TestCase):
+    def test_mask_stores(self):
+        rng = np.random.default_rng(1)
+        masks = {(f"token{k}", cam): rng.integers(0, 6, size=(20, 30)).astype(np.uint8)
+                 for k in range(5) for cam in ('CAM_FRONT', 'CAM_BACK')}
+        for mask_format in ('png', 'rle', 'npz'):
+            with tempfile.TemporaryDirectory() as tmp:
+                store = make_mask_store(mask_format, tmp, shard_size=3)
+                for (token, cam), mask in masks.items():
+                    store.put(token, cam, f"{token}_{cam}.jpg", mask)
+                store.close()
+
+                reader = MaskReader(tmp)
+                self.assertEqual(len(reader.keys()), len(masks))
+                for (token, cam), mask in masks.items():
+                    np.testing.assert_array_equal(reader.get(token, cam), mask)
+                self.assertEqual(sorted(reader.get_sample("token3")), ['CAM_BACK', 'CAM_FRONT'])
+                self.assertIsNone(reader.get("unknown", 'CAM_FRONT'))
+
+    def test_mask_store_requires_put(self):
+        class IncompleteStore(MaskStore):
+            format = "incomplete"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(TypeError):
+                IncompleteStore(tmp)
+
+    def test_instances_random_access(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for run in range(2):
+                writer = InstanceWriter(tmp)
+                for k in range(3):
+                    task = {'sample_token': f"token{k + run}", 'cam_name': 'CAM_FRONT'}
+                    writer.write(task, {"filename": "a.jpg", "mask_path": "a.png", "instances": [{"class_id": run}]})
+                writer.close()
+
+            reader = InstanceReader(tmp)
+            self.assertEqual(sorted(reader.tokens()), ["token0", "token1", "token2", "token3"])
+            # Re-processed samples resolve to the latest run
+            self.assertEqual(reader.get("token1")['CAM_FRONT']['instances'], [{"class_id": 1}])
+            self.assertEqual(reader.get("token0")['CAM_FRONT']['instances'], [{"class_id": 0}])
+            self.assertEqual(reader.get("unknown"), {})
+
+            # The index can be rebuilt from the JSONL lines
+            (Path(tmp) / "instances.index.json").unlink()
+            self.assertEqual(InstanceReader(tmp).get("token1")['CAM_FRONT']['instances'], [{"class_id": 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent))
+
+from inference import CLASSES, MIN_INSTANCE_AREA, extract_instances
+
+def extract_instances_per_class(mask, min_area=MIN_INSTANCE_AREA):
+    """
+    Reference implementation: one full-mask scan and findContours per class,
+    noise filtered after the contours are traced.
+    """
+    instances = []
+    for class_id in range(1, 6):
+        class_mask = (mask == class_id).astype(np.uint8)
+        if np.sum(class_mask) == 0:
+            continue
+        contours, _ = cv2.findContours(class_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            instances.append({
+                "label": CLASSES[class_id],
+                "class_id": class_id,
+                "score": 1.0,
+                "bbox": [int(x), int(y), int(w), int(h)],
+                "polygon": contour.flatten().tolist()
+            })
+    return instances
+
+def synthetic_mask(rng, height=900, width=1600):
+    """
+    Road-marking-like mask: lane lines, dashes, a zebra crossing, a stop line and speckle noise.
+    """
+    mask = np.zeros((height, width), dtype=np.uint8)
+    horizon = height // 2
+    for x_bottom in rng.integers(0, width, size=3):
+        cv2.line(mask, (int(x_bottom), height - 1), (width // 2, horizon), 1, thickness=int(rng.integers(4, 12)))
+    for _ in range(8):
+        x, y = int(rng.integers(0, width - 40)), int(rng.integers(horizon, height - 60))
+        cv2.line(mask, (x, y), (x + 20, y + 50), 2, thickness=8)
+    guide_y = int(rng.integers(horizon, height - 80))
+    cv2.fillConvexPoly(mask, np.array([[600, guide_y + 70], [700, guide_y], [720, guide_y + 10], [640, guide_y + 80]]), 3)
+    zebra_y = int(rng.integers(horizon, height - 60))
+    for x in range(200, 1400, 60):
+        cv2.rectangle(mask, (x, zebra_y), (x + 30, zebra_y + 50), 4, thickness=-1)
+    stop_y = int(rng.integers(horizon, height - 20))
+    cv2.rectangle(mask, (300, stop_y), (1300, stop_y + 12), 5, thickness=-1)
+    # Speckle noise below the area threshold
+    ys = rng.integers(horizon, height, size=300)
+    xs = rng.integers(0, width, size=300)
+    mask[ys, xs] = rng.integers(1, 6, size=300)
+    return mask
+
+def time_per_mask(fn, masks, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for mask in masks:
+            fn(mask)
+        best = min(best, (time.perf_counter() - start) / len(masks))
+    return best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of instance extraction on nuScenes-sized masks")
+    parser.add_argument("--num_masks", type=int, default=20, help="Number of synthetic masks")
+    parser.add_argument("--height", type=int, default=900, help="Mask height")
+    parser.add_argument("--width", type=int, default=1600, help="Mask width")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions (best is reported)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    masks = [synthetic_mask(rng, args.height, args.width) for _ in range(args.num_masks)]
+
+    variants = [
+        ("full-frame per class (reference)", extract_instances_per_class),
+        ("cropped", extract_instances),
+        ("cropped, epsilon=1.5", lambda m: extract_instances(m, epsilon=1.5)),
+        ("cropped, bbox only", lambda m: extract_instances(m, polygon=False)),
+    ]
+    same = all(extract_instances(mask) == extract_instances_per_class(mask) for mask in masks)
+    print(f"{args.num_masks} masks of {args.width}x{args.height}, output identical to reference: {same}")
+    baseline = None
+    for name, fn in variants:
+        ms = time_per_mask(fn, masks, args.repeat)
+        baseline = baseline or ms
+        instances = sum(len(fn(mask)) for mask in masks)
+        points = sum(len(inst['polygon']) // 2 for mask in masks for inst in fn(mask))
+        print(f"  {name:<36} {ms:7.2f} ms/mask  x{baseline / ms:4.1f}  {instances} instances, {points} polygon points")
+
+if __name__ == "__main__":
+    main()
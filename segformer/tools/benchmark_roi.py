@@ -0,0 +1,115 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+from nuscenes.nuscenes import NuScenes
+
+sys.path.append(str(Path(__file__).parent))
+
+from inference import CAMERAS, CLASSES, RoadMarkingDetector, parse_horizon, prepare_input, restore_mask
+
+def confusion(reference, mask, num_classes):
+    """
+    Pixel confusion matrix (reference class x predicted class) of two masks.
+    """
+    codes = reference.astype(np.int64).ravel() * num_classes + mask.ravel()
+    return np.bincount(codes, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+def class_iou(matrix):
+    """
+    IoU per class from a confusion matrix (NaN for classes absent from both).
+    """
+    intersection = np.diag(matrix).astype(np.float64)
+    union = matrix.sum(axis=0) + matrix.sum(axis=1) - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return intersection / union
+
+def infer(detector, img, roi_top, input_scale):
+    """
+    Time one inference of a prepared input and return the full-frame mask.
+    """
+    model_input = prepare_input(img, roi_top, input_scale)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    mask = detector.process_batch([model_input])[0]['predictions']
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return restore_mask(mask, img.shape, roi_top), time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed/IoU of ROI-cropped vs full-frame SegFormer inference")
+    parser.add_argument("--config", required=True, help="Path to model config")
+    parser.add_argument("--checkpoint", required=True, help="Path to model checkpoint")
+    parser.add_argument("--dataroot", required=True, help="NuScenes dataroot")
+    parser.add_argument("--version", default="v1.0-mini", help="NuScenes version")
+    parser.add_argument("--device", default=None, help="Inference device (default: cuda if available)")
+    parser.add_argument("--num_samples", type=int, default=20, help="Number of samples (evenly spaced)")
+    parser.add_argument("--cameras", default="CAM_FRONT,CAM_BACK", help="Comma-separated cameras")
+    parser.add_argument("--horizon", default="0.45", help="Horizon line, as in inference.py")
+    parser.add_argument("--input_scale", type=float, default=1.0, help="Pre-resize factor of the ROI input")
+    args = parser.parse_args()
+
+    horizon = parse_horizon(args.horizon)
+    cameras = [cam.strip() for cam in args.cameras.split(",") if cam.strip() in CAMERAS]
+
+    nusc = NuScenes(version=args.version, dataroot=args.dataroot, verbose=False)
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    detector = RoadMarkingDetector(args.config, args.checkpoint, device=device)
+
+    step = max(1, len(nusc.sample) // args.num_samples)
+    samples = nusc.sample[::step][:args.num_samples]
+
+    num_classes = max(CLASSES) + 1
+    matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    full_time = roi_time = 0.0
+    num_images = 0
+    # Marking pixels of the full-frame masks above the horizon line (lost by the crop)
+    above_horizon = 0
+    warmed_up = False
+    for sample in samples:
+        for cam_name in cameras:
+            if cam_name not in sample['data']:
+                continue
+            img = cv2.imread(nusc.get_sample_data_path(sample['data'][cam_name]))
+            if img is None:
+                continue
+            if not warmed_up:
+                # First call includes CUDA/cuDNN initialization
+                infer(detector, img, 0.0, 1.0)
+                warmed_up = True
+
+            roi_top = horizon.get(cam_name, horizon.get('default', 0.0))
+            reference, t_full = infer(detector, img, 0.0, 1.0)
+            mask, t_roi = infer(detector, img, roi_top, args.input_scale)
+            matrix += confusion(reference, mask, num_classes)
+            above_horizon += np.count_nonzero(reference[:int(round(img.shape[0] * roi_top))])
+            full_time += t_full
+            roi_time += t_roi
+            num_images += 1
+
+    if num_images == 0:
+        print("No images found.")
+        return
+
+    iou = class_iou(matrix)
+    print(f"{num_images} images ({', '.join(cameras)}), horizon {args.horizon}, input scale {args.input_scale}, {device}")
+    print(f"  Full frame: {1000 * full_time / num_images:.1f} ms/img")
+    print(f"  ROI:        {1000 * roi_time / num_images:.1f} ms/img (x{full_time / roi_time:.2f})")
+    print("  IoU of ROI masks against full-frame masks:")
+    for class_id in range(1, num_classes):
+        pixels = matrix[class_id].sum()
+        value = "n/a" if np.isnan(iou[class_id]) else f"{iou[class_id]:.3f}"
+        print(f"    {CLASSES[class_id]:<8} {value:>6}  ({pixels} full-frame pixels)")
+    print(f"  mIoU: {np.nanmean(iou[1:]):.3f}")
+    marking_pixels = matrix[1:].sum()
+    print(f"  Pixel agreement: {np.trace(matrix) / matrix.sum():.4f}")
+    print(f"  Full-frame marking pixels above the horizon: {above_horizon}/{marking_pixels} "
+          f"({above_horizon / max(marking_pixels, 1):.2%})")
+
+if __name__ == "__main__":
+    main()
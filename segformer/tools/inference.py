@@ -1,7 +1,13 @@
 import argparse
 import json
 import os
+import queue
 import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 import cv2
@@ -11,6 +17,9 @@ from mmseg.apis import MMSegInferencer
 from nuscenes.nuscenes import NuScenes
 from tqdm import tqdm
 
+from manifest import Manifest, image_fingerprint, model_signature
+from output_store import MASK_FORMATS, InstanceWriter, make_mask_store
+
 # RoadLib Class Definitions
 # 0: Background (EMPTY)
 # 1: SOLID
@@ -27,6 +36,11 @@ CLASSES = {
     5: "stop"
 }
 
+CAMERAS = ['CAM_FRONT', 'CAM_FRONT_LEFT', 'CAM_FRONT_RIGHT', 'CAM_BACK', 'CAM_BACK_LEFT', 'CAM_BACK_RIGHT']
+
+# Contours smaller than this (in pixels) are treated as noise
+MIN_INSTANCE_AREA = 50
+
 class RoadMarkingDetector:
     def __init__(self, config_path, checkpoint_path, device='cuda'):
         self.inferencer = MMSegInferencer(
@@ -39,7 +53,7 @@ class RoadMarkingDetector:
         """
         Run inference on a batch of images.
         Args:
-            img_paths (list): List of image paths.
+            img_paths (list): List of image paths or decoded BGR images (np.ndarray).
             batch_size (int): Batch size.
         Returns:
             results (list): List of inference results.
@@ -71,56 +85,20 @@ class RoadMarkingDetector:
             
         return formatted_results
 
-    def extract_instances(self, mask):
+    def extract_instances(self, mask, min_area=MIN_INSTANCE_AREA, polygon=True, epsilon=0.0):
         """
-        Extract instances from segmentation mask using connected components / contours.
-        Args:
-            mask (np.ndarray): Segmentation mask (H, W) with class IDs.
-        Returns:
-            instances (list): List of dicts containing label, score (dummy), bbox, polygon.
+        Extract instances from segmentation mask (see extract_instances).
         """
-        instances = []
-        
-        # Iterate over each class (skipping background 0)
-        for class_id in range(1, 6):
-            if class_id not in CLASSES:
-                continue
-                
-            # Create binary mask for the current class
-            class_mask = (mask == class_id).astype(np.uint8)
-            
-            if np.sum(class_mask) == 0:
-                continue
+        return extract_instances(mask, min_area, polygon, epsilon)
 
-            # Find contours
-            contours, _ = cv2.findContours(class_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            for contour in contours:
-                if cv2.contourArea(contour) < 50: # Filter small noise
-                    continue
-                    
-                # Bounding box
-                x, y, w, h = cv2.boundingRect(contour)
-                bbox = [int(x), int(y), int(w), int(h)]
-                
-                # Polygon (flattened list of points)
-                polygon = contour.flatten().tolist()
-                
-                instances.append({
-                    "label": CLASSES[class_id],
-                    "class_id": class_id,
-                    "score": 1.0, # Placeholder as semantic seg doesn't give instance scores
-                    "bbox": bbox,
-                    "polygon": polygon
-                })
-                
-        return instances
-
-    def visualize(self, img_path, mask, output_path):
+    def visualize(self, img_path, mask, output_path, img=None):
         """
         Save overlay image.
+        Args:
+            img (np.ndarray, optional): Already decoded image; read from img_path if omitted.
         """
-        img = cv2.imread(str(img_path))
+        if img is None:
+            img = cv2.imread(str(img_path))
         if img is None:
             print(f"Warning: Could not read image {img_path}")
             return
@@ -147,6 +125,299 @@ class RoadMarkingDetector:
         
         cv2.imwrite(str(output_path), overlay)
 
+def extract_instances(mask, min_area=MIN_INSTANCE_AREA, polygon=True, epsilon=0.0):
+    """
+    Extract instances from segmentation mask using contours.
+
+    The foreground is located once and every class is traced inside its
+    bounding box only (road markings cover a small part of the frame).
+    Noise is dropped by contour area before any bbox/polygon is computed.
+    Args:
+        mask (np.ndarray): Segmentation mask (H, W) with class IDs.
+        min_area (float): Minimum contour area in pixels.
+        polygon (bool): Output the instance outline (False: bbox only, 'polygon' is empty).
+        epsilon (float): approxPolyDP tolerance of the outline in pixels (0: exact).
+    Returns:
+        instances (list): List of dicts containing label, score (dummy), bbox, polygon.
+    """
+    mask = np.asarray(mask)
+    if mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+
+    # Bounding box of all road markings (skipping background 0)
+    x0, y0, w0, h0 = cv2.boundingRect(cv2.inRange(mask, 1, max(CLASSES)))
+    if w0 == 0 or h0 == 0:
+        return []
+    roi = mask[y0:y0 + h0, x0:x0 + w0]
+
+    instances = []
+    for class_id in range(1, max(CLASSES) + 1):
+        # cv2.compare yields the 0/255 binary image directly (no astype copy)
+        class_mask = cv2.compare(roi, class_id, cv2.CMP_EQ)
+        contours, _ = cv2.findContours(class_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area: # Filter small noise
+                continue
+
+            # Bounding box
+            x, y, w, h = cv2.boundingRect(contour)
+            bbox = [int(x), int(y), int(w), int(h)]
+
+            # Polygon (flattened list of points)
+            points = []
+            if polygon:
+                if epsilon > 0:
+                    contour = cv2.approxPolyDP(contour, epsilon, True)
+                points = contour.flatten().tolist()
+
+            instances.append({
+                "label": CLASSES[class_id],
+                "class_id": class_id,
+                "score": 1.0, # Placeholder as semantic seg doesn't give instance scores
+                "bbox": bbox,
+                "polygon": points
+            })
+
+    return instances
+
+class StageTimer:
+    """
+    Thread-safe accumulator of busy time per pipeline stage.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def measure(self, stage, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[stage] += elapsed
+                self.counts[stage] += count
+
+    def report(self, wall):
+        """
+        Print total and per-image time of every stage. Reader/writer times are
+        summed over their workers, so they can exceed the wall time.
+        """
+        print(f"Wall time: {wall:.1f}s")
+        for stage in ('read', 'infer', 'write', 'wait_read', 'wait_write'):
+            if stage not in self.seconds:
+                continue
+            seconds = self.seconds[stage]
+            count = self.counts[stage]
+            per_image = f", {1000 * seconds / count:.1f} ms/img" if count else ""
+            print(f"  {stage:<10} {seconds:8.1f}s{per_image}")
+
+def parse_horizon(value):
+    """
+    Parse --horizon: the fraction of the image height above which no road
+    markings are expected, for all cameras ("0.45") or per camera
+    ("CAM_FRONT=0.48,CAM_BACK=0.5,default=0.45").
+    Returns:
+        horizon (dict): Camera name (or 'default') -> fraction in [0, 1).
+    """
+    if not value:
+        return {}
+    horizon = {}
+    for part in value.split(","):
+        name, _, fraction = part.rpartition("=")
+        fraction = float(fraction)
+        if not 0.0 <= fraction < 1.0:
+            raise ValueError(f"Horizon must be in [0, 1): {part}")
+        horizon[name.strip() or "default"] = fraction
+    return horizon
+
+def prepare_input(img, roi_top=0.0, input_scale=1.0):
+    """
+    Model input of an image: the rows below the horizon line, optionally reduced.
+    Args:
+        img (np.ndarray): Full-frame image.
+        roi_top (float): Horizon line as a fraction of the image height (0: full frame).
+        input_scale (float): Scale of the model input relative to the original image.
+    Returns:
+        model_input (np.ndarray): Cropped/resized image (a view if nothing is resized).
+    """
+    model_input = img[int(round(img.shape[0] * roi_top)):]
+    if input_scale != 1.0:
+        model_input = cv2.resize(model_input, None, fx=input_scale, fy=input_scale, interpolation=cv2.INTER_AREA)
+    return model_input
+
+def restore_mask(mask, image_shape, roi_top=0.0):
+    """
+    Map a prediction of prepare_input back to full-frame coordinates
+    (nearest-neighbour upscaling, background above the horizon line).
+    """
+    h, w = image_shape[:2]
+    top = int(round(h * roi_top))
+    mask = np.asarray(mask).astype(np.uint8)
+    if mask.shape != (h - top, w):
+        mask = cv2.resize(mask, (w, h - top), interpolation=cv2.INTER_NEAREST)
+    if top == 0:
+        return mask
+    full = np.zeros((h, w), dtype=np.uint8)
+    full[top:] = mask
+    return full
+
+def load_image(task, input_scale=1.0):
+    """
+    Reader stage: decode an image and prepare the model input (ROI crop, pre-resize).
+    Args:
+        task (dict): Task with 'img_path' and optionally 'roi_top' (see prepare_input).
+        input_scale (float): Scale of the model input relative to the original image.
+    Returns:
+        item (dict): Task plus 'image' (original BGR) and 'input' (model input), or None if unreadable.
+    """
+    img = cv2.imread(task['img_path'])
+    if img is None:
+        print(f"Warning: Could not read image {task['img_path']}")
+        return None
+    return dict(task, image=img, input=prepare_input(img, task.get('roi_top', 0.0), input_scale))
+
+def write_outputs(detector, item, mask, mask_store=None, vis_dir=None, instance_options=None, instance_writer=None):
+    """
+    Writer stage: extract instances and save mask/visualization of one image.
+    Args:
+        mask_store (MaskStore, optional): Mask writer (None: masks are not saved).
+        instance_options (dict, optional): Keyword arguments of extract_instances.
+        instance_writer (InstanceWriter, optional): Writes the entry to instances.jsonl
+                                                    (the returned entry then has no instances).
+    Returns:
+        (task, entry): Task and its results.json entry.
+    """
+    # Prediction of a cropped/pre-resized input, map it back to the full frame
+    mask = restore_mask(mask, item['image'].shape, item.get('roi_top', 0.0))
+
+    instances = detector.extract_instances(mask, **(instance_options or {}))
+
+    filename = item['filename']
+    mask_filename = f"{filename.replace('.jpg', '.png')}"
+    if mask_store is not None:
+        mask_filename = mask_store.put(item['sample_token'], item['cam_name'], filename, mask)
+    if vis_dir is not None:
+        detector.visualize(item['img_path'], mask, vis_dir / f"vis_{filename}", img=item['image'])
+
+    task = {k: v for k, v in item.items() if k not in ('image', 'input')}
+    entry = {
+        "filename": filename,
+        "mask_path": str(mask_filename),
+        "instances": instances
+    }
+    if instance_writer is not None:
+        instance_writer.write(task, entry)
+        # Keep only the small part in memory
+        entry = {k: v for k, v in entry.items() if k != "instances"}
+    return task, entry
+
+def run_pipeline(detector, tasks, batch_size=1, read_workers=4, write_workers=4, queue_size=16,
+                 input_scale=1.0, mask_store=None, vis_dir=None, instance_options=None, instance_writer=None,
+                 manifest=None, timer=None):
+    """
+    Run inference as a three-stage pipeline with bounded queues:
+    reader pool (decode + pre-resize) -> inference (calling thread) -> writer pool
+    (instances, PNG masks, visualizations). The model keeps running while the
+    next images are decoded and the previous outputs are written.
+    Args:
+        detector (RoadMarkingDetector): Detector.
+        tasks (list): Tasks with 'sample_token', 'cam_name', 'img_path', 'filename'.
+        batch_size (int): Inference batch size.
+        read_workers (int): Decoder threads.
+        write_workers (int): Writer threads.
+        queue_size (int): Maximum number of images decoded ahead / waiting to be written.
+        input_scale (float): Pre-resize factor of the model input (masks are saved at full resolution).
+        mask_store (MaskStore, optional): Mask writer (None: masks are not saved).
+        vis_dir (Path, optional): Visualization output directory (None: no visualization).
+        instance_options (dict, optional): Keyword arguments of extract_instances.
+        instance_writer (InstanceWriter, optional): Stream results to instances.jsonl.
+        manifest (Manifest, optional): With instance_writer, records every task once its outputs
+                                       are on disk, i.e. its mask too (see MaskStore.unsaved_keys).
+                                       Without, the caller records the tasks after saving results.json.
+                                       Tasks need a 'fingerprint'.
+        timer (StageTimer, optional): Collects per-stage timing.
+    Returns:
+        outputs (list): (task, entry) per readable task, in task order.
+    """
+    timer = timer or StageTimer()
+    readers = ThreadPoolExecutor(max_workers=read_workers)
+    writers = ThreadPoolExecutor(max_workers=write_workers)
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_slots = threading.BoundedSemaphore(queue_size)
+    # Written tasks waiting for their mask to be saved (NPZ shards), by manifest key
+    unsaved_tasks = {}
+    unsaved_lock = threading.Lock()
+
+    def record(task):
+        with unsaved_lock:
+            unsaved_tasks[Manifest.key(task)] = task
+            # Manifest and mask keys are both "<sample_token>/<cam_name>"
+            unsaved = mask_store.unsaved_keys() if mask_store is not None else set()
+            for key in [key for key in unsaved_tasks if key not in unsaved]:
+                manifest.add(unsaved_tasks.pop(key))
+
+    def read(task):
+        with timer.measure('read'):
+            return load_image(task, input_scale)
+
+    def write(item, mask):
+        try:
+            with timer.measure('write'):
+                output = write_outputs(detector, item, mask, mask_store, vis_dir, instance_options, instance_writer)
+            if manifest is not None and instance_writer is not None:
+                record(output[0])
+            return output
+        finally:
+            write_slots.release()
+
+    def feed():
+        # Futures are queued in task order, so the inference stage sees tasks in order
+        for task in tasks:
+            read_queue.put(readers.submit(read, task))
+        read_queue.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    write_futures = []
+    progress = tqdm(total=len(tasks))
+
+    def infer(batch):
+        with timer.measure('infer', len(batch)):
+            batch_results = detector.process_batch([item['input'] for item in batch], batch_size=len(batch))
+        for item, inference_result in zip(batch, batch_results):
+            with timer.measure('wait_write', 0):
+                write_slots.acquire()
+            write_futures.append(writers.submit(write, item, inference_result['predictions']))
+
+    try:
+        batch = []
+        while True:
+            with timer.measure('wait_read', 0):
+                future = read_queue.get()
+                item = future.result() if future is not None else None
+            if future is None:
+                break
+            progress.update(1)
+            if item is None:
+                continue
+            batch.append(item)
+            if len(batch) == batch_size:
+                infer(batch)
+                batch = []
+        if batch:
+            infer(batch)
+        outputs = [f.result() for f in write_futures]
+    finally:
+        progress.close()
+        readers.shutdown(wait=False, cancel_futures=True)
+        writers.shutdown(wait=True)
+    return outputs
+
 def main():
     parser = argparse.ArgumentParser(description="SegFormer Inference on NuScenes")
     parser.add_argument("--config", required=True, help="Path to model config")
@@ -157,36 +428,85 @@ def main():
     parser.add_argument("--visualize", action="store_true", help="Enable visualization")
     parser.add_argument("--no_save_mask", action="store_true", help="Disable mask saving")
     parser.add_argument("--batch_size", type=int, default=1, help="Batch size for inference")
+    parser.add_argument("--device", default=None, help="Inference device, e.g. cuda, cuda:1, cpu (default: cuda if available)")
+    parser.add_argument("--read_workers", type=int, default=4, help="Image decoder threads")
+    parser.add_argument("--write_workers", type=int, default=4, help="Output writer threads")
+    parser.add_argument("--queue_size", type=int, default=16, help="Max images decoded ahead / waiting to be written")
+    parser.add_argument("--input_scale", type=float, default=1.0, help="Pre-resize factor of the model input (masks stay full resolution)")
+    parser.add_argument("--cameras", default=",".join(CAMERAS), help="Comma-separated cameras to process")
+    parser.add_argument("--horizon", default=None,
+                        help="Only run the model below this fraction of the image height, e.g. 0.45 or CAM_FRONT=0.48,default=0.45")
+    parser.add_argument("--min_area", type=float, default=MIN_INSTANCE_AREA, help="Minimum instance contour area in pixels")
+    parser.add_argument("--polygon_epsilon", type=float, default=0.0, help="approxPolyDP tolerance of instance polygons in pixels (0: exact)")
+    parser.add_argument("--no_polygon", action="store_true", help="Only output instance bboxes")
+    parser.add_argument("--mask_format", choices=MASK_FORMATS, default="png",
+                        help="Mask storage: one PNG per image, COCO RLE lines (masks.jsonl) or NPZ shards")
+    parser.add_argument("--shard_size", type=int, default=256, help="Masks per NPZ shard")
+    parser.add_argument("--results_format", choices=["json", "jsonl"], default="json",
+                        help="Instances as one results.json or as instances.jsonl with a per-sample index")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process images that are new/changed or whose model/options changed since the last run (manifest.jsonl)")
+    parser.add_argument("--hash_images", action="store_true", help="Identify images by content hash instead of size + mtime")
     args = parser.parse_args()
 
+    try:
+        horizon = parse_horizon(args.horizon)
+    except ValueError as e:
+        parser.error(str(e))
+    unknown = [cam for cam in args.cameras.split(",") if cam.strip() and cam.strip() not in CAMERAS]
+    if unknown:
+        parser.error(f"Unknown cameras: {unknown} (expected {CAMERAS})")
+
     # Initialize NuScenes
     print(f"Initializing NuScenes ({args.version})...")
     nusc = NuScenes(version=args.version, dataroot=args.dataroot, verbose=True)
 
     # Initialize Detector
-    print("Loading model...")
-    detector = RoadMarkingDetector(args.config, args.checkpoint)
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"Loading model on {device}...")
+    detector = RoadMarkingDetector(args.config, args.checkpoint, device=device)
 
     # Prepare output directories
     output_dir = Path(args.output_dir)
     mask_dir = output_dir / "masks"
     vis_dir = output_dir / "vis"
     mask_dir.mkdir(parents=True, exist_ok=True)
+    mask_store = None if args.no_save_mask else make_mask_store(args.mask_format, mask_dir, args.shard_size)
+    instance_writer = InstanceWriter(output_dir) if args.results_format == "jsonl" else None
     if args.visualize:
         vis_dir.mkdir(parents=True, exist_ok=True)
 
+    instance_options = {
+        "min_area": args.min_area,
+        "polygon": not args.no_polygon,
+        "epsilon": args.polygon_epsilon
+    }
+    # Everything besides the image that changes the outputs of a task
+    output_options = dict(
+        instance_options,
+        input_scale=args.input_scale,
+        horizon=horizon,
+        save_mask=not args.no_save_mask,
+        mask_format=args.mask_format,
+        results_format=args.results_format,
+        visualize=args.visualize
+    )
+    manifest = Manifest(output_dir, model_signature(args.config, args.checkpoint, output_options))
+
     results = {}
+    results_path = output_dir / "results.json"
+    if args.incremental and args.results_format == "json" and results_path.exists():
+        # Merge into the results of earlier runs
+        with open(results_path, "r") as f:
+            results = json.load(f)
     
-    cameras = ['CAM_FRONT', 'CAM_FRONT_LEFT', 'CAM_FRONT_RIGHT', 'CAM_BACK', 'CAM_BACK_LEFT', 'CAM_BACK_RIGHT']
+    cameras = [cam.strip() for cam in args.cameras.split(",") if cam.strip()]
 
-    print("Starting inference...")
-    print("Starting inference...")
-    
     # Collect all tasks first to batch them
     tasks = []
     for sample in nusc.sample:
         sample_token = sample['token']
-        results[sample_token] = {}
+        results.setdefault(sample_token, {})
         
         for cam_name in cameras:
             if cam_name not in sample['data']:
@@ -199,47 +519,59 @@ def main():
                 'sample_token': sample_token,
                 'cam_name': cam_name,
                 'img_path': str(img_path),
-                'filename': img_path.name
+                'filename': img_path.name,
+                'roi_top': horizon.get(cam_name, horizon.get('default', 0.0))
             })
 
-    # Process in batches
-    for i in tqdm(range(0, len(tasks), args.batch_size)):
-        batch_tasks = tasks[i:i + args.batch_size]
-        batch_paths = [t['img_path'] for t in batch_tasks]
-        
-        # Inference
-        batch_results = detector.process_batch(batch_paths, batch_size=args.batch_size)
-        
-        for j, task in enumerate(batch_tasks):
-            inference_result = batch_results[j]
-            mask = inference_result['predictions']
-            
-            # Extract instances
-            instances = detector.extract_instances(mask)
-            
-            filename = task['filename']
-            mask_filename = f"{filename.replace('.jpg', '.png')}"
-            
-            # Save mask
-            if not args.no_save_mask:
-                mask_path = mask_dir / mask_filename
-                cv2.imwrite(str(mask_path), mask)
-            
-            # Visualization
-            if args.visualize:
-                vis_path = vis_dir / f"vis_{filename}"
-                detector.visualize(task['img_path'], mask, vis_path)
-            
-            # Store results
-            results[task['sample_token']][task['cam_name']] = {
-                "filename": filename,
-                "mask_path": str(mask_filename),
-                "instances": instances
-            }
-
-    # Save results JSON
-    with open(output_dir / "results.json", "w") as f:
-        json.dump(results, f, indent=2)
+    with ThreadPoolExecutor(max_workers=args.read_workers) as pool:
+        fingerprints = pool.map(lambda t: image_fingerprint(t['img_path'], args.hash_images), tasks)
+        for task, fingerprint in zip(tasks, fingerprints):
+            task['fingerprint'] = fingerprint
+    if args.incremental:
+        statuses = [manifest.status(task) for task in tasks]
+        counts = {status: statuses.count(status) for status in ('new', 'changed', 'model', 'done')}
+        print(f"Incremental: {counts['new']} new, {counts['changed']} changed, "
+              f"{counts['model']} with a changed model/options, {counts['done']} unchanged (skipped)")
+        tasks = [task for task, status in zip(tasks, statuses) if status != 'done']
+
+    print("Starting inference...")
+    timer = StageTimer()
+    start = time.perf_counter()
+    outputs = run_pipeline(
+        detector, tasks,
+        batch_size=args.batch_size,
+        read_workers=args.read_workers,
+        write_workers=args.write_workers,
+        queue_size=args.queue_size,
+        input_scale=args.input_scale,
+        mask_store=mask_store,
+        vis_dir=vis_dir if args.visualize else None,
+        instance_options=instance_options,
+        instance_writer=instance_writer,
+        manifest=manifest,
+        timer=timer
+    )
+    if mask_store is not None:
+        mask_store.close()
+    if instance_writer is not None:
+        instance_writer.close()
+    timer.report(time.perf_counter() - start)
+
+    if args.results_format == "json":
+        for task, entry in outputs:
+            results[task['sample_token']][task['cam_name']] = entry
+
+        # Save results JSON (via a temp file, so an interrupted write keeps the earlier results)
+        tmp_path = output_dir / "results.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(tmp_path, results_path)
+
+    # Everything is saved now: record the tasks the pipeline could not record yet
+    # (all of them with results.json, the last NPZ shard otherwise)
+    for task, _ in outputs:
+        manifest.add(task)
+    manifest.close()
     
     print(f"Done. Results saved to {args.output_dir}")
 
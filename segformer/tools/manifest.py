@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file, read in chunks (checkpoints are hundreds of MB).
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def model_signature(config_path, checkpoint_path, options=None):
+    """
+    Digest of everything besides the image that determines a task's outputs:
+    model config, checkpoint contents and output options.
+    Args:
+        config_path (str): Model config.
+        checkpoint_path (str): Model checkpoint.
+        options (dict, optional): Output-affecting options (input scale, instance options, formats...).
+    Returns:
+        signature (str): Hex digest.
+    """
+    h = hashlib.sha256()
+    with open(config_path, "rb") as f:
+        h.update(f.read())
+    h.update(file_digest(checkpoint_path).encode())
+    h.update(json.dumps(options or {}, sort_keys=True).encode())
+    return h.hexdigest()
+
+def image_fingerprint(img_path, use_hash=False):
+    """
+    Identity of an image file: size + mtime, or size + content hash with use_hash
+    (for copies/re-syncs that touch mtime without changing the data).
+    Returns None if the image does not exist (the reader stage reports it).
+    """
+    try:
+        stat = os.stat(img_path)
+    except FileNotFoundError:
+        return None
+    if use_hash:
+        return {"size": stat.st_size, "sha1": hashlib.sha1(Path(img_path).read_bytes()).hexdigest()}
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+class Manifest:
+    """
+    Append-only record of finished tasks (output_dir/manifest.jsonl), one line
+    per task with its image fingerprint and model signature. The last line of a
+    task wins, so tasks finished before an interruption are not run again.
+    """
+    def __init__(self, output_dir, signature):
+        self.path = Path(output_dir) / MANIFEST_FILENAME
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.num_lines = 0
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn write from an interrupted run
+                        continue
+                    self.entries[record["key"]] = record
+                    self.num_lines += 1
+        self.f = open(self.path, "a")
+
+    @staticmethod
+    def key(task):
+        return f"{task['sample_token']}/{task['cam_name']}"
+
+    def status(self, task):
+        """
+        Returns:
+            status (str): 'done' (unchanged, skip), 'new', 'changed' (image) or 'model' (model/options).
+        """
+        record = self.entries.get(self.key(task))
+        if record is None:
+            return "new"
+        if record["image"] != task["fingerprint"] or record["img_path"] != task["img_path"]:
+            return "changed"
+        if record["model"] != self.signature:
+            return "model"
+        return "done"
+
+    def add(self, task):
+        record = {
+            "key": self.key(task),
+            "img_path": task["img_path"],
+            "image": task["fingerprint"],
+            "model": self.signature,
+        }
+        with self.lock:
+            if self.entries.get(record["key"]) == record:
+                # Already recorded (e.g. once by the pipeline, then again by the caller)
+                return
+            self.f.write(json.dumps(record) + "\n")
+            self.f.flush()
+            self.entries[record["key"]] = record
+            self.num_lines += 1
+
+    def close(self):
+        """
+        Close the manifest, dropping superseded lines once they make up most of the file.
+        """
+        with self.lock:
+            self.f.close()
+            if self.num_lines > 2 * len(self.entries):
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    for record in self.entries.values():
+                        f.write(json.dumps(record) + "\n")
+                os.replace(tmp_path, self.path)
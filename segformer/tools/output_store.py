@@ -0,0 +1,433 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Mask storage backends (--mask_format)
+MASK_FORMATS = ("png", "rle", "npz")
+INDEX_FILENAME = "index.json"
+INDEX_JOURNAL_FILENAME = "index.jsonl"
+RLE_FILENAME = "masks.jsonl"
+INSTANCES_FILENAME = "instances.jsonl"
+INSTANCES_INDEX_FILENAME = "instances.index.json"
+
+def mask_key(sample_token, cam_name):
+    return f"{sample_token}/{cam_name}"
+
+def counts_to_string(counts):
+    """
+    Compress run lengths into the COCO RLE string (same as pycocotools' rleToString).
+    """
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+def string_to_counts(s):
+    """
+    Inverse of counts_to_string (pycocotools' rleFrString).
+    """
+    counts = []
+    p = 0
+    while p < len(s):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+def encode_mask(mask):
+    """
+    Encode a class-ID mask as one pycocotools-compatible RLE per present class.
+
+    The mask is scanned once: the runs of the column-major mask are computed
+    for all classes together and split per class afterwards.
+    Args:
+        mask (np.ndarray): Segmentation mask (H, W) with class IDs.
+    Returns:
+        rle (dict): {str(class_id): {"size": [H, W], "counts": str}}, usable with
+                    pycocotools.mask.decode.
+    """
+    h, w = mask.shape
+    flat = np.ascontiguousarray(mask.T).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [flat.size]))
+    values = flat[starts]
+
+    rle = {}
+    for class_id in np.unique(values):
+        if class_id == 0:
+            continue
+        selected = values == class_id
+        # Boundaries alternate: start of a 0-run (implicitly 0), start of a class run, its end, ...
+        bounds = np.empty(2 * np.count_nonzero(selected) + 2, dtype=np.int64)
+        bounds[0] = 0
+        bounds[1:-1:2] = starts[selected]
+        bounds[2:-1:2] = ends[selected]
+        bounds[-1] = flat.size
+        counts = np.diff(bounds)
+        if counts[-1] == 0:
+            # Ends with the class: no trailing 0-run
+            counts = counts[:-1]
+        rle[str(int(class_id))] = {"size": [h, w], "counts": counts_to_string(counts.tolist())}
+    return rle
+
+def decode_mask(rle, shape):
+    """
+    Inverse of encode_mask.
+    """
+    h, w = shape
+    # Runs of different classes never overlap, so one difference array holds all of them
+    steps = np.zeros(h * w + 1, dtype=np.int16)
+    for class_id, class_rle in rle.items():
+        ends = np.cumsum(string_to_counts(class_rle["counts"]))
+        # Odd runs are the class pixels
+        steps[ends[0::2][:len(ends) // 2]] += int(class_id)
+        steps[ends[1::2]] -= int(class_id)
+    flat = np.cumsum(steps[:-1]).astype(np.uint8)
+    return flat.reshape(w, h).T.copy()
+
+class MaskStore(ABC):
+    """
+    Thread-safe mask writer. Every stored mask is recorded in masks/index.json
+    (key -> location), which is merged with the index of earlier runs into the
+    same directory and written on close().
+
+    Until then, index entries are appended to masks/index.jsonl as soon as the
+    mask data is on disk, so the masks of an interrupted run stay readable.
+    """
+    format = None
+
+    def __init__(self, mask_dir):
+        self.mask_dir = Path(mask_dir)
+        self.mask_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = load_mask_index(self.mask_dir)
+        drop_torn_tail(self.mask_dir / INDEX_JOURNAL_FILENAME)
+        self.journal = open(self.mask_dir / INDEX_JOURNAL_FILENAME, "a")
+
+    @abstractmethod
+    def put(self, sample_token, cam_name, filename, mask):
+        """
+        Store one mask.
+        Returns:
+            mask_path (str): File holding the mask, relative to the mask directory.
+        """
+
+    def unsaved_keys(self):
+        """
+        Keys of the masks that were put but are not on disk yet.
+        """
+        return set()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.journal.close()
+            write_index(self.mask_dir / INDEX_FILENAME, self.index)
+            os.remove(self.mask_dir / INDEX_JOURNAL_FILENAME)
+
+    def flush(self):
+        pass
+
+    def _record(self, entries):
+        """
+        Add the entries (key -> location) of saved masks to the index and its journal.
+        The caller holds the lock.
+        """
+        for key, entry in entries.items():
+            self.journal.write(json.dumps(dict(entry, key=key)) + "\n")
+            self.index[key] = entry
+        self.journal.flush()
+
+class PngMaskStore(MaskStore):
+    """
+    One PNG per image (mask_dir/<image name>.png).
+    """
+    format = "png"
+
+    def put(self, sample_token, cam_name, filename, mask):
+        mask_filename = f"{filename.replace('.jpg', '.png')}"
+        cv2.imwrite(str(self.mask_dir / mask_filename), mask)
+        with self.lock:
+            self._record({mask_key(sample_token, cam_name): {"format": self.format, "file": mask_filename}})
+        return mask_filename
+
+class RleMaskStore(MaskStore):
+    """
+    COCO RLE per class, one JSON line per image in mask_dir/masks.jsonl.
+    """
+    format = "rle"
+
+    def __init__(self, mask_dir):
+        super().__init__(mask_dir)
+        drop_torn_tail(self.mask_dir / RLE_FILENAME)
+        self.f = open(self.mask_dir / RLE_FILENAME, "ab")
+
+    def put(self, sample_token, cam_name, filename, mask):
+        key = mask_key(sample_token, cam_name)
+        line = json.dumps({"key": key, "filename": filename, "size": list(mask.shape), "rle": encode_mask(mask)})
+        with self.lock:
+            offset = self.f.tell()
+            self.f.write(line.encode("utf-8") + b"\n")
+            # Flushed per mask like instances.jsonl, so an interrupted run keeps what it wrote
+            self.f.flush()
+            self._record({key: {"format": self.format, "file": RLE_FILENAME, "offset": offset}})
+        return RLE_FILENAME
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+class NpzMaskStore(MaskStore):
+    """
+    Compressed NPZ shards of up to `shard_size` masks (mask_dir/shard_XXXXX.npz).
+    """
+    format = "npz"
+
+    def __init__(self, mask_dir, shard_size=256):
+        super().__init__(mask_dir)
+        self.shard_size = shard_size
+        # Continue the numbering of shards from earlier runs
+        self.next_shard = len(list(self.mask_dir.glob("shard_*.npz")))
+        self.buffer = {}
+        # Keys of full shards that are being compressed
+        self.saving = set()
+        self.shard_name = self._shard_name()
+
+    def _shard_name(self):
+        name = f"shard_{self.next_shard:05d}.npz"
+        self.next_shard += 1
+        return name
+
+    def put(self, sample_token, cam_name, filename, mask):
+        key = mask_key(sample_token, cam_name)
+        with self.lock:
+            shard_name = self.shard_name
+            self.buffer[key] = mask
+            if len(self.buffer) < self.shard_size:
+                return shard_name
+            buffer, self.buffer = self.buffer, {}
+            self.saving.update(buffer)
+            self.shard_name = self._shard_name()
+        # Compress outside the lock so other writers are not blocked
+        np.savez_compressed(self.mask_dir / shard_name, **buffer)
+        with self.lock:
+            self._record({key: {"format": self.format, "file": shard_name} for key in buffer})
+            self.saving.difference_update(buffer)
+        return shard_name
+
+    def unsaved_keys(self):
+        with self.lock:
+            return set(self.buffer) | self.saving
+
+    def flush(self):
+        if self.buffer:
+            np.savez_compressed(self.mask_dir / self.shard_name, **self.buffer)
+            self._record({key: {"format": self.format, "file": self.shard_name} for key in self.buffer})
+            self.buffer = {}
+
+def make_mask_store(mask_format, mask_dir, shard_size=256):
+    """
+    Create the mask writer of --mask_format.
+    """
+    if mask_format == "png":
+        return PngMaskStore(mask_dir)
+    if mask_format == "rle":
+        return RleMaskStore(mask_dir)
+    if mask_format == "npz":
+        return NpzMaskStore(mask_dir, shard_size)
+    raise ValueError(f"Unknown mask format: {mask_format} (expected one of {MASK_FORMATS})")
+
+class MaskReader:
+    """
+    Random access to stored masks by sample token, whatever the format.
+    """
+    def __init__(self, mask_dir):
+        self.mask_dir = Path(mask_dir)
+        self.index = load_mask_index(self.mask_dir)
+        self._shards = {}
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, sample_token, cam_name):
+        """
+        Returns:
+            mask (np.ndarray): Segmentation mask, or None if it was not stored.
+        """
+        key = mask_key(sample_token, cam_name)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        path = self.mask_dir / entry["file"]
+        if entry["format"] == "png":
+            return cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+        if entry["format"] == "rle":
+            with open(path, "rb") as f:
+                f.seek(entry["offset"])
+                record = json.loads(f.readline())
+            return decode_mask(record["rle"], record["size"])
+        if entry["file"] not in self._shards:
+            self._shards[entry["file"]] = np.load(path)
+        return self._shards[entry["file"]][key]
+
+    def get_sample(self, sample_token):
+        """
+        Returns:
+            masks (dict): Camera name -> mask of every stored camera of the sample.
+        """
+        prefix = f"{sample_token}/"
+        return {key[len(prefix):]: self.get(sample_token, key[len(prefix):])
+                for key in self.index if key.startswith(prefix)}
+
+class InstanceWriter:
+    """
+    Thread-safe JSONL writer of per-image results (one line per sample/camera),
+    with a sample token -> byte offsets index written on close().
+    Appends to (and merges the index of) earlier runs into the same directory;
+    lines of an interrupted run that are missing from the index are added back.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.lock = threading.Lock()
+        path = self.output_dir / INSTANCES_FILENAME
+        drop_torn_tail(path)
+        self.index = recover_instance_index(path, load_index(self.output_dir / INSTANCES_INDEX_FILENAME))
+        self.f = open(path, "ab")
+
+    def write(self, task, entry):
+        line = json.dumps(dict(sample_token=task['sample_token'], cam_name=task['cam_name'], **entry))
+        with self.lock:
+            offset = self.f.tell()
+            self.f.write(line.encode("utf-8") + b"\n")
+            self.f.flush()
+            self.index.setdefault(task['sample_token'], {})[task['cam_name']] = offset
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+            write_index(self.output_dir / INSTANCES_INDEX_FILENAME, self.index)
+
+class InstanceReader:
+    """
+    Random access to instances.jsonl by sample token.
+    """
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / INSTANCES_FILENAME
+        # Interrupted run: lines written after the index (or all of them, without one)
+        self.index = recover_instance_index(self.path, load_index(Path(output_dir) / INSTANCES_INDEX_FILENAME))
+
+    def tokens(self):
+        return self.index.keys()
+
+    def get(self, sample_token):
+        """
+        Returns:
+            results (dict): Camera name -> record (filename, mask_path, instances), like
+                            results.json[sample_token]. Empty if the sample is unknown.
+        """
+        results = {}
+        with open(self.path, "rb") as f:
+            for cam_name, offset in self.index.get(sample_token, {}).items():
+                f.seek(offset)
+                record = json.loads(f.readline())
+                results[cam_name] = {k: v for k, v in record.items() if k not in ('sample_token', 'cam_name')}
+        return results
+
+def load_index(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def load_mask_index(mask_dir):
+    """
+    Mask index of a directory: index.json plus the journal of an interrupted run.
+    """
+    mask_dir = Path(mask_dir)
+    index = load_index(mask_dir / INDEX_FILENAME)
+    journal_path = mask_dir / INDEX_JOURNAL_FILENAME
+    if journal_path.exists():
+        with open(journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write from an interrupted run
+                    continue
+                index[entry.pop("key")] = entry
+    return index
+
+def recover_instance_index(path, index):
+    """
+    Add the lines of instances.jsonl after the last indexed one to the index
+    (they were written by a run that was interrupted before writing its index).
+    """
+    if not os.path.exists(path):
+        return index
+    offset = max((offset for cams in index.values() for offset in cams.values()), default=0)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn write from an interrupted run
+                record = None
+            if record is not None:
+                index.setdefault(record['sample_token'], {})[record['cam_name']] = offset
+            offset += len(line)
+    return index
+
+def drop_torn_tail(path):
+    """
+    Cut the partial last line an interrupted run may have left in a JSONL file,
+    so that appended lines start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+def write_index(path, index):
+    # Write to a temp file first so an interrupted write keeps the old index
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)